@@ -1,129 +1,130 @@
-from flask import Flask, redirect, request, session, render_template, url_for, make_response
+import time
+
+# Taken first, so the startup report covers every import below
+STARTED_AT = time.perf_counter()
+
+from flask import Flask, redirect, request, session, render_template, url_for, make_response, jsonify, Response, stream_with_context, g
 from flask_session import Session
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 from dotenv import load_dotenv
 import os
 import json
 import logging
 import os.path
-from google.oauth2.credentials import Credentials
 import warnings
-from datetime import datetime, timedelta
 from jinja2 import TemplateNotFound, TemplateSyntaxError
-import tempfile
 import uuid
 import urllib.parse
-import threading
+import sys
+from clients import get_spotify_oauth, google_oauth_flow, load_google_client_config, spotify_client
+from jobs import job_manager, TransferJob
+from engines import TransferRequest
+from transfer import merge_playlist_id, merged_playlist_ids
+from match_cache import match_cache
+from quota import quota_accountant
+from state import BackendCache, state_backend
+from token_store import token_store
+from retry import call, circuit_breakers
+from dead_letters import dead_letters
+from playlist_cache import PLAYLIST_PAGE_SIZE, playlist_cache
+from metrics import http_request_seconds, registry, startup_seconds
+from logs import configure_logging
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY")
 load_dotenv()
 
-# Configure Flask-Session
-app.config["SESSION_TYPE"] = "filesystem"
-app.config["SESSION_FILE_DIR"] = os.path.join("data", "sessions")
+# Configure Flask-Session; sessions live in the shared state backend so any worker can serve any request
+app.config["SESSION_TYPE"] = "cachelib"
+app.config["SESSION_CACHELIB"] = BackendCache(state_backend)
 app.config["SESSION_PERMANENT"] = False
 app.config["SESSION_USE_SIGNER"] = True
 Session(app)
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+# Set up logging; records are written by a background thread, see logs.py
+configure_logging()
 logger = logging.getLogger(__name__)
 
-# Paths for progress file
-PROGRESS_FILE = "data/transfer_progress.json"
-
-# Ensure data directory and files exist
+# Ensure data directory exists
 os.makedirs("data", exist_ok=True)
-if not os.path.exists(PROGRESS_FILE):
-    with open(PROGRESS_FILE, "w") as f:
-        json.dump({}, f)
 
-# Thread-safe OAuth state store
-oauth_states = {}
-oauth_states_lock = threading.Lock()
+# OAuth states expire if the user never comes back from the provider
+OAUTH_STATE_TTL = 600
+
+# Server-Sent Events tuning for the job event stream
+SSE_KEEPALIVE_SECONDS = 15
+SSE_MAX_STREAM_SECONDS = 300
+SSE_RETRY_MS = 3000
+
+# Add a Server-Timing header with each response's handling time, for browser dev tools
+METRICS_TIMING_HEADER = os.getenv("METRICS_TIMING_HEADER", "").lower() in ("1", "true", "yes")
+
+# Libraries imported on first use rather than at startup; the startup report lists which are still unloaded
+DEFERRED_MODULES = ("spotipy", "googleapiclient.discovery", "google_auth_oauthlib", "httplib2", "requests")
+
+# Parse the Google client config once now, so a broken one shows up in the startup log
+try:
+    load_google_client_config()
+except ValueError as e:
+    logger.warning(f"Google OAuth is unavailable until the client config is fixed: {e}")
 
 # Suppress Spotify deprecation warning
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
-# Spotify OAuth setup with unique cache path per session
-def get_spotify_oauth(session_id):
-    cache_path = os.path.join("data", f".cache-{session_id}")
-    return SpotifyOAuth(
-        client_id=os.getenv("SPOTIFY_CLIENT_ID"),
-        client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
-        redirect_uri=os.getenv("SPOTIFY_REDIRECT_URI"),
-        scope="playlist-read-private playlist-read-collaborative",
-        cache_path=cache_path,  # Unique cache path per session
-        state=session_id   # Use session_id as state for uniqueness
-    )
-
 def store_oauth_state(session_id, state):
-    """Store OAuth state in thread-safe dictionary."""
-    with oauth_states_lock:
-        oauth_states[session_id] = state
-        logger.info(f"Stored OAuth state for session_id {session_id}: {state}")
+    """Store OAuth state in the shared state backend, so the callback can land on any worker."""
+    state_backend.set(f"oauth_state:{session_id}", state, ttl=OAUTH_STATE_TTL)
+    logger.debug(f"Stored OAuth state for session_id {session_id}")
 
 def get_oauth_state(session_id):
-    """Retrieve OAuth state from thread-safe dictionary."""
-    with oauth_states_lock:
-        state = oauth_states.get(session_id)
-        logger.info(f"Retrieved OAuth state for session_id {session_id}: {state}")
-        return state
+    """Retrieve OAuth state from the shared state backend."""
+    state = state_backend.get(f"oauth_state:{session_id}")
+    logger.debug(f"Retrieved OAuth state for session_id {session_id}")
+    return state
 
 def remove_oauth_state(session_id):
-    """Remove OAuth state from thread-safe dictionary."""
-    with oauth_states_lock:
-        oauth_states.pop(session_id, None)
-        logger.info(f"Removed OAuth state for session_id {session_id}")
+    """Remove OAuth state from the shared state backend."""
+    state_backend.delete(f"oauth_state:{session_id}")
+    logger.debug(f"Removed OAuth state for session_id {session_id}")
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    """Record the route's latency; streamed responses count until their first byte."""
+    started = g.get("request_started")
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    # Label by route pattern, not URL, so IDs don't create a series each
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    http_request_seconds.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+    if METRICS_TIMING_HEADER:
+        response.headers["Server-Timing"] = f"app;dur={elapsed * 1000:.1f}"
+    return response
 
 def refresh_spotify_token():
-    """Refresh Spotify access token if expired."""
+    """This session's Spotify token info, refreshed first if it's about to expire."""
+    session_id = session.get("session_id")
     try:
-        token_info = session.get("token_info")
+        token_info = token_store.fresh_spotify(session_id)
         if not token_info:
-            raise ValueError("No token info in session")
-        
-        expires_at = token_info.get("expires_at")
-        if not expires_at or datetime.now().timestamp() >= expires_at - 60:
-            logger.info("Spotify token expired or about to expire, refreshing...")
-            session_id = session.get("session_id")
-            if not session_id:
-                raise ValueError("No session_id in session")
-            sp_oauth = get_spotify_oauth(session_id)
-            token_info = sp_oauth.refresh_access_token(token_info["refresh_token"])
-            session["token_info"] = token_info
-        logger.info(f"Using Spotify access token: {token_info['access_token'][:10]}...")
-        return token_info["access_token"]
+            raise ValueError("No Spotify token for this session")
+        return token_info
     except Exception as e:
         logger.error(f"Error refreshing Spotify token: {e}")
-        session.pop("token_info", None)
+        token_store.delete(session_id, "spotify")
         raise
 
-def read_progress():
-    try:
-        with open(PROGRESS_FILE, "r") as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"Error reading progress file: {e}")
-        return {}
-
-def write_progress(data):
-    try:
-        with open(PROGRESS_FILE, "w") as f:
-            json.dump(data, f, indent=2)
-    except Exception as e:
-        logger.error(f"Error writing to progress file: {e}")
+def spotify_logged_in():
+    return token_store.get(session.get("session_id"), "spotify") is not None
 
 @app.route("/")
 def index():
     try:
         # Ensure session is fresh for new requests
-        session.pop("token_info", None)
+        token_store.delete(session.get("session_id"), "spotify")
         # Generate a unique session ID and cookie name if not present
         if "session_id" not in session:
             session["session_id"] = str(uuid.uuid4())
@@ -142,13 +143,8 @@ def index():
 def login():
     session_id = session.get("session_id", "unknown")
     session.clear()  # Ensure fresh session
-    for cache_file in os.listdir("data"):
-        if cache_file.startswith(".cache"):
-            try:
-                os.remove(os.path.join("data", cache_file))
-                logger.info(f"Removed cache file: {cache_file}")
-            except Exception as e:
-                logger.error(f"Error removing cache file {cache_file}: {e}")
+    # Only this session's tokens; other users stay logged in
+    token_store.delete(session_id)
     remove_oauth_state(session_id)
     session["session_id"] = str(uuid.uuid4())
     app.config["SESSION_COOKIE_NAME"] = f"session_{session['session_id']}"
@@ -180,7 +176,7 @@ def authorize():
         session.modified = True
         store_oauth_state(state, state)
     # Conditionally add show_dialog
-    show_dialog = not session.get("token_info") and not request.args.get("force_dialog")
+    show_dialog = not token_store.get(session.get("session_id"), "spotify") and not request.args.get("force_dialog")
     auth_url = sp_oauth.get_authorize_url(state=state)
     parsed_url = urllib.parse.urlparse(auth_url)
     query_params = urllib.parse.parse_qs(parsed_url.query)
@@ -202,13 +198,7 @@ def authorize():
 @app.route("/logout")
 def logout():
     session_id = session.get("session_id", "unknown")
-    for cache_file in os.listdir("data"):
-        if cache_file.startswith(".cache"):
-            try:
-                os.remove(os.path.join("data", cache_file))
-                logger.info(f"Removed cache file: {cache_file}")
-            except Exception as e:
-                logger.error(f"Error removing cache file {cache_file}: {e}")
+    token_store.delete(session_id)
     remove_oauth_state(session_id)
     session.clear()
     spotify_cookies = [
@@ -228,13 +218,7 @@ def clear_session():
     # This route is no longer needed in the redirect chain but kept for consistency
     session_id = session.get("session_id", "unknown")
     session.clear()
-    for cache_file in os.listdir("data"):
-        if cache_file.startswith(".cache"):
-            try:
-                os.remove(os.path.join("data", cache_file))
-                logger.info(f"Removed cache file: {cache_file}")
-            except Exception as e:
-                logger.error(f"Error removing cache file {cache_file}: {e}")
+    token_store.delete(session_id)
     remove_oauth_state(session_id)
     # Redirect to Spotify logout (optional, as cookies should suffice)
     spotify_logout_url = "https://www.spotify.com/us/logout/"
@@ -262,14 +246,13 @@ def callback():
         if not state or (expected_state and state != expected_state):
             raise ValueError(f"Invalid or missing state parameter: got {state}, expected {expected_state}")
         token_info = sp_oauth.get_access_token(request.args["code"], as_dict=True)
-        session["token_info"] = token_info
+        token_store.save(session_id, "spotify", token_info)
         remove_oauth_state(session_id)
-        logger.info(f"Spotify token obtained for session_id {session_id}: {token_info['access_token'][:10]}...")
-        logger.info(f"Token info in /callback: {token_info}")
+        logger.info(f"Spotify token obtained for session_id {session_id}")
         return redirect(url_for("playlists"))
     except Exception as e:
         logger.error(f"Spotify auth error: {e}")
-        session.pop("token_info", None)
+        token_store.delete(session_id, "spotify")
         remove_oauth_state(session_id)
         try:
             return render_template("error.html", message=f"Spotify login failed: {str(e)}")
@@ -280,21 +263,33 @@ def callback():
             logger.error(f"Template syntax error in error.html: {te}")
             return f"Error: Invalid syntax in error.html: {str(te)}", 500
 
+def playlist_page(offset, refresh=False):
+    """A page of the logged-in user's playlists, served from the playlist cache while it's fresh."""
+    sp = spotify_client(refresh_spotify_token()["access_token"])
+    # The Spotify user ID outlives any one token, so it's only looked up once per session
+    if "spotify_user_id" not in session:
+        user = call("spotify", "me", sp.current_user)
+        session["spotify_user_id"] = user["id"]
+        logger.info(f"Spotify user for session_id {session.get('session_id')}: {user['id']} ({user.get('display_name', 'Unknown')})")
+    spotify_user_id = session["spotify_user_id"]
+    if refresh:
+        playlist_cache.invalidate(spotify_user_id)
+    return playlist_cache.get_page(spotify_user_id, offset, lambda offset: call(
+        "spotify", "me.playlists", lambda: sp.current_user_playlists(limit=PLAYLIST_PAGE_SIZE, offset=offset)))
+
 @app.route("/playlists")
 def playlists():
-    if "token_info" not in session:
+    if not spotify_logged_in():
         return redirect(url_for("login"))
     try:
-        access_token = refresh_spotify_token()
-        sp = spotipy.Spotify(auth=access_token)
-        user = sp.current_user()
-        logger.info(f"Fetched playlists for Spotify user: {user['id']} ({user.get('display_name', 'Unknown')}) with session_id: {session.get('session_id')}")
-        playlists = sp.current_user_playlists(limit=50)["items"]
-        logger.info(f"Fetched {len(playlists)} playlists for user with token: {access_token[:10]}...")
-        return render_template("playlists.html", playlists=playlists)
+        offset = max(request.args.get("offset", 0, type=int), 0)
+        page = playlist_page(offset, refresh=bool(request.args.get("refresh")))
+        logger.info(f"Showing {len(page['items'])} of {page['total']} playlists from offset {offset}")
+        return render_template("playlists.html", playlists=page["items"], total=page["total"],
+                               next_offset=page["next_offset"])
     except Exception as e:
         logger.error(f"Error fetching playlists: {e}")
-        session.pop("token_info", None)
+        token_store.delete(session.get("session_id"), "spotify")
         try:
             return render_template("error.html", message=f"Failed to fetch playlists: {str(e)}")
         except TemplateNotFound as te:
@@ -304,6 +299,17 @@ def playlists():
             logger.error(f"Template syntax error in error.html: {te}")
             return f"Error: Invalid syntax in error.html: {str(te)}", 500
 
+@app.route("/api/playlists")
+def playlist_list():
+    """Further pages of the playlists page, loaded as the user scrolls."""
+    if not spotify_logged_in():
+        return jsonify({"error": "Not logged in to Spotify"}), 401
+    try:
+        return jsonify(playlist_page(max(request.args.get("offset", 0, type=int), 0)))
+    except Exception as e:
+        logger.error(f"Error fetching playlists: {e}")
+        return jsonify({"error": f"Failed to fetch playlists: {e}"}), 502
+
 @app.route("/google-callback")
 def google_callback():
     try:
@@ -311,82 +317,25 @@ def google_callback():
         state = get_oauth_state(session_id)
         if not state:
             raise ValueError("No OAuth state found for session")
-        client_secrets_file = "client_secrets.json"
-        temp_file = None
-        if not os.path.exists(client_secrets_file) and os.getenv("GOOGLE_CLIENT_SECRETS"):
-            try:
-                client_secrets = json.loads(os.getenv("GOOGLE_CLIENT_SECRETS"))
-                with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as temp_file:
-                    json.dump(client_secrets, temp_file)
-                    temp_file.flush()
-                    client_secrets_file = temp_file.name
-                logger.info(f"Created temporary client_secrets file: {client_secrets_file}")
-            except json.JSONDecodeError as e:
-                logger.error(f"Invalid GOOGLE_CLIENT_SECRETS format: {e}")
-                try:
-                    return render_template("error.html", message=f"Invalid client secrets format: {str(e)}")
-                except TemplateNotFound as te:
-                    logger.error(f"Template not found: {te}")
-                    return f"Error: error.html template not found.", 500
-                except TemplateSyntaxError as te:
-                    logger.error(f"Template syntax error in error.html: {te}")
-                    return f"Error: Invalid syntax in error.html: {str(te)}", 500
-        elif not os.path.exists(client_secrets_file):
-            logger.error("client_secrets.json not found and GOOGLE_CLIENT_SECRETS not set")
-            try:
-                return render_template("error.html", message="Client secrets file not found.")
-            except TemplateNotFound as te:
-                logger.error(f"Template not found: {te}")
-                return f"Error: error.html template not found.", 500
-            except TemplateSyntaxError as te:
-                logger.error(f"Template syntax error in error.html: {te}")
-                return f"Error: Invalid syntax in error.html: {str(te)}", 500
-
-        try:
-            with open(client_secrets_file, "r", encoding="utf-8") as f:
-                client_secrets = json.load(f)
-            logger.info(f"Loaded client_secrets: {json.dumps(client_secrets, indent=2)}")
-        except Exception as e:
-            logger.error(f"Error loading client_secrets.json: {e}")
-            try:
-                return render_template("error.html", message=f"Error loading client secrets: {str(e)}")
-            except TemplateNotFound as te:
-                logger.error(f"Template not found: {te}")
-                return f"Error: error.html template not found.", 500
-            except TemplateSyntaxError as te:
-                logger.error(f"Template syntax error in error.html: {te}")
-                return f"Error: Invalid syntax in error.html: {str(te)}", 500
-
-        flow = InstalledAppFlow.from_client_secrets_file(
-            client_secrets_file,
-            scopes=["https://www.googleapis.com/auth/youtube"],
-            state=state,
-            redirect_uri="https://spotify-to-youtube-web.onrender.com/google-callback" if os.getenv("RENDER") else "http://127.0.0.1:5000/google-callback"
-        )
+        flow = google_oauth_flow(state=state)
         logger.info(f"Google OAuth redirect URI in callback: {flow.redirect_uri}")
         flow.fetch_token(code=request.args.get("code"))
         credentials = flow.credentials
-        session["google_credentials"] = {
+        token_store.save(session_id, "google", {
             "token": credentials.token,
             "refresh_token": credentials.refresh_token,
             "token_uri": credentials.token_uri,
             "client_id": credentials.client_id,
             "client_secret": credentials.client_secret,
             "scopes": credentials.scopes
-        }
+        })
         playlist_id = session.get("transfer_playlist_id")
         if not playlist_id:
             raise ValueError("No playlist ID found in session")
-        if temp_file:
-            os.unlink(temp_file.name)
-            logger.info(f"Deleted temporary client_secrets file: {temp_file.name}")
         remove_oauth_state(session_id)
         return redirect(url_for("transfer", playlist_id=playlist_id))
     except Exception as e:
         logger.error(f"Google callback error: {e}")
-        if temp_file:
-            os.unlink(temp_file.name)
-            logger.info(f"Deleted temporary client_secrets file: {temp_file.name}")
         try:
             return render_template("error.html", message=f"Google login failed: {str(e)}")
         except TemplateNotFound as te:
@@ -398,77 +347,42 @@ def google_callback():
 
 @app.route("/transfer/<playlist_id>", methods=["GET", "POST"])
 def transfer(playlist_id):
-    if "token_info" not in session:
+    if not spotify_logged_in():
         return redirect(url_for("login"))
-
     try:
-        # Check for resume state
-        resume_key = f"transfer_{session['token_info']['access_token']}_{playlist_id}"
-        progress = read_progress()
-        last_transferred = progress.get(resume_key, {}).get("last_transferred", 0)
-        logger.info(f"Resuming transfer from index {last_transferred} for session_id: {session.get('session_id')}")
-
-        # Spotify playlist data
-        access_token = refresh_spotify_token()
-        sp = spotipy.Spotify(auth=access_token)
-        playlist = sp.playlist(playlist_id)
-        tracks = sp.playlist_tracks(playlist_id)["items"]
-
-        # Check if Google credentials are already in session
-        if "google_credentials" in session:
-            credentials = Credentials(**session["google_credentials"])
-            youtube = build("youtube", "v3", credentials=credentials)
-        else:
-            # Load client secrets
-            client_secrets_file = "client_secrets.json"
-            temp_file = None
-            if not os.path.exists(client_secrets_file) and os.getenv("GOOGLE_CLIENT_SECRETS"):
-                try:
-                    client_secrets = json.loads(os.getenv("GOOGLE_CLIENT_SECRETS"))
-                    with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as temp_file:
-                        json.dump(client_secrets, temp_file)
-                        temp_file.flush()
-                        client_secrets_file = temp_file.name
-                    logger.info(f"Created temporary client_secrets file: {client_secrets_file}")
-                except json.JSONDecodeError as e:
-                    logger.error(f"Invalid GOOGLE_CLIENT_SECRETS format: {e}")
-                    try:
-                        return render_template("error.html", message=f"Invalid client secrets format: {str(e)}")
-                    except TemplateNotFound as te:
-                        logger.error(f"Template not found: {te}")
-                        return f"Error: error.html template not found.", 500
-                    except TemplateSyntaxError as te:
-                        logger.error(f"Template syntax error in error.html: {te}")
-                        return f"Error: Invalid syntax in error.html: {str(te)}", 500
-                except Exception as e:
-                    logger.error(f"Error processing GOOGLE_CLIENT_SECRETS: {e}")
-                    try:
-                        return render_template("error.html", message=f"Error processing client secrets: {str(e)}")
-                    except TemplateNotFound as te:
-                        logger.error(f"Template not found: {te}")
-                        return f"Error: error.html template not found.", 500
-                    except TemplateSyntaxError as te:
-                        logger.error(f"Template syntax error in error.html: {te}")
-                        return f"Error: Invalid syntax in error.html: {str(te)}", 500
-            elif not os.path.exists(client_secrets_file):
-                logger.error("client_secrets.json not found and GOOGLE_CLIENT_SECRETS not set")
-                try:
-                    return render_template("error.html", message="Client secrets file not found.")
-                except TemplateNotFound as te:
-                    logger.error(f"Template not found: {te}")
-                    return f"Error: error.html template not found.", 500
-                except TemplateSyntaxError as te:
-                    logger.error(f"Template syntax error in error.html: {te}")
-                    return f"Error: Invalid syntax in error.html: {str(te)}", 500
+        merged_playlist_ids(playlist_id)
+    except ValueError as e:
+        try:
+            return render_template("error.html", message=str(e)), 400
+        except TemplateNotFound as te:
+            logger.error(f"Template not found: {te}")
+            return f"Error: error.html template not found.", 500
+        except TemplateSyntaxError as te:
+            logger.error(f"Template syntax error in error.html: {te}")
+            return f"Error: Invalid syntax in error.html: {str(te)}", 500
 
+    try:
+        session_id = session.get("session_id", "unknown")
+        # Don't start a second transfer of the same playlist while one is in flight
+        existing_job = job_manager.find_active(session_id, playlist_id)
+        if existing_job:
+            return redirect(url_for("transfer_status", job_id=existing_job.id))
+
+        token_info = refresh_spotify_token()
+        # Sync state and resume points are kept per Spotify account, which outlives any one token
+        if "spotify_user_id" not in session:
+            session["spotify_user_id"] = call("spotify", "me", spotify_client(token_info["access_token"]).current_user)["id"]
+        fresh = bool(request.args.get("fresh") or session.get("transfer_fresh"))
+
+        # Check if Google credentials are already stored for this session
+        google_credentials = token_store.get(session_id, "google")
+        if google_credentials is None:
             try:
-                with open(client_secrets_file, "r", encoding="utf-8") as f:
-                    client_secrets = json.load(f)
-                logger.info(f"Loaded client_secrets: {json.dumps(client_secrets, indent=2)}")
-            except Exception as e:
-                logger.error(f"Error loading client_secrets.json: {e}")
+                flow = google_oauth_flow()
+            except ValueError as e:
+                logger.error(f"Google OAuth client config unavailable: {e}")
                 try:
-                    return render_template("error.html", message=f"Error loading client secrets: {str(e)}")
+                    return render_template("error.html", message=str(e))
                 except TemplateNotFound as te:
                     logger.error(f"Template not found: {te}")
                     return f"Error: error.html template not found.", 500
@@ -477,24 +391,14 @@ def transfer(playlist_id):
                     return f"Error: Invalid syntax in error.html: {str(te)}", 500
 
             try:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    client_secrets_file,
-                    scopes=["https://www.googleapis.com/auth/youtube"],
-                    redirect_uri="https://spotify-to-youtube-web.onrender.com/google-callback" if os.getenv("RENDER") else "http://127.0.0.1:5000/google-callback"
-                )
                 logger.info(f"Google OAuth redirect URI: {flow.redirect_uri}")
                 auth_url, state = flow.authorization_url(prompt="consent")
                 store_oauth_state(session.get("session_id", "unknown"), state)
                 session["transfer_playlist_id"] = playlist_id
-                if temp_file:
-                    os.unlink(temp_file.name)
-                    logger.info(f"Deleted temporary client_secrets file: {temp_file.name}")
+                session["transfer_fresh"] = fresh
                 return redirect(auth_url)
             except Exception as e:
                 logger.error(f"Error initializing Google OAuth flow: {e}")
-                if temp_file:
-                    os.unlink(temp_file.name)
-                    logger.info(f"Deleted temporary client_secrets file: {temp_file.name}")
                 try:
                     return render_template("error.html", message=f"Failed to initialize Google OAuth: {str(e)}")
                 except TemplateNotFound as te:
@@ -504,68 +408,22 @@ def transfer(playlist_id):
                     logger.error(f"Template syntax error in error.html: {te}")
                     return f"Error: Invalid syntax in error.html: {str(te)}", 500
 
-        # Create YouTube playlist
-        youtube_playlist = youtube.playlists().insert(
-            part="snippet,status",
-            body={
-                "snippet": {
-                    "title": playlist["name"],
-                    "description": playlist.get("description", "Transferred from Spotify")
-                },
-                "status": {"privacyStatus": "private"}
-            }
-        ).execute()
-
-        # Transfer tracks and count successes
-        total_tracks = len([item for item in tracks if item["track"]])
-        successful_transfers = 0
-        for i, item in enumerate(tracks[last_transferred:], start=last_transferred):
-            track = item["track"]
-            if not track:
-                continue
-            query = f"{track['name']} {track['artists'][0]['name']}"
-            try:
-                search_response = youtube.search().list(
-                    q=query, part="id", maxResults=1, type="video"
-                ).execute()
-                if search_response["items"]:
-                    video_id = search_response["items"][0]["id"]["videoId"]
-                    youtube.playlistItems().insert(
-                        part="snippet",
-                        body={
-                            "snippet": {
-                                "playlistId": youtube_playlist["id"],
-                                "resourceId": {"kind": "youtube#video", "videoId": video_id}
-                            }
-                        }
-                    ).execute()
-                    successful_transfers += 1
-                # Save progress
-                progress[resume_key] = {"last_transferred": i + 1}
-                write_progress(progress)
-            except HttpError as e:
-                logger.error(f"Error transferring track {query}: {e}")
-                continue
-
-        # Clear progress and session data on completion
-        progress.pop(resume_key, None)
-        write_progress(progress)
-        session.pop("google_credentials", None)
-        session.pop("transfer_playlist_id", None)
-        remove_oauth_state(session.get("session_id", "unknown"))
-        try:
-            return render_template(
-                "transfer.html",
-                message=f"Playlist '{playlist['name']}' transferred successfully!",
-                successful_transfers=successful_transfers,
-                total_tracks=total_tracks
+        # Queue the transfer and return immediately; the status page follows its progress.
+        # If another worker started the same transfer meanwhile, that job is returned instead
+        job = job_manager.submit(
+            TransferJob(session_id, playlist_id),
+            TransferRequest(
+                dict(token_info),
+                dict(google_credentials),
+                session["spotify_user_id"],
+                fresh
             )
-        except TemplateNotFound as e:
-            logger.error(f"Template not found: {e}")
-            return f"Error: transfer.html template not found.", 500
-        except TemplateSyntaxError as e:
-            logger.error(f"Template syntax error in transfer.html: {e}")
-            return f"Error: Invalid syntax in transfer.html: {str(e)}", 500
+        )
+        token_store.delete(session_id, "google")
+        session.pop("transfer_playlist_id", None)
+        session.pop("transfer_fresh", None)
+        remove_oauth_state(session_id)
+        return redirect(url_for("transfer_status", job_id=job.id))
     except Exception as e:
         logger.error(f"Transfer error: {e}")
         try:
@@ -577,5 +435,109 @@ def transfer(playlist_id):
             logger.error(f"Template syntax error in error.html: {te}")
             return f"Error: Invalid syntax in error.html: {str(te)}", 500
 
+@app.route("/merge")
+def merge():
+    """Transfer the checked playlists into one YouTube playlist, each track only once."""
+    if not spotify_logged_in():
+        return redirect(url_for("login"))
+    playlist_ids = list(dict.fromkeys(request.args.getlist("playlist")))
+    # The merge is one transfer as far as jobs, sync state and resume points are concerned; /transfer validates it
+    return redirect(url_for("transfer", playlist_id=merge_playlist_id(playlist_ids), fresh=request.args.get("fresh")))
+
+@app.route("/transfer-status/<job_id>")
+def transfer_status(job_id):
+    job = job_manager.get(job_id)
+    if not job or job.session_id != session.get("session_id"):
+        try:
+            return render_template("error.html", message="Transfer job not found."), 404
+        except TemplateNotFound as te:
+            logger.error(f"Template not found: {te}")
+            return f"Error: error.html template not found.", 500
+        except TemplateSyntaxError as te:
+            logger.error(f"Template syntax error in error.html: {te}")
+            return f"Error: Invalid syntax in error.html: {str(te)}", 500
+    try:
+        return render_template("transfer_status.html", job=job.to_dict())
+    except TemplateNotFound as e:
+        logger.error(f"Template not found: {e}")
+        return f"Error: transfer_status.html template not found.", 500
+    except TemplateSyntaxError as e:
+        logger.error(f"Template syntax error in transfer_status.html: {e}")
+        return f"Error: Invalid syntax in transfer_status.html: {str(e)}", 500
+
+@app.route("/api/jobs/<job_id>")
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if not job or job.session_id != session.get("session_id"):
+        return jsonify({"error": "Transfer job not found"}), 404
+    return jsonify(job.to_dict())
+
+@app.route("/api/jobs/<job_id>/events")
+def job_events(job_id):
+    """Server-Sent Events stream of a job's per-track events, resumable via Last-Event-ID."""
+    job = job_manager.get(job_id)
+    if not job or job.session_id != session.get("session_id"):
+        return jsonify({"error": "Transfer job not found"}), 404
+    try:
+        last_event_id = int(request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or 0)
+    except ValueError:
+        last_event_id = 0
+
+    def stream():
+        nonlocal last_event_id
+        # Hand the worker thread back now and then; EventSource reconnects with Last-Event-ID
+        deadline = time.time() + SSE_MAX_STREAM_SECONDS
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        while time.time() < deadline:
+            events = job.events_after(last_event_id, timeout=SSE_KEEPALIVE_SECONDS)
+            for event_id, event_type, data in events:
+                last_event_id = event_id
+                yield f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
+            if not events:
+                if not job.active:
+                    yield "event: end\ndata: {}\n\n"
+                    return
+                yield ": keep-alive\n\n"
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route("/api/quota")
+def quota_stats():
+    return jsonify(quota_accountant.stats())
+
+@app.route("/api/match-cache")
+def match_cache_stats():
+    return jsonify(match_cache.stats())
+
+@app.route("/api/circuit-breakers")
+def circuit_breaker_stats():
+    return jsonify({api: breaker.stats() for api, breaker in circuit_breakers.items()})
+
+@app.route("/api/dead-letters/<playlist_id>")
+def dead_letter_list(playlist_id):
+    """Tracks of this user's playlist that failed on the last transfer; transferring again retries them."""
+    spotify_user_id = session.get("spotify_user_id")
+    if not spotify_user_id:
+        return jsonify({"error": "Not logged in"}), 401
+    return jsonify(dead_letters.list(spotify_user_id, playlist_id))
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus scrape endpoint; every worker process reports its own numbers."""
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+def report_startup():
+    elapsed = time.perf_counter() - STARTED_AT
+    startup_seconds.set(round(elapsed, 3))
+    deferred = [name for name in DEFERRED_MODULES if name not in sys.modules]
+    logger.info(f"App ready in {elapsed * 1000:.0f} ms with {len(sys.modules)} modules loaded; "
+                f"not yet imported: {', '.join(deferred) or 'none'}")
+
+report_startup()
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)), debug=True, threaded=True)
\ No newline at end of file
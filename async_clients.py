@@ -0,0 +1,166 @@
+import asyncio
+import json
+import logging
+import os
+import urllib.parse
+import uuid
+from email.parser import BytesParser
+
+import aiohttp
+import httplib2
+from google.auth.transport.requests import Request
+from googleapiclient.discovery import build_from_document
+from googleapiclient.errors import HttpError
+from spotipy.exceptions import SpotifyException
+
+from clients import HTTP_TIMEOUT, SPOTIFY_API_URL, youtube_discovery
+
+logger = logging.getLogger(__name__)
+
+SPOTIFY_DEFAULT_URL = "https://api.spotify.com/v1/"
+# Connections the asyncio engine keeps open across all of its transfers
+ASYNC_HTTP_CONNECTIONS = int(os.getenv("ASYNC_HTTP_CONNECTIONS", 100))
+
+_request_builder = None
+
+
+def youtube_request_builder():
+    """A YouTube service used only to build requests, never to execute them.
+
+    Requests come out with exactly the URL, query and body the threaded engine
+    sends. Only the event loop thread uses it.
+    """
+    global _request_builder
+    if _request_builder is None:
+        _request_builder = build_from_document(youtube_discovery(), http=httplib2.Http())
+    return _request_builder
+
+
+def http_session(connections=ASYNC_HTTP_CONNECTIONS):
+    """A pooled keep-alive aiohttp session; create it on the event loop that will use it."""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=connections),
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+    )
+
+
+def _response(status, headers):
+    """httplib2-style response, which is what HttpError and googleapiclient's parsers expect."""
+    info = {key.lower(): value for key, value in headers.items()}
+    info["status"] = str(status)
+    return httplib2.Response(info)
+
+
+def _serialize(request, headers):
+    # One request of a batch in application/http form, as googleapiclient writes it
+    parsed = urllib.parse.urlsplit(request.uri)
+    target = urllib.parse.urlunsplit(("", "", parsed.path, parsed.query, ""))
+    lines = [f"{request.method} {target} HTTP/1.1"]
+    lines.extend(f"{key}: {value}" for key, value in {**request.headers, **headers, "host": parsed.netloc}.items())
+    if request.body is not None:
+        lines.append(f"content-length: {len(request.body)}")
+    return "\r\n".join(lines) + "\r\n\r\n" + (request.body or "")
+
+
+def _deserialize(payload):
+    # (response, content) of one part of a batch response
+    head, _, content = payload.replace("\r\n", "\n").partition("\n\n")
+    status_line, *header_lines = head.split("\n")
+    headers = {}
+    for line in header_lines:
+        key, _, value = line.partition(":")
+        headers[key.strip()] = value.strip()
+    return _response(int(status_line.split(" ", 2)[1]), headers), content.strip("\n").encode()
+
+
+class AsyncApis:
+    """The Spotify and YouTube calls of one transfer, made over a shared aiohttp session.
+
+    Requests are built, and responses parsed, the way spotipy and googleapiclient
+    do it for the threaded engine, and failures raise the same SpotifyException
+    and HttpError, so both engines retry, charge and record alike. Connection
+    failures are raised as ConnectionError.
+    """
+
+    def __init__(self, session, spotify_token, credentials):
+        self.session = session
+        self.spotify_token = spotify_token
+        self.credentials = credentials
+        self.spotify_url = (SPOTIFY_API_URL or SPOTIFY_DEFAULT_URL).rstrip("/") + "/"
+        self.youtube = youtube_request_builder()
+        discovery = youtube_discovery()
+        self.batch_url = discovery["rootUrl"] + discovery.get("batchPath", "batch")
+        self._refresh_lock = asyncio.Lock()
+
+    async def _request(self, method, url, headers, data=None):
+        try:
+            async with self.session.request(method, url, headers=headers, data=data) as response:
+                return response.status, response.headers, await response.read()
+        except aiohttp.ClientError as e:
+            raise ConnectionError(f"{method} {url} failed: {e}") from e
+
+    async def spotify_get(self, path, params=None):
+        """GET a Spotify Web API path (or full URL, like a page's `next`) and return the JSON body."""
+        url = path if path.startswith("http") else self.spotify_url + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        headers = {"Authorization": f"Bearer {self.spotify_token}", "Content-Type": "application/json"}
+        status, response_headers, body = await self._request("GET", url, headers)
+        if status >= 400:
+            try:
+                error = json.loads(body).get("error", {})
+                message, reason = error.get("message"), error.get("reason")
+            except ValueError:
+                message, reason = body.decode(errors="replace") or None, None
+            raise SpotifyException(status, -1, f"{url}:\n {message}", reason=reason, headers=response_headers)
+        try:
+            return json.loads(body)
+        except ValueError:
+            return None
+
+    async def _youtube_auth(self):
+        if not self.credentials.valid:
+            async with self._refresh_lock:
+                if not self.credentials.valid:
+                    await asyncio.to_thread(self.credentials.refresh, Request())
+        headers = {}
+        self.credentials.apply(headers)
+        return headers
+
+    async def youtube_execute(self, request):
+        """Send a googleapiclient request and return what `request.execute()` would."""
+        headers = {**request.headers, **await self._youtube_auth()}
+        status, response_headers, body = await self._request(request.method, request.uri, headers, request.body)
+        return request.postproc(_response(status, response_headers), body)
+
+    async def youtube_batch(self, requests):
+        """Send `requests` ({request_id: request}) as one batch.
+
+        Returns {request_id: (response, error)}, what BatchHttpRequest hands its
+        callback; raises HttpError if the batch request itself failed.
+        """
+        auth = await self._youtube_auth()
+        base = uuid.uuid4()
+        boundary = f"batch_{uuid.uuid4().hex}"
+        body = "".join(
+            f"--{boundary}\r\nContent-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n"
+            f"Content-ID: <{base}+{request_id}>\r\n\r\n{_serialize(request, auth)}\r\n"
+            for request_id, request in requests.items()
+        ) + f"--{boundary}--"
+        headers = {"Content-Type": f'multipart/mixed; boundary="{boundary}"', **auth}
+        status, response_headers, content = await self._request("POST", self.batch_url, headers, body.encode())
+        if status >= 300:
+            raise HttpError(_response(status, response_headers), content, uri=self.batch_url)
+
+        results = {}
+        content_type = response_headers.get("Content-Type", "")
+        message = BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + content)
+        for part in message.get_payload():
+            request_id = urllib.parse.unquote(part["Content-ID"].strip("<>").rsplit("+", 1)[-1])
+            resp, part_content = _deserialize(part.get_payload())
+            try:
+                results[request_id] = (requests[request_id].postproc(resp, part_content), None)
+            except HttpError as e:
+                results[request_id] = (None, e)
+        return results
+
@@ -0,0 +1,323 @@
+"""Local stand-ins for the Spotify and YouTube endpoints a transfer uses.
+
+Playlists are synthesized from their ID: `bench<tracks>x<tag>` has <tracks>
+tracks whose names are unique to the hex <tag>, so every run starts with a cold match
+cache. Latency, error rate, search misses and the YouTube quota are
+configurable, and every request is counted and timed per stage.
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# YouTube Data API unit costs, as charged by the real service
+COSTS = {"youtube_search": 100, "youtube_insert": 50, "youtube_update": 50, "youtube_playlist_create": 50,
+         "youtube_playlist_items_list": 1, "youtube_videos_list": 1}
+PAGE_SIZE_LIMIT = 100
+SYNTHETIC_QUERY_PATTERN = re.compile(r"^Track \S+ (\d+)\b")
+
+
+def synthetic_track(tag, index):
+    return {
+        "id": f"{tag}{index:06d}",
+        "name": f"Track {tag} {index}",
+        "artists": [{"name": f"Artist {index % 500}"}],
+        "external_ids": {"isrc": f"BENCH{tag[:4].upper()}{index:07d}"},
+        "duration_ms": 180000 + index % 120000,
+    }
+
+
+def parse_playlist_id(playlist_id):
+    """(track count, tag) of a synthetic playlist ID; Spotify IDs are base62, hence no separators but "x"."""
+    size, _, tag = playlist_id[len("bench"):].partition("x")
+    try:
+        return int(size), tag
+    except ValueError:
+        return 0, tag
+
+
+class FakeApiServer:
+    """Spotify and YouTube stand-in served over HTTP on localhost.
+
+    `latency` seconds are added to every request, `error_rate` of requests (and of
+    items inside a batch) fail with a 503, `miss_rate` of searches find nothing,
+    and YouTube answers quotaExceeded once `quota_units` are spent.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, miss_rate=0.0, quota_units=None, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.miss_rate = miss_rate
+        self.quota_units = quota_units
+        self.units_spent = 0
+        self.random = random.Random(seed)
+        self.playlists = {}
+        self.video_durations = {}
+        self.calls = {}
+        self.latencies = {}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-apis", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = {}
+            self.latencies = {}
+
+    def stats(self):
+        with self._lock:
+            return {"calls": dict(self.calls), "latencies": {stage: list(values) for stage, values in self.latencies.items()},
+                    "units_spent": self.units_spent}
+
+    def _record(self, stage, seconds, count=1):
+        with self._lock:
+            self.calls[stage] = self.calls.get(stage, 0) + count
+            self.latencies.setdefault(stage, []).append(seconds)
+
+    def _fails(self):
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+    def _spend(self, stage):
+        """Charge YouTube quota for `stage`; False once it's used up."""
+        with self._lock:
+            cost = COSTS.get(stage, 0)
+            if self.quota_units is not None and self.units_spent + cost > self.quota_units:
+                return False
+            self.units_spent += cost
+            return True
+
+    # Spotify
+
+    def spotify_playlist(self, playlist_id):
+        size, _ = parse_playlist_id(playlist_id)
+        return {"id": playlist_id, "name": f"Bench playlist {playlist_id}", "description": "Synthetic benchmark playlist",
+                "snapshot_id": f"{playlist_id}-snapshot", "tracks": {"total": size}}
+
+    def spotify_tracks(self, playlist_id, offset, limit):
+        size, tag = parse_playlist_id(playlist_id)
+        limit = max(1, min(limit, PAGE_SIZE_LIMIT))
+        end = min(offset + limit, size)
+        next_url = None
+        if end < size:
+            next_url = f"{self.url}/v1/playlists/{playlist_id}/tracks?offset={end}&limit={limit}"
+        return {"items": [{"track": synthetic_track(tag, index)} for index in range(offset, end)],
+                "next": next_url, "total": size}
+
+    # YouTube
+
+    def youtube_search(self, query, max_results):
+        digest = hashlib.sha1(query.encode()).hexdigest()
+        with self._lock:
+            miss = self.random.random() < self.miss_rate
+        if miss:
+            return {"items": []}
+        # Queries for synthetic tracks name their index, which gives the track's duration
+        match = SYNTHETIC_QUERY_PATTERN.search(query)
+        duration_ms = synthetic_track("", int(match.group(1)))["duration_ms"] if match else None
+        items = []
+        for rank in range(max(1, max_results)):
+            video_id = f"{digest[:10]}{rank}"
+            items.append({
+                "id": {"kind": "youtube#video", "videoId": video_id},
+                "snippet": {"title": query if rank == 0 else f"{query} (cover {rank})", "channelTitle": "Bench - Topic"},
+            })
+            if duration_ms is not None:
+                with self._lock:
+                    self.video_durations[video_id] = duration_ms + rank * 20000
+        return {"items": items}
+
+    def youtube_videos(self, video_ids):
+        items = []
+        with self._lock:
+            for video_id in video_ids:
+                seconds = self.video_durations.get(video_id, 200000) // 1000
+                items.append({"id": video_id, "contentDetails": {"duration": f"PT{seconds // 60}M{seconds % 60}S"}})
+        return {"items": items}
+
+    def youtube_create_playlist(self, body):
+        with self._lock:
+            playlist_id = f"PL{len(self.playlists):08d}"
+            self.playlists[playlist_id] = []
+        return {"id": playlist_id, "snippet": body.get("snippet", {})}
+
+    def youtube_insert(self, body):
+        snippet = body["snippet"]
+        with self._lock:
+            items = self.playlists.setdefault(snippet["playlistId"], [])
+            position = min(snippet.get("position", len(items)), len(items))
+            item = {"id": f"{snippet['playlistId']}-{len(items)}-{snippet['resourceId']['videoId']}",
+                    "snippet": {"playlistId": snippet["playlistId"], "position": position,
+                                "resourceId": snippet["resourceId"]}}
+            items.insert(position, item)
+        return item
+
+    def youtube_update(self, body):
+        snippet = body["snippet"]
+        with self._lock:
+            items = self.playlists.setdefault(snippet["playlistId"], [])
+            item = next((item for item in items if item["id"] == body["id"]), None)
+            if item is None:
+                return None
+            items.remove(item)
+            items.insert(min(snippet["position"], len(items)), item)
+            item["snippet"]["position"] = snippet["position"]
+        return item
+
+    def youtube_list_items(self, playlist_id, page_token, max_results):
+        with self._lock:
+            items = list(self.playlists.get(playlist_id, ()))
+        start = int(page_token or 0)
+        end = start + max(1, min(max_results, 50))
+        response = {"items": [{"snippet": {"resourceId": item["snippet"]["resourceId"]}} for item in items[start:end]]}
+        if end < len(items):
+            response["nextPageToken"] = str(end)
+        return response
+
+    def handle_youtube(self, method, path, query, body):
+        """Return (stage, status, payload) for one YouTube request."""
+        resource = path.rsplit("/", 1)[-1]
+        if resource == "search":
+            stage = "youtube_search"
+        elif resource == "videos" and method == "GET":
+            stage = "youtube_videos_list"
+        elif resource == "playlists" and method == "POST":
+            stage = "youtube_playlist_create"
+        elif resource == "playlistItems" and method == "POST":
+            stage = "youtube_insert"
+        elif resource == "playlistItems" and method == "PUT":
+            stage = "youtube_update"
+        elif resource == "playlistItems" and method == "GET":
+            stage = "youtube_playlist_items_list"
+        else:
+            return "youtube_unknown", 404, {"error": {"code": 404, "message": f"No fake for {method} {path}"}}
+        if self._fails():
+            return stage, 503, {"error": {"code": 503, "message": "Backend Error", "errors": [{"reason": "backendError"}]}}
+        if not self._spend(stage):
+            return stage, 403, {"error": {"code": 403, "message": "quotaExceeded",
+                                          "errors": [{"reason": "quotaExceeded", "domain": "youtube.quota"}]}}
+        if stage == "youtube_search":
+            return stage, 200, self.youtube_search(query.get("q", ""), int(query.get("maxResults", 5)))
+        if stage == "youtube_videos_list":
+            return stage, 200, self.youtube_videos(query.get("id", "").split(","))
+        if stage == "youtube_playlist_create":
+            return stage, 200, self.youtube_create_playlist(body)
+        if stage == "youtube_insert":
+            return stage, 200, self.youtube_insert(body)
+        if stage == "youtube_update":
+            item = self.youtube_update(body)
+            return (stage, 200, item) if item else (stage, 404, {"error": {"code": 404, "message": "playlistItemNotFound"}})
+        playlist_id = query.get("playlistId", "")
+        if playlist_id not in self.playlists:
+            return stage, 404, {"error": {"code": 404, "message": "playlistNotFound"}}
+        return stage, 200, self.youtube_list_items(playlist_id, query.get("pageToken"), int(query.get("maxResults", 5)))
+
+    def handle_batch(self, content_type, body):
+        """Answer a multipart/mixed batch the way googleapiclient expects; returns the response body and boundary."""
+        message = BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        boundary = f"batch_{random.getrandbits(64):016x}"
+        parts = []
+        for part in message.get_payload():
+            request_text = part.get_payload().replace("\r\n", "\n")
+            request_line, rest = request_text.split("\n", 1)
+            method, target, _ = request_line.split(" ", 2)
+            part_body = rest.split("\n\n", 1)[1] if "\n\n" in rest else ""
+            parsed = urllib.parse.urlparse(target)
+            query = dict(urllib.parse.parse_qsl(parsed.query))
+            stage, status, payload = self.handle_youtube(method, parsed.path, query, json.loads(part_body or "{}"))
+            self._record(f"{stage}_batched", 0.0)
+            content_id = part["Content-ID"][1:-1]
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: application/json\r\n\r\n"
+                f"{json.dumps(payload)}\r\n"
+            )
+        return ("".join(parts) + f"--{boundary}--\r\n").encode(), boundary
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, payload, content_type="application/json"):
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _handle(self, method):
+                started = time.perf_counter()
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                parsed = urllib.parse.urlparse(self.path)
+                query = dict(urllib.parse.parse_qsl(parsed.query))
+                if server.latency:
+                    time.sleep(server.latency)
+                if parsed.path.startswith("/v1/"):
+                    stage, status, payload = self._spotify(parsed.path, query)
+                    self._send(status, payload)
+                elif parsed.path == "/batch":
+                    stage = "youtube_batch"
+                    if server._fails():
+                        status, payload = 503, {"error": {"code": 503, "message": "Backend Error"}}
+                        self._send(status, payload)
+                    else:
+                        data, boundary = server.handle_batch(self.headers.get("Content-Type", ""), body)
+                        self._send(200, data, content_type=f'multipart/mixed; boundary="{boundary}"')
+                else:
+                    stage, status, payload = server.handle_youtube(method, parsed.path, query, json.loads(body or b"{}"))
+                    self._send(status, payload)
+                server._record(stage, time.perf_counter() - started)
+
+            def _spotify(self, path, query):
+                segments = path.strip("/").split("/")
+                if server._fails():
+                    return "spotify_error", 503, {"error": {"status": 503, "message": "Service unavailable"}}
+                if segments[1:2] == ["me"]:
+                    if segments[2:3] == ["playlists"]:
+                        return "spotify_user_playlists", 200, {"items": [], "next": None, "total": 0}
+                    return "spotify_user", 200, {"id": "bench-user", "display_name": "Bench User"}
+                if segments[1:2] == ["playlists"] and len(segments) == 3:
+                    return "spotify_playlist", 200, server.spotify_playlist(segments[2])
+                if segments[1:2] == ["playlists"] and segments[3:4] in (["tracks"], ["items"]):
+                    offset = int(query.get("offset", 0))
+                    limit = int(query.get("limit", PAGE_SIZE_LIMIT))
+                    return "spotify_tracks", 200, server.spotify_tracks(segments[2], offset, limit)
+                return "spotify_unknown", 404, {"error": {"status": 404, "message": f"No fake for {path}"}}
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+        return Handler
@@ -0,0 +1,209 @@
+"""Transfer throughput benchmark against the local Spotify/YouTube stand-ins.
+
+Drives the real Flask routes and transfer engine over synthetic playlists and
+writes a JSON report that later runs can be compared against:
+
+    python -m bench.run --sizes 100 1000 10000 --latency-ms 20
+    python -m bench.run --sizes 1000 --baseline bench/results/<earlier>.json
+
+Per-stage latencies of API calls are measured by the stand-in server; route
+latencies are measured by the client.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from bench.fake_apis import FakeApiServer  # noqa: E402
+
+TERMINAL_STATES = ("completed", "failed")
+# States a job can sit in for hours; the benchmark reports them instead of waiting
+BLOCKED_STATES = ("deferred",)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(latencies):
+    """count/p50/p99/max in milliseconds for each stage's list of seconds."""
+    return {
+        stage: {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+            "max_ms": round(max(values) * 1000, 2),
+        }
+        for stage, values in sorted(latencies.items()) if values
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def configure_environment(args, server):
+    """Point the app at the stand-ins and keep its state in a scratch directory; must run before importing it."""
+    os.environ.setdefault("FLASK_SECRET_KEY", uuid.uuid4().hex)
+    os.environ["SPOTIFY_API_URL"] = f"{server.url}/v1/"
+    os.environ["YOUTUBE_API_URL"] = server.url
+    os.environ.setdefault("YOUTUBE_DAILY_QUOTA", str(args.app_quota))
+    os.environ.setdefault("SEARCH_RATE", str(args.search_rate))
+    os.environ.setdefault("SEARCH_BURST", str(args.search_rate))
+    os.environ.setdefault("RETRY_BASE_DELAY", "0.05")
+    os.environ.setdefault("TRANSFER_WORKERS", str(max(args.jobs, 2)))
+    os.environ["TRANSFER_ENGINE"] = args.engine
+    workdir = tempfile.mkdtemp(prefix="transfer-bench-")
+    os.chdir(workdir)
+    return workdir
+
+
+def new_client(flask_app, session_id):
+    from token_store import token_store
+
+    client = flask_app.test_client()
+    with client.session_transaction() as session:
+        session["session_id"] = session_id
+        # One Spotify account per client, as concurrent transfers would usually come from different users
+        session["spotify_user_id"] = f"bench-user-{session_id}"
+    token_store.save(session_id, "spotify", {"access_token": "bench-spotify-token", "refresh_token": "bench-refresh",
+                                             "expires_at": int(time.time()) + 24 * 3600})
+    token_store.save(session_id, "google", {"token": f"bench-youtube-token-{session_id}", "refresh_token": None,
+                                            "token_uri": None, "client_id": None, "client_secret": None,
+                                            "scopes": ["https://www.googleapis.com/auth/youtube"]})
+    return client
+
+
+def run_size(flask_app, server, size, jobs, timeout):
+    """Transfer `jobs` synthetic playlists of `size` tracks at once through the web routes."""
+    server.reset_stats()
+    route_latencies = {"route_transfer": [], "route_job_status": []}
+    started = time.perf_counter()
+    running = []
+    for _ in range(jobs):
+        session_id = str(uuid.uuid4())
+        client = new_client(flask_app, session_id)
+        tag = uuid.uuid4().hex[:8]
+        request_started = time.perf_counter()
+        response = client.get(f"/transfer/bench{size}x{tag}")
+        route_latencies["route_transfer"].append(time.perf_counter() - request_started)
+        if response.status_code != 302 or "/transfer-status/" not in response.location:
+            raise RuntimeError(f"Transfer route returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+        running.append((client, response.location.rsplit("/", 1)[-1]))
+
+    results = {}
+    deadline = time.time() + timeout
+    while running and time.time() < deadline:
+        for client, job_id in list(running):
+            request_started = time.perf_counter()
+            job = client.get(f"/api/jobs/{job_id}").get_json()
+            route_latencies["route_job_status"].append(time.perf_counter() - request_started)
+            if job["state"] in TERMINAL_STATES + BLOCKED_STATES:
+                results[job_id] = job
+                running.remove((client, job_id))
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    for client, job_id in running:
+        results[job_id] = client.get(f"/api/jobs/{job_id}").get_json()
+
+    stats = server.stats()
+    tracks = sum(job["processed"] for job in results.values())
+    http_requests = sum(count for stage, count in stats["calls"].items() if not stage.endswith("_batched"))
+    operations = sum(count for stage, count in stats["calls"].items() if stage != "youtube_batch")
+    stages = summarize(stats["latencies"])
+    stages.update(summarize(route_latencies))
+    return {
+        "size": size,
+        "jobs": jobs,
+        "tracks": tracks,
+        "transferred": sum(job["successful_transfers"] for job in results.values()),
+        "states": sorted(job["state"] for job in results.values()),
+        "timed_out": bool(running),
+        "seconds": round(elapsed, 3),
+        "tracks_per_second": round(tracks / elapsed, 2) if elapsed else None,
+        "http_requests": http_requests,
+        "http_requests_per_track": round(http_requests / tracks, 3) if tracks else None,
+        "api_operations_per_track": round(operations / tracks, 3) if tracks else None,
+        "calls": stats["calls"],
+        "stages": stages,
+    }
+
+
+def compare(report, baseline_path):
+    with open(baseline_path, "r") as f:
+        baseline = {(run["size"], run["jobs"]): run for run in json.load(f)["runs"]}
+    for run in report["runs"]:
+        before = baseline.get((run["size"], run["jobs"]))
+        if not before or not before["tracks_per_second"] or not run["tracks_per_second"]:
+            continue
+        change = 100.0 * (run["tracks_per_second"] / before["tracks_per_second"] - 1)
+        print(f"  {run['size']:>6} tracks x{run['jobs']}: {before['tracks_per_second']:>8.1f} -> "
+              f"{run['tracks_per_second']:>8.1f} tracks/s ({change:+.1f}%)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="playlist sizes to transfer")
+    parser.add_argument("--jobs", type=int, default=1, help="playlists transferred concurrently per size")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="latency added to every API request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of API requests failing with 503")
+    parser.add_argument("--miss-rate", type=float, default=0.05, help="fraction of searches finding nothing")
+    parser.add_argument("--quota-units", type=int, default=None, help="YouTube units the stand-in allows in total")
+    parser.add_argument("--app-quota", type=int, default=10 ** 9, help="YOUTUBE_DAILY_QUOTA the app budgets with")
+    parser.add_argument("--search-rate", type=float, default=1000.0, help="SEARCH_RATE for the app's rate limiter")
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads", help="TRANSFER_ENGINE to run")
+    parser.add_argument("--timeout", type=float, default=3600.0, help="seconds to wait for each size")
+    parser.add_argument("--seed", type=int, default=0, help="seed for injected errors and misses")
+    parser.add_argument("--output", help="where to write the JSON report (default bench/results/<timestamp>.json)")
+    parser.add_argument("--baseline", help="earlier JSON report to compare tracks/sec against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = FakeApiServer(latency=args.latency_ms / 1000, error_rate=args.error_rate, miss_rate=args.miss_rate,
+                           quota_units=args.quota_units, seed=args.seed).start()
+    configure_environment(args, server)
+    from app import app as flask_app
+
+    timestamp = datetime.now(timezone.utc)
+    report = {"timestamp": timestamp.isoformat(), "git_commit": git_commit(), "config": vars(args), "runs": []}
+    try:
+        for size in args.sizes:
+            run = run_size(flask_app, server, size, args.jobs, args.timeout)
+            report["runs"].append(run)
+            print(f"{size:>6} tracks x{args.jobs}: {run['tracks_per_second']} tracks/s, "
+                  f"{run['http_requests_per_track']} requests/track, states {run['states']}")
+    finally:
+        server.stop()
+
+    output = args.output or os.path.join(REPO_ROOT, "bench", "results", f"{timestamp:%Y%m%dT%H%M%SZ}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}")
+    if args.baseline:
+        compare(report, args.baseline)
+    if any(run["timed_out"] or set(run["states"]) & set(BLOCKED_STATES) for run in report["runs"]):
+        # Deferred jobs wait on timers until the quota resets; don't wait for them to exit
+        sys.stdout.flush()
+        os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from metrics import timed
+
+# spotipy, googleapiclient and the Google auth libraries take a good part of a
+# second to import, so they're imported when first used rather than at startup
+
+logger = logging.getLogger(__name__)
+
+YOUTUBE_CLIENT_TTL = int(os.getenv("YOUTUBE_CLIENT_TTL", 1800))
+HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", 30))
+# Send API calls somewhere else than the real services, e.g. the local stand-ins in bench/
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL")
+YOUTUBE_API_URL = os.getenv("YOUTUBE_API_URL")
+
+_discovery_lock = threading.Lock()
+_youtube_discovery = None
+
+_local = threading.local()
+
+_clients_lock = threading.Lock()
+_youtube_clients = {}
+
+_spotify_session_lock = threading.Lock()
+_spotify_session = None
+
+GOOGLE_CLIENT_SECRETS_FILE = "client_secrets.json"
+YOUTUBE_SCOPES = ["https://www.googleapis.com/auth/youtube"]
+_google_client_config = None
+
+
+def spotify_session():
+    """The pooled keep-alive session every Spotify call in the process shares."""
+    global _spotify_session
+    if _spotify_session is None:
+        with _spotify_session_lock:
+            if _spotify_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+                _spotify_session = session
+    return _spotify_session
+
+
+def youtube_discovery():
+    """The YouTube v3 discovery document, read from the copy bundled with googleapiclient once per process.
+
+    build_from_document only adds the standard query parameters to it, so one
+    parsed copy can be shared by every client.
+    """
+    global _youtube_discovery
+    if _youtube_discovery is None:
+        with _discovery_lock:
+            if _youtube_discovery is None:
+                from googleapiclient.discovery_cache import get_static_doc
+                discovery = json.loads(get_static_doc("youtube", "v3"))
+                if YOUTUBE_API_URL:
+                    root = YOUTUBE_API_URL.rstrip("/") + "/"
+                    discovery.update(rootUrl=root, baseUrl=root, mtlsRootUrl=root)
+                _youtube_discovery = discovery
+    return _youtube_discovery
+
+
+def thread_http():
+    """This thread's httplib2 connection pool; httplib2 objects can't be shared across threads."""
+    http = getattr(_local, "http", None)
+    if http is None:
+        import httplib2
+        http = httplib2.Http(timeout=HTTP_TIMEOUT)
+        _local.http = http
+    return http
+
+
+def authorized_http(credentials):
+    """Authorized view of this thread's keep-alive connections for `credentials`."""
+    from google_auth_httplib2 import AuthorizedHttp
+    return AuthorizedHttp(credentials, http=thread_http())
+
+
+def _credentials_key(credentials):
+    return credentials.refresh_token or credentials.token
+
+
+def youtube_client(credentials):
+    """A YouTube service for `credentials`, reused by the calling thread until it expires."""
+    key = (_credentials_key(credentials), threading.get_ident())
+    now = time.time()
+    with _clients_lock:
+        entry = _youtube_clients.get(key)
+        if entry and entry[1] > now:
+            return entry[0]
+        # Drop expired clients while we're here
+        for stale in [k for k, (_, expires_at) in _youtube_clients.items() if expires_at <= now]:
+            del _youtube_clients[stale]
+    from googleapiclient.discovery import build_from_document
+    youtube = build_from_document(youtube_discovery(), http=authorized_http(credentials))
+    with _clients_lock:
+        _youtube_clients[key] = (youtube, now + YOUTUBE_CLIENT_TTL)
+    return youtube
+
+
+def spotify_client(access_token):
+    """A Spotify client on the shared connection pool."""
+    import spotipy
+    sp = spotipy.Spotify(auth=access_token, requests_session=spotify_session())
+    if SPOTIFY_API_URL:
+        sp.prefix = SPOTIFY_API_URL.rstrip("/") + "/"
+    return sp
+
+
+def get_spotify_oauth(session_id):
+    """Spotify OAuth for one session; tokens live in the token store, so spotipy's own cache stays in memory."""
+    from spotipy.cache_handler import MemoryCacheHandler
+    from spotipy.oauth2 import SpotifyOAuth
+    return SpotifyOAuth(
+        client_id=os.getenv("SPOTIFY_CLIENT_ID"),
+        client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
+        redirect_uri=os.getenv("SPOTIFY_REDIRECT_URI"),
+        scope="playlist-read-private playlist-read-collaborative",
+        cache_handler=MemoryCacheHandler(),
+        state=session_id,  # Use session_id as state for uniqueness
+        requests_session=spotify_session()
+    )
+
+
+def fresh_token_info(session_id, token_info):
+    """`token_info`, refreshed first if the access token expires within a minute."""
+    if datetime.now().timestamp() < token_info.get("expires_at", 0) - 60:
+        return token_info
+    with timed("token_refresh"):
+        return get_spotify_oauth(session_id).refresh_access_token(token_info["refresh_token"])
+
+
+def load_google_client_config(path=GOOGLE_CLIENT_SECRETS_FILE):
+    """The Google OAuth client config from `path` or GOOGLE_CLIENT_SECRETS, parsed once per process.
+
+    Raises ValueError if neither is there or the JSON is invalid.
+    """
+    global _google_client_config
+    if _google_client_config is None:
+        try:
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    config = json.load(f)
+            elif os.getenv("GOOGLE_CLIENT_SECRETS"):
+                config = json.loads(os.getenv("GOOGLE_CLIENT_SECRETS"))
+            else:
+                raise ValueError("Client secrets file not found.")
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid client secrets format: {e}") from e
+        client = config.get("web") or config.get("installed") or {}
+        logger.info(f"Loaded Google OAuth client {client.get('client_id')}")
+        _google_client_config = config
+    return _google_client_config
+
+
+def google_redirect_uri():
+    if os.getenv("RENDER"):
+        return "https://spotify-to-youtube-web.onrender.com/google-callback"
+    return "http://127.0.0.1:5000/google-callback"
+
+
+def google_oauth_flow(state=None, redirect_uri=None):
+    """A YouTube OAuth flow for the app's Google client, built from the in-memory client config."""
+    from google_auth_oauthlib.flow import Flow
+    return Flow.from_client_config(load_google_client_config(), scopes=YOUTUBE_SCOPES, state=state,
+                                   redirect_uri=redirect_uri or google_redirect_uri())
@@ -0,0 +1,4 @@
+import os
+
+# Keep the stores the modules create on import in this process rather than in data/state.db
+os.environ.setdefault("STATE_BACKEND", "memory")
@@ -0,0 +1,45 @@
+import logging
+import time
+
+from state import state_backend
+
+logger = logging.getLogger(__name__)
+
+
+class DeadLetterStore:
+    """Tracks that still failed to transfer after every retry, per Spotify user and playlist.
+
+    A playlist with dead letters is synced again on its next transfer even if its
+    snapshot hasn't changed, which retries them.
+    """
+
+    def __init__(self, backend=state_backend, ttl=30 * 24 * 3600, max_entries=10000):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def add(self, spotify_user_id, playlist_id, index, track, query, error):
+        try:
+            self.backend.rpush(
+                f"dead_letters:{spotify_user_id}:{playlist_id}",
+                {
+                    "index": index,
+                    "track_id": track.id,
+                    "query": query,
+                    "error": str(error),
+                    "failed_at": time.time(),
+                },
+                max_len=self.max_entries,
+                ttl=self.ttl
+            )
+        except Exception as e:
+            logger.error(f"Error recording failed track {query}: {e}")
+
+    def list(self, spotify_user_id, playlist_id):
+        return self.backend.lrange(f"dead_letters:{spotify_user_id}:{playlist_id}")
+
+    def clear(self, spotify_user_id, playlist_id):
+        self.backend.delete(f"dead_letters:{spotify_user_id}:{playlist_id}")
+
+
+dead_letters = DeadLetterStore()
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from clients import fresh_token_info, spotify_client, youtube_client
+from transfer import run_transfer, run_transfer_async
+
+logger = logging.getLogger(__name__)
+
+TRANSFER_WORKERS = int(os.getenv("TRANSFER_WORKERS", 2))
+# Transfers the asyncio engine runs at once, in total and per Spotify account
+ASYNC_MAX_TRANSFERS = int(os.getenv("ASYNC_MAX_TRANSFERS", 50))
+ASYNC_USER_TRANSFERS = int(os.getenv("ASYNC_USER_TRANSFERS", 2))
+
+
+class TransferRequest:
+    """What a queued job needs to run its transfer, kept so a deferred job can be started again."""
+
+    __slots__ = ("token_info", "google_credentials", "spotify_user_id", "fresh")
+
+    def __init__(self, token_info, google_credentials, spotify_user_id, fresh=False):
+        self.token_info = token_info
+        self.google_credentials = google_credentials
+        self.spotify_user_id = spotify_user_id
+        self.fresh = fresh
+
+
+class TransferEngine:
+    """Executes transfer jobs for the JobManager.
+
+    `start` runs the transfer in the background, calling `job.start()` once it
+    actually begins, and returns a concurrent.futures.Future of its outcome;
+    deferring, failing and finishing the job is left to the JobManager.
+    """
+
+    name = None
+
+    def start(self, job, request):
+        raise NotImplementedError
+
+    def _refresh_token(self, job, request):
+        # Jobs can sit deferred until the quota resets, so the session's token may be stale by now
+        request.token_info = fresh_token_info(job.session_id, request.token_info)
+        return request.token_info["access_token"]
+
+
+class ThreadEngine(TransferEngine):
+    """Runs each transfer on a thread of a bounded pool, which it holds for the whole transfer."""
+
+    name = "threads"
+
+    def __init__(self, max_workers=TRANSFER_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="transfer")
+
+    def start(self, job, request):
+        return self._executor.submit(self._run, job, request)
+
+    def _run(self, job, request):
+        from google.oauth2.credentials import Credentials
+        job.start()
+        sp = spotify_client(self._refresh_token(job, request))
+        credentials = Credentials(**request.google_credentials)
+        youtube = youtube_client(credentials)
+        run_transfer(job, sp, youtube, request.spotify_user_id, credentials=credentials, fresh=request.fresh)
+
+
+class AsyncioEngine(TransferEngine):
+    """Runs every transfer as a task on one event loop, so a process can drive many at once.
+
+    All transfers share one pooled HTTP session. At most `max_transfers` run at a
+    time and at most `per_user` for any one Spotify account, so a user queuing
+    many playlists can't hold everyone else up; waiting transfers start in the
+    order they were queued. Needs the `aiohttp` package.
+    """
+
+    name = "asyncio"
+
+    def __init__(self, max_transfers=ASYNC_MAX_TRANSFERS, per_user=ASYNC_USER_TRANSFERS):
+        import async_clients
+        self._clients = async_clients
+        self.max_transfers = max_transfers
+        self.per_user = per_user
+        self.loop = asyncio.new_event_loop()
+        # Created on the loop by the first transfer
+        self._session = None
+        self._slots = None
+        # Spotify user ID -> [semaphore, transfers holding or waiting for it]
+        self._user_slots = {}
+        thread = threading.Thread(target=self.loop.run_forever, name="transfer-loop", daemon=True)
+        thread.start()
+
+    def start(self, job, request):
+        return asyncio.run_coroutine_threadsafe(self._run(job, request), self.loop)
+
+    async def _run(self, job, request):
+        from google.oauth2.credentials import Credentials
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_transfers)
+            self._session = self._clients.http_session()
+        user_slots = self._user_slots.setdefault(request.spotify_user_id, [asyncio.Semaphore(self.per_user), 0])
+        user_slots[1] += 1
+        try:
+            # Take the user's slot first so their queued transfers don't sit on global slots
+            async with user_slots[0], self._slots:
+                await asyncio.to_thread(job.start)
+                access_token = await asyncio.to_thread(self._refresh_token, job, request)
+                apis = self._clients.AsyncApis(self._session, access_token, Credentials(**request.google_credentials))
+                await run_transfer_async(job, apis, request.spotify_user_id, fresh=request.fresh)
+        finally:
+            user_slots[1] -= 1
+            if not user_slots[1]:
+                del self._user_slots[request.spotify_user_id]
+
+
+def create_engine(name):
+    """Engine for a TRANSFER_ENGINE value: "threads" or "asyncio"."""
+    if name == "threads":
+        return ThreadEngine()
+    if name == "asyncio":
+        return AsyncioEngine()
+    raise ValueError(f"Unknown TRANSFER_ENGINE: {name}")
@@ -0,0 +1,390 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+
+from engines import create_engine
+from metrics import jobs_finished, registry
+from quota import QuotaDeferred
+from retry import API_NAMES, CircuitOpen
+from state import state_backend
+
+logger = logging.getLogger(__name__)
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DEFERRED = "deferred"
+COMPLETED = "completed"
+FAILED = "failed"
+ACTIVE_STATES = (QUEUED, RUNNING, DEFERRED)
+
+# Events kept per job for clients reconnecting to the event stream
+MAX_JOB_EVENTS = int(os.getenv("MAX_JOB_EVENTS", 20000))
+
+# Seconds a worker's claim on a job lasts without being renewed
+JOB_CLAIM_TTL = 120
+# How often a worker following another worker's job checks its event log
+REMOTE_POLL_SECONDS = 0.5
+
+
+class TransferJob:
+    """A single playlist transfer tracked by the job manager."""
+
+    def __init__(self, session_id, playlist_id):
+        self.id = str(uuid.uuid4())
+        self.session_id = session_id
+        self.playlist_id = playlist_id
+        self.playlist_name = None
+        self.youtube_playlist_id = None
+        self.state = QUEUED
+        self.message = "Waiting for a free worker..."
+        self.total_tracks = 0
+        self.processed = 0
+        self.successful_transfers = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.quota_estimate = None
+        self.quota_units = 0
+        self.resume_at = None
+        self.events = deque(maxlen=MAX_JOB_EVENTS)
+        self._next_event_id = 1
+        # Called with new events, outside the lock, so other workers can follow the job
+        self.listener = None
+        self._outbox = []
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def _emit(self, event_type, data):
+        # Caller holds self._lock
+        data.update(processed=self.processed, total_tracks=self.total_tracks,
+                    successful_transfers=self.successful_transfers)
+        event = (self._next_event_id, event_type, data)
+        self.events.append(event)
+        if self.listener is not None:
+            self._outbox.append(event)
+        self._next_event_id += 1
+        self._changed.notify_all()
+
+    def _flush(self):
+        with self._lock:
+            events, self._outbox = self._outbox, []
+        if events:
+            self.listener(self, events)
+
+    def emit(self, event_type, **data):
+        """Publish a per-track or pipeline event to the job's event stream."""
+        with self._lock:
+            self._emit(event_type, data)
+        self._flush()
+
+    def _emit_state(self):
+        self._emit("state", {"state": self.state, "message": self.message, "resume_at": self.resume_at})
+
+    def events_after(self, last_event_id, timeout):
+        """Events newer than `last_event_id`, waiting up to `timeout` seconds for one to arrive."""
+        with self._lock:
+            if not self._has_events_after(last_event_id) and self.active:
+                self._changed.wait(timeout)
+            return [event for event in self.events if event[0] > last_event_id]
+
+    def _has_events_after(self, last_event_id):
+        return bool(self.events) and self.events[-1][0] > last_event_id
+
+    def start(self):
+        with self._lock:
+            # A parked job starts again from its saved resume point, so count from there
+            self.processed = 0
+            self.successful_transfers = 0
+            self.state = RUNNING
+            self.started_at = time.time()
+            self.message = "Transfer in progress..."
+            self._emit_state()
+        self._flush()
+
+    def defer(self, resume_at, reason=None):
+        """The job was not admitted, or was parked mid-transfer, and will be queued again at `resume_at`."""
+        with self._lock:
+            self.state = DEFERRED
+            self.resume_at = resume_at
+            if reason:
+                self.message = f"{reason}, resuming after {datetime.fromtimestamp(resume_at):%H:%M:%S}"
+            else:
+                verb = "continuing" if self.processed else "starting"
+                self.message = f"Not enough YouTube quota left today, {verb} after {datetime.fromtimestamp(resume_at):%Y-%m-%d %H:%M}"
+            self._emit("api_wait" if reason else "quota_wait", {"resume_at": resume_at})
+            self._emit_state()
+        self._flush()
+
+    def add_quota_units(self, units):
+        with self._lock:
+            self.quota_units += units
+
+    def set_total(self, total_tracks):
+        with self._lock:
+            self.total_tracks = total_tracks
+
+    def advance(self, succeeded):
+        """Record one processed track."""
+        with self._lock:
+            self.processed += 1
+            if succeeded:
+                self.successful_transfers += 1
+
+    def finish(self, message):
+        with self._lock:
+            self.state = COMPLETED
+            self.finished_at = time.time()
+            self.message = message
+            self._emit_state()
+        self._flush()
+
+    def fail(self, error):
+        with self._lock:
+            self.state = FAILED
+            self.finished_at = time.time()
+            self.error = str(error)
+            self.message = f"Transfer failed: {error}"
+            self._emit_state()
+        self._flush()
+
+    @property
+    def active(self):
+        return self.state in ACTIVE_STATES
+
+    def to_dict(self):
+        """Snapshot of the job for the status page and polling endpoint."""
+        with self._lock:
+            now = self.finished_at or time.time()
+            elapsed = now - self.started_at if self.started_at else 0.0
+            throughput = self.processed / elapsed if elapsed > 0 else 0.0
+            remaining = max(self.total_tracks - self.processed, 0)
+            eta = remaining / throughput if throughput > 0 and self.state == RUNNING else None
+            if self.resume_at:
+                eta = max(self.resume_at - time.time(), 0) + (remaining / throughput if throughput > 0 else 0)
+            percent = 100.0 * self.processed / self.total_tracks if self.total_tracks else 0.0
+            if self.state == COMPLETED:
+                percent = 100.0
+            return {
+                "id": self.id,
+                "playlist_id": self.playlist_id,
+                "playlist_name": self.playlist_name,
+                "youtube_playlist_id": self.youtube_playlist_id,
+                "state": self.state,
+                "message": self.message,
+                "error": self.error,
+                "total_tracks": self.total_tracks,
+                "processed": self.processed,
+                "successful_transfers": self.successful_transfers,
+                "percent": round(percent, 1),
+                "elapsed_seconds": round(elapsed, 1),
+                "tracks_per_second": round(throughput, 2),
+                "eta_seconds": round(eta, 1) if eta is not None else None,
+                "quota_estimate": self.quota_estimate,
+                "quota_units": self.quota_units,
+                "resume_at": self.resume_at,
+            }
+
+
+class RemoteJob:
+    """Read-only view of a job running in another worker or instance, from its shared snapshot."""
+
+    def __init__(self, backend, snapshot):
+        self._backend = backend
+        self._snapshot = snapshot
+        self.id = snapshot["job"]["id"]
+        self.session_id = snapshot["session_id"]
+        self.playlist_id = snapshot["job"]["playlist_id"]
+        # How far into the shared event log this view has read, and the last event ID found there
+        self._events_read = 0
+        self._last_read_id = 0
+
+    @property
+    def state(self):
+        return self._snapshot["job"]["state"]
+
+    @property
+    def active(self):
+        return self.state in ACTIVE_STATES
+
+    def to_dict(self):
+        return dict(self._snapshot["job"])
+
+    def events_after(self, last_event_id, timeout):
+        """Events newer than `last_event_id`, polling the shared event log for up to `timeout` seconds."""
+        deadline = time.time() + timeout
+        while True:
+            events = sorted(tuple(event) for event in self._read_events() if event[0] > last_event_id)
+            snapshot = self._backend.get(f"job:{self.id}")
+            if snapshot:
+                self._snapshot = snapshot
+            if events or not self.active or time.time() >= deadline:
+                return events
+            time.sleep(REMOTE_POLL_SECONDS)
+
+    def _read_events(self):
+        """Events appended to the shared event log since the last read."""
+        key = f"job_events:{self.id}"
+        start = self._events_read
+        while True:
+            # Read again from the last event seen, to check it's still in the same place
+            events = self._backend.lrange(key, max(start - 1, 0))
+            if not start:
+                break
+            if events and events[0][0] == self._last_read_id:
+                events = events[1:]
+                break
+            # Trimming the log at MAX_JOB_EVENTS moved everything down; event IDs are consecutive,
+            # so the ID now in that place tells by how many places
+            moved = events[0][0] - self._last_read_id if events else start
+            start = max(start - max(moved, 1), 0)
+        if events:
+            self._events_read = start + len(events)
+            self._last_read_id = events[-1][0]
+        return events
+
+
+class JobManager:
+    """Runs transfer jobs on a transfer engine outside the request thread.
+
+    With a shared state backend, each job's snapshot and events are published to
+    it so any worker can report on the job, and a short-lived claim per session
+    and playlist, renewed while the job is active, keeps two workers from running
+    the same transfer.
+    """
+
+    def __init__(self, engine, retention_seconds=3600, backend=state_backend):
+        self.engine = engine
+        self.retention_seconds = retention_seconds
+        self.backend = backend
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._snapshot_times = {}
+        if backend.shared:
+            heartbeat = threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)
+            heartbeat.start()
+
+    def submit(self, job, request):
+        """Queue the transfer described by the TransferRequest `request` and return the job immediately.
+
+        If another worker already runs this session's transfer of the playlist,
+        that job is returned instead and nothing is queued.
+        """
+        if self.backend.shared:
+            claim_key = f"active_job:{job.session_id}:{job.playlist_id}"
+            if not self.backend.add(claim_key, job.id, ttl=JOB_CLAIM_TTL):
+                existing = self.get(self.backend.get(claim_key) or "")
+                if existing and existing.active:
+                    return existing
+                self.backend.set(claim_key, job.id, ttl=JOB_CLAIM_TTL)
+            job.listener = self._publish
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._publish(job, [])
+        self._start(job, request)
+        logger.info(f"Queued transfer job {job.id} for playlist {job.playlist_id}")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.backend.shared:
+            snapshot = self.backend.get(f"job:{job_id}")
+            if snapshot:
+                job = RemoteJob(self.backend, snapshot)
+        return job
+
+    def find_active(self, session_id, playlist_id):
+        """Return a queued or running job for the same session and playlist, if any."""
+        with self._lock:
+            for job in self._jobs.values():
+                if job.session_id == session_id and job.playlist_id == playlist_id and job.active:
+                    return job
+        if self.backend.shared:
+            job_id = self.backend.get(f"active_job:{session_id}:{playlist_id}")
+            job = self.get(job_id) if job_id else None
+            if job and job.active:
+                return job
+        return None
+
+    def active_count(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.active)
+
+    def _publish(self, job, events):
+        # Runs outside the job's lock; per-track snapshots are throttled, state changes never are
+        try:
+            for event in events:
+                self.backend.rpush(f"job_events:{job.id}", list(event), max_len=MAX_JOB_EVENTS,
+                                   ttl=self.retention_seconds + JOB_CLAIM_TTL)
+            now = time.time()
+            state_changed = any(event[1] == "state" for event in events)
+            if not events or state_changed or now - self._snapshot_times.get(job.id, 0) >= 1:
+                self._snapshot_times[job.id] = now
+                self._save_snapshot(job)
+            if state_changed and not job.active:
+                self._snapshot_times.pop(job.id, None)
+                self.backend.delete(f"active_job:{job.session_id}:{job.playlist_id}")
+        except Exception as e:
+            logger.error(f"Error publishing state of transfer job {job.id}: {e}")
+
+    def _save_snapshot(self, job):
+        self.backend.set(f"job:{job.id}", {"session_id": job.session_id, "job": job.to_dict()},
+                         ttl=self.retention_seconds + JOB_CLAIM_TTL)
+
+    def _heartbeat(self):
+        # Renew claims and snapshots of our active jobs; a crashed worker's claims simply expire
+        while True:
+            time.sleep(JOB_CLAIM_TTL / 3)
+            with self._lock:
+                jobs = [job for job in self._jobs.values() if job.active]
+            for job in jobs:
+                try:
+                    self.backend.set(f"active_job:{job.session_id}:{job.playlist_id}", job.id, ttl=JOB_CLAIM_TTL)
+                    self._save_snapshot(job)
+                except Exception as e:
+                    logger.error(f"Error renewing claim on transfer job {job.id}: {e}")
+
+    def _start(self, job, request):
+        future = self.engine.start(job, request)
+        future.add_done_callback(lambda future: self._settle(job, request, future))
+
+    def _settle(self, job, request, future):
+        error = future.exception()
+        if isinstance(error, (QuotaDeferred, CircuitOpen)):
+            # Give the worker back and queue the job again once the quota resets or the API recovers;
+            # it resumes from its saved progress
+            job.defer(error.resume_at, f"{API_NAMES[error.api]} API unavailable" if isinstance(error, CircuitOpen) else None)
+            jobs_finished.inc(state=DEFERRED)
+            delay = max(error.resume_at - time.time(), 0)
+            timer = threading.Timer(delay, self._start, args=(job, request))
+            timer.daemon = True
+            timer.start()
+            logger.info(f"Deferred transfer job {job.id} for {delay:.0f}s: {error}")
+            return
+        if error is not None:
+            logger.error(f"Transfer job {job.id} failed: {error}")
+            job.fail(error)
+            jobs_finished.inc(state=FAILED)
+            return
+        if job.active:
+            job.finish("Transfer complete.")
+        jobs_finished.inc(state=job.state)
+
+    def _prune(self):
+        # Forget finished jobs once nobody is likely to poll them anymore
+        cutoff = time.time() - self.retention_seconds
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if not job.active and job.finished_at and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+
+job_manager = JobManager(create_engine(os.getenv("TRANSFER_ENGINE", "threads")))
+registry.gauge("transfer_jobs_active", "Transfer jobs queued, running or deferred in this process.",
+               function=job_manager.active_count)
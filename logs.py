@@ -0,0 +1,163 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+
+from metrics import log_records_dropped
+
+# "json" writes one JSON object per line for log collectors; "text" is easier to read in a terminal
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Records waiting to be written; past this, new records are dropped rather than blocking the caller
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+# Fraction of records below ERROR kept per logger, e.g. "retry=0.1,werkzeug=0.05"; children of a listed logger
+# share its rate. Meant for loggers that fire once per track or per request under load
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
+# "access_token": "...", refresh_token=..., client_secret: ..., Bearer ... and OAuth codes in URLs
+SECRET_PATTERNS = (
+    re.compile(r"""(?i)(['"]?\b(?:access_token|refresh_token|id_token|client_secret|token|password|secret)"""
+               r"""['"]?\s*[:=]\s*['"]?)[^'"\s,}&]+"""),
+    re.compile(r"(?i)(\bbearer\s+)[\w.~+/-]+=*"),
+    re.compile(r"([?&](?:code|state)=)[^&\s'\"]+"),
+)
+REDACTED = "[REDACTED]"
+# Attributes every LogRecord has; anything else was passed in `extra` and goes into the JSON line
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+
+
+def redact(text):
+    for pattern in SECRET_PATTERNS:
+        text = pattern.sub(lambda match: match.group(1) + REDACTED, text)
+    return text
+
+
+def parse_sample_rates(spec):
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, rate = item.partition("=")
+        rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of the records below ERROR from the configured loggers; errors always pass."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        # Logger name -> rate of its nearest configured ancestor, or None
+        self._resolved = {}
+
+    def _rate(self, name):
+        if name not in self._resolved:
+            rate, candidate = None, name
+            while candidate:
+                if candidate in self.rates:
+                    rate = self.rates[candidate]
+                    break
+                candidate = candidate.rpartition(".")[0]
+            self._resolved[name] = rate
+        return self._resolved[name]
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        rate = self._rate(record.name)
+        if rate is None or rate >= 1.0 or random.random() < rate:
+            return True
+        log_records_dropped.inc(reason="sampled")
+        return False
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread as they are, without formatting or blocking the caller.
+
+    The stock QueueHandler formats each message in the calling thread; here even
+    that is left to the writer, so logging costs the caller a queue put.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc(reason="queue_full")
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room rather than fail when stopping with a full queue; everything before it is written first
+        self.queue.put(self._sentinel)
+
+
+class StructuredFormatter(logging.Formatter):
+    """Redacts secrets from the message and traceback, then writes a JSON object or a plain text line."""
+
+    def __init__(self, json_lines=True):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        self.json_lines = json_lines
+
+    def format(self, record):
+        record.message = redact(record.getMessage())
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        exc_text = redact(record.exc_text) if record.exc_text else None
+        if not self.json_lines:
+            line = f"{self.formatTime(record)} {record.levelname} {record.name}: {record.message}"
+            return f"{line}\n{exc_text}" if exc_text else line
+        entry = {
+            "ts": f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))}.{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.message,
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value if isinstance(value, (int, float, bool, type(None))) else redact(str(value))
+        if exc_text:
+            entry["exc"] = exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging(level=LOG_LEVEL, json_lines=LOG_FORMAT == "json", sample_rates=LOG_SAMPLE_RATES):
+    """Send every log record through a bounded queue to a writer thread that redacts, formats and prints it.
+
+    Calling it again only changes the level.
+    """
+    global _listener
+    root = logging.getLogger()
+    root.setLevel(level)
+    if _listener is not None:
+        return
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    handler = DeferredQueueHandler(records)
+    handler.addFilter(SamplingFilter(parse_sample_rates(sample_rates)))
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(StructuredFormatter(json_lines))
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    _listener = DrainingQueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    # Write out whatever is still queued when the process exits normally
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Write out every queued record and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        listener, _listener = _listener, None
+        listener.stop()
@@ -0,0 +1,147 @@
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+
+from metrics import match_cache_lookups
+from state import SQLiteConnections
+
+logger = logging.getLogger(__name__)
+
+MATCH_CACHE_FILE = os.path.join("data", "match_cache.db")
+
+
+def normalize_text(text):
+    """Lowercase, strip accents and punctuation so equivalent titles compare equal."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+def track_keys(track):
+    """Cache keys for a tracks.Track, most specific first."""
+    keys = []
+    if track.id:
+        keys.append(f"id:{track.id}")
+    if track.isrc:
+        keys.append(f"isrc:{track.isrc.upper()}")
+    keys.append(f"name:{normalize_text(track.name)}|{normalize_text(track.artist)}")
+    return keys
+
+
+class MatchCache:
+    """Persistent track->video cache shared by every user's transfers.
+
+    Entries expire after `ttl` seconds (`negative_ttl` for "no result" entries)
+    and the least recently used entries are evicted past `max_entries`.
+    """
+
+    def __init__(self, path=MATCH_CACHE_FILE, ttl=30 * 24 * 3600, negative_ttl=24 * 3600, max_entries=100000):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_evict = 0
+        # Guards the counters; the database has a connection per thread
+        self._lock = threading.Lock()
+        self._db = SQLiteConnections(path)
+        self._db.get().executescript(
+            "CREATE TABLE IF NOT EXISTS matches ("
+            " key TEXT PRIMARY KEY,"
+            " video_id TEXT,"
+            " created_at REAL NOT NULL,"
+            " last_used_at REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS matches_last_used ON matches (last_used_at);"
+        )
+
+    def get(self, track):
+        """Return (hit, video_id); video_id is None for a cached "no result"."""
+        now = time.time()
+        conn = self._db.get()
+        for key in track_keys(track):
+            row = conn.execute("SELECT video_id, created_at FROM matches WHERE key = ?", (key,)).fetchone()
+            if not row:
+                continue
+            video_id, created_at = row
+            ttl = self.ttl if video_id else self.negative_ttl
+            if now - created_at > ttl:
+                conn.execute("DELETE FROM matches WHERE key = ? AND created_at = ?", (key, created_at))
+                continue
+            conn.execute("UPDATE matches SET last_used_at = ? WHERE key = ?", (now, key))
+            with self._lock:
+                self.hits += 1
+            match_cache_lookups.inc(result="hit")
+            return True, video_id
+        with self._lock:
+            self.misses += 1
+        match_cache_lookups.inc(result="miss")
+        return False, None
+
+    def contains(self, track):
+        """Whether `track` has a live entry, without touching counters or recency."""
+        now = time.time()
+        conn = self._db.get()
+        for key in track_keys(track):
+            row = conn.execute("SELECT video_id, created_at FROM matches WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] <= (self.ttl if row[0] else self.negative_ttl):
+                return True
+        return False
+
+    def put(self, track, video_id):
+        """Remember the search result for every key of `track` (None means no result)."""
+        now = time.time()
+        rows = [(key, video_id, now, now) for key in track_keys(track)]
+        with self._db.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO matches (key, video_id, created_at, last_used_at) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._evict(conn)
+
+    def invalidate(self, track):
+        with self._db.transaction() as conn:
+            conn.executemany("DELETE FROM matches WHERE key = ?", [(key,) for key in track_keys(track)])
+
+    def invalidate_negative(self):
+        """Drop every cached "no result" entry so those tracks are searched again."""
+        deleted = self._db.get().execute("DELETE FROM matches WHERE video_id IS NULL").rowcount
+        logger.info(f"Invalidated {deleted} negative match cache entries")
+        return deleted
+
+    def stats(self):
+        size = self._db.get().execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+    def _evict(self, conn):
+        # Counting rows is a table scan, so only check the bound every so often
+        with self._lock:
+            self._puts_since_evict += 1
+            if self._puts_since_evict < 100:
+                return
+            self._puts_since_evict = 0
+        size = conn.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+        if size <= self.max_entries:
+            return
+        conn.execute(
+            "DELETE FROM matches WHERE key IN (SELECT key FROM matches ORDER BY last_used_at LIMIT ?)",
+            (size - self.max_entries,)
+        )
+
+
+match_cache = MatchCache(
+    ttl=int(os.getenv("MATCH_CACHE_TTL", 30 * 24 * 3600)),
+    negative_ttl=int(os.getenv("MATCH_CACHE_NEGATIVE_TTL", 24 * 3600)),
+    max_entries=int(os.getenv("MATCH_CACHE_MAX_ENTRIES", 100000))
+)
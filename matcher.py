@@ -0,0 +1,93 @@
+import os
+import re
+
+from match_cache import normalize_text
+
+# A best candidate scoring below this gets one fallback search
+MATCH_MIN_SCORE = float(os.getenv("MATCH_MIN_SCORE", 0.7))
+# Nothing scoring below this is inserted, even after the fallback
+MATCH_ACCEPT_SCORE = float(os.getenv("MATCH_ACCEPT_SCORE", 0.4))
+
+TITLE_WEIGHT = 0.45
+ARTIST_WEIGHT = 0.25
+DURATION_WEIGHT = 0.3
+# Duration differences up to this many milliseconds still earn part of the duration score
+DURATION_TOLERANCE_MS = 30000
+# Official audio uploaded by YouTube's auto-generated "<artist> - Topic" channels
+TOPIC_BONUS = 0.1
+# Words marking a different recording, unless the Spotify track's own name has them too
+VARIANT_WORDS = frozenset(("cover", "karaoke", "instrumental", "live", "remix", "nightcore", "slowed", "sped",
+                           "reverb", "8d", "reaction", "tutorial", "lesson"))
+VARIANT_PENALTY = 0.3
+
+DURATION_PATTERN = re.compile(r"P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?")
+# "Song - Remastered 2011", "Song (feat. Someone)": suffixes YouTube titles usually leave out
+NAME_SUFFIX_PATTERN = re.compile(r"\s+-\s+.*$|\s*[(\[](?:feat|ft|with)\b.*?[)\]]", re.IGNORECASE)
+
+
+def parse_duration(value):
+    """Milliseconds in an ISO 8601 duration as YouTube reports it ("PT3M25S"), or None."""
+    match = DURATION_PATTERN.fullmatch(value or "")
+    if not match or not any(match.groups()):
+        return None
+    days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return (((days * 24 + hours) * 60 + minutes) * 60 + seconds) * 1000
+
+
+def fallback_query(track):
+    """A second, differently phrased search for tracks the first one didn't match confidently.
+
+    YouTube finds the official upload of many releases by ISRC; without one,
+    the artist's Topic channel usually carries it.
+    """
+    if track.isrc:
+        return track.isrc
+    return f"{track.name} {track.artist} topic"
+
+
+def score_candidates(track, candidates):
+    """Confidence between 0 and 1 that each candidate is the Spotify `track`, in candidate order.
+
+    Each candidate is a dict with `title`, `channel` and `duration_ms` (None when
+    unknown). Scores combine how much of the track name and first artist appear
+    in the video title and channel with how close the durations are; versions
+    like covers and live recordings are marked down unless the track is one.
+    The track's side is tokenized once for the whole set.
+    """
+    name_tokens = set(normalize_text(NAME_SUFFIX_PATTERN.sub("", track.name) or track.name).split())
+    all_name_tokens = set(normalize_text(track.name).split())
+    artist_tokens = set(normalize_text(track.artist).split())
+    artist_compact = normalize_text(track.artist).replace(" ", "")
+    unwanted = VARIANT_WORDS - all_name_tokens
+    scores = []
+    for candidate in candidates:
+        title_tokens = set(normalize_text(candidate["title"]).split())
+        channel = normalize_text(candidate["channel"])
+        channel_tokens = set(channel.split())
+        score = TITLE_WEIGHT * (len(name_tokens & title_tokens) / len(name_tokens) if name_tokens else 0.0)
+        if artist_tokens:
+            found = artist_tokens & (title_tokens | channel_tokens)
+            # "ArtistVEVO" style channel names run the artist's name together
+            if not found and artist_compact and artist_compact in channel.replace(" ", ""):
+                found = artist_tokens
+            score += ARTIST_WEIGHT * len(found) / len(artist_tokens)
+        if track.duration_ms and candidate["duration_ms"]:
+            delta = abs(track.duration_ms - candidate["duration_ms"])
+            score += DURATION_WEIGHT * max(0.0, 1.0 - delta / DURATION_TOLERANCE_MS)
+        else:
+            score += DURATION_WEIGHT / 2
+        if channel.endswith(" topic"):
+            score += TOPIC_BONUS
+        if unwanted & title_tokens:
+            score -= VARIANT_PENALTY
+        scores.append(min(max(score, 0.0), 1.0))
+    return scores
+
+
+def best_candidate(track, candidates):
+    """(candidate, score) of the highest-scoring candidate, the earliest on ties; (None, 0.0) if there are none."""
+    best, best_score = None, 0.0
+    for candidate, score in zip(candidates, score_candidates(track, candidates)):
+        if best is None or score > best_score:
+            best, best_score = candidate, score
+    return best, best_score
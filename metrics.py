@@ -0,0 +1,189 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a cache lookup up to a long batch insert
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines.extend(self._render_sample(key, value) for key, value in items)
+        return "\n".join(lines)
+
+    def _render_sample(self, key, value):
+        return f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down; `function` computes it at scrape time instead."""
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        if self.function is not None:
+            # A plain number, or {tuple of label values: number} for labelled gauges
+            values = self.function()
+            if not self.labelnames:
+                values = {(): values}
+            with self._lock:
+                self._values = {tuple(str(v) for v in key): value for key, value in values.items()}
+        return super().render()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = entry[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return "\n".join(lines)
+
+
+class Registry:
+    """Metrics of this process, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+registry = Registry()
+
+# External calls and pipeline stages
+api_request_seconds = registry.histogram(
+    "api_request_duration_seconds", "Latency of each Spotify/YouTube request attempt.", ("api", "operation", "outcome"))
+api_retries = registry.counter("api_retries_total", "Spotify/YouTube requests retried after a transient error.", ("api",))
+stage_seconds = registry.histogram(
+    "transfer_stage_duration_seconds",
+    "Time spent in each stage: spotify_fetch, youtube_search, youtube_insert, progress_write, token_refresh.",
+    ("stage",))
+match_cache_lookups = registry.counter("match_cache_lookups_total", "Match cache lookups by result.", ("result",))
+searches_coalesced = registry.counter(
+    "youtube_searches_coalesced_total", "Track lookups that waited on the same track's lookup already in flight.")
+playlist_cache_lookups = registry.counter(
+    "playlist_cache_lookups_total", "Playlist list page lookups: hit, miss, unchanged or changed.", ("result",))
+token_refreshes = registry.counter(
+    "token_refreshes_total", "Spotify access token refreshes, by trigger (request or background) and outcome.",
+    ("trigger", "outcome"))
+quota_units = registry.counter("youtube_quota_units_total", "YouTube quota units charged by transfers.")
+tracks_processed = registry.counter("transfer_tracks_total", "Tracks processed by transfers, by outcome.", ("outcome",))
+jobs_finished = registry.counter("transfer_jobs_finished_total", "Transfer jobs that left the worker, by state.", ("state",))
+http_request_seconds = registry.histogram(
+    "http_request_duration_seconds", "Latency of requests to this app's routes.", ("endpoint", "method", "status"))
+log_records_dropped = registry.counter(
+    "log_records_dropped_total", "Log records not written: sampled out, or the log queue was full.", ("reason",))
+startup_seconds = registry.gauge("app_startup_seconds", "Seconds from the app module starting to import to it being ready.")
+
+
+@contextmanager
+def timed(stage):
+    """Time a block as one observation of `stage` in transfer_stage_duration_seconds."""
+    with stage_seconds.time(stage=stage):
+        yield
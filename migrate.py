@@ -0,0 +1,398 @@
+"""Migrate many Spotify playlists to YouTube from the command line.
+
+Log in once; the tokens are kept in data/cli_tokens.json and refreshed as needed:
+
+    python migrate.py login
+
+Then run a manifest, a JSON file listing the playlists to move (IDs, URIs or
+links), or "all" for every playlist in the account's library:
+
+    {"playlists": ["37i9dQZF1DXcBWIGoYBM5M", "spotify:playlist:...", "https://open.spotify.com/playlist/..."]}
+    {"playlists": "all", "exclude": ["37i9dQZF1DXcBWIGoYBM5M"]}
+
+    python migrate.py run manifest.json --engine asyncio --workers 4
+
+Playlists are transferred in parallel by the same job manager and engine as the
+web app, and sync into the YouTube playlists they were copied to before. Tracks
+are first collected across all of them so each unique track is searched only
+once. The run is checkpointed next to the other app data: running the same
+manifest again skips the playlists that finished, and the others resume from
+their saved track positions.
+
+Tracks matched to the wrong video, or cached as having no match, can be
+searched again by dropping their match cache entries:
+
+    python migrate.py forget-matches 4uLU6hMCjMI75M1A2tKUQC spotify:track:...
+    python migrate.py forget-matches --negative-only
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import urllib.parse
+
+TOKENS_FILE = os.path.join("data", "cli_tokens.json")
+CHECKPOINT_DIR = os.path.join("data", "migrations")
+# The CLI's transfers run under this session ID, like a browser session's
+CLI_SESSION_ID = "cli"
+POLL_SECONDS = 2
+
+TERMINAL_STATES = ("completed", "failed")
+BLOCKED_STATES = ("deferred",)
+
+PLAYLIST_LINK_PATTERN = re.compile(r"(?:spotify:playlist:|open\.spotify\.com/(?:[\w-]+/)?playlist/)([0-9A-Za-z]+)")
+TRACK_LINK_PATTERN = re.compile(r"(?:spotify:track:|open\.spotify\.com/(?:[\w-]+/)?track/)([0-9A-Za-z]+)")
+LINK_PATTERNS = {"playlist": PLAYLIST_LINK_PATTERN, "track": TRACK_LINK_PATTERN}
+# Tracks per Spotify "several tracks" request
+TRACKS_PER_REQUEST = 50
+
+
+def load_tokens(path=TOKENS_FILE):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        sys.exit(f"No stored tokens in {path}; run `python migrate.py login` first.")
+
+
+def save_json(path, data, mode=None):
+    """Write `data` to `path` atomically, so an interrupted run never leaves half a file behind."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    if mode is not None:
+        os.chmod(temp_path, mode)
+    os.replace(temp_path, path)
+
+
+def prompt_redirect(provider, authorize_url):
+    print(f"Open this URL, authorize access to {provider}, and paste the address you were redirected to:\n\n"
+          f"  {authorize_url}\n")
+    return input("Redirected URL: ").strip()
+
+
+def login(args):
+    """Authorize Spotify and YouTube once and store both tokens for later runs."""
+    from clients import get_spotify_oauth, google_oauth_flow
+
+    sp_oauth = get_spotify_oauth(CLI_SESSION_ID)
+    response = prompt_redirect("Spotify", sp_oauth.get_authorize_url())
+    token_info = sp_oauth.get_access_token(sp_oauth.parse_response_code(response), as_dict=True, check_cache=False)
+
+    # Reuse the web app's registered redirect URI; nothing needs to be listening on it
+    try:
+        flow = google_oauth_flow(redirect_uri=args.google_redirect_uri)
+    except ValueError as e:
+        sys.exit(f"Google OAuth client config unavailable: {e}")
+    authorize_url, _ = flow.authorization_url(access_type="offline", prompt="consent")
+    response = prompt_redirect("YouTube", authorize_url)
+    code = urllib.parse.parse_qs(urllib.parse.urlsplit(response).query).get("code", [response])[0]
+    flow.fetch_token(code=code)
+    credentials = flow.credentials
+
+    save_json(args.tokens, {
+        "spotify": token_info,
+        "google": {
+            "token": credentials.token,
+            "refresh_token": credentials.refresh_token,
+            "token_uri": credentials.token_uri,
+            "client_id": credentials.client_id,
+            "client_secret": credentials.client_secret,
+            "scopes": credentials.scopes
+        }
+    }, mode=0o600)
+    print(f"Stored tokens in {args.tokens}")
+
+
+def parse_spotify_id(value, kind="playlist"):
+    match = LINK_PATTERNS[kind].search(value)
+    if match:
+        return match.group(1)
+    if not value.isalnum():
+        raise ValueError(f"Not a Spotify {kind} ID, URI or link: {value}")
+    return value
+
+
+def library_playlists(sp):
+    """IDs of every playlist in the current user's library, owned or followed."""
+    from retry import call
+
+    page = call("spotify", "me.playlists", lambda: sp.current_user_playlists(limit=50))
+    playlist_ids = []
+    while page:
+        playlist_ids.extend(item["id"] for item in page["items"] if item)
+        page = call("spotify", "me.playlists", lambda: sp.next(page)) if page.get("next") else None
+    return playlist_ids
+
+
+def manifest_playlists(manifest, sp):
+    """Playlist IDs the manifest asks for, in order and without repeats."""
+    playlists = manifest.get("playlists")
+    if playlists == "all":
+        playlist_ids = library_playlists(sp)
+    elif isinstance(playlists, list):
+        playlist_ids = [parse_spotify_id(value) for value in playlists]
+    else:
+        raise ValueError('The manifest needs "playlists": a list of playlists, or "all"')
+    excluded = {parse_spotify_id(value) for value in manifest.get("exclude", [])}
+    return [playlist_id for playlist_id in dict.fromkeys(playlist_ids) if playlist_id not in excluded]
+
+
+class BudgetQuota:
+    """Quota handle for the search pre-pass, which stops instead of waiting for the quota reset.
+
+    Raises QuotaDeferred once today's remaining units can't cover a charge; the
+    tracks left unsearched are searched by the transfers as their quota allows.
+    """
+
+    def __init__(self, accountant):
+        self.accountant = accountant
+
+    def charge(self, units):
+        from quota import QuotaDeferred, quota_units
+
+        if self.accountant.available() < units:
+            raise QuotaDeferred(self.accountant.next_reset(), units)
+        self.accountant.charge(units)
+        quota_units.inc(units)
+
+    def exhausted(self):
+        # The resolver charges again next, which now raises
+        self.accountant.mark_exhausted()
+
+
+def unique_tracks(sp, spotify_user_id, playlist_ids):
+    """Tracks of all `playlist_ids` that will need a YouTube search, each listed once.
+
+    Tracks already synced to a playlist's YouTube copy or held in the match cache
+    are left out, as are later copies of a track (by any of its match cache keys).
+    """
+    from match_cache import match_cache, track_keys
+    from sync import sync_store
+    from tracks import iter_playlist_tracks
+
+    seen = set()
+    tracks = []
+    for playlist_id in playlist_ids:
+        synced = sync_store.items(spotify_user_id, playlist_id) if sync_store.get(spotify_user_id, playlist_id) else {}
+        for _, track in iter_playlist_tracks(sp, playlist_id):
+            keys = track_keys(track)
+            if keys[0] in synced or seen.intersection(keys):
+                continue
+            seen.update(keys)
+            if not match_cache.contains(track):
+                tracks.append(track)
+    return tracks
+
+
+def search_unique_tracks(sp, google_credentials, spotify_user_id, playlist_ids):
+    """Search each track that the playlists share once, up front, so their transfers find it in the match cache."""
+    from google.oauth2.credentials import Credentials
+
+    from clients import youtube_client
+    from quota import QuotaDeferred, quota_accountant
+    from resolver import SearchResolver
+    from retry import CircuitOpen
+
+    tracks = unique_tracks(sp, spotify_user_id, playlist_ids)
+    print(f"{len(tracks)} unique tracks across {len(playlist_ids)} playlists need a YouTube search")
+    credentials = Credentials(**google_credentials)
+    resolver = SearchResolver(youtube_client(credentials), credentials, quota=BudgetQuota(quota_accountant))
+    found = searched = 0
+    try:
+        for resolution in resolver.resolve_all(enumerate(tracks)):
+            searched += 1
+            found += resolution.video_id is not None
+    except (QuotaDeferred, CircuitOpen) as e:
+        # Whatever is left gets searched by the transfers once they can run
+        print(f"Stopped searching after {searched} tracks: {e}")
+        return False
+    print(f"Searched {searched} tracks, found {found} videos")
+    return True
+
+
+def checkpoint_path(manifest_path):
+    name = os.path.splitext(os.path.basename(manifest_path))[0]
+    return os.path.join(CHECKPOINT_DIR, f"{name}.json")
+
+
+def load_checkpoint(path, restart):
+    if restart or not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def wait_for_jobs(jobs, checkpoint, path, exit_when_blocked):
+    """Poll the running jobs, recording each one's state in the checkpoint until all have settled."""
+    reported = {}
+    while True:
+        for playlist_id, job in jobs.items():
+            status = job.to_dict()
+            checkpoint["playlists"][playlist_id] = {key: status[key] for key in (
+                "state", "message", "playlist_name", "youtube_playlist_id", "total_tracks", "processed",
+                "successful_transfers")}
+            line = f"{status['playlist_name'] or playlist_id}: {status['state']}, {status['processed']}/" \
+                   f"{status['total_tracks']} tracks, {status['message']}"
+            if reported.get(playlist_id) != line:
+                reported[playlist_id] = line
+                print(line)
+        save_json(path, checkpoint)
+        states = {job.state for job in jobs.values()}
+        if states <= set(TERMINAL_STATES) or (exit_when_blocked and states <= set(TERMINAL_STATES + BLOCKED_STATES)):
+            return
+        time.sleep(POLL_SECONDS)
+
+
+def run(args):
+    """Transfer every playlist of the manifest, resuming from its checkpoint."""
+    os.environ["TRANSFER_ENGINE"] = args.engine
+    if args.workers:
+        os.environ["TRANSFER_WORKERS"] = os.environ["ASYNC_USER_TRANSFERS"] = str(args.workers)
+    # The job manager picks its engine up from the environment when it's imported
+    from clients import fresh_token_info, spotify_client
+    from engines import TransferRequest
+    from jobs import TransferJob, job_manager
+    from retry import call
+
+    tokens = load_tokens(args.tokens)
+    token_info = fresh_token_info(CLI_SESSION_ID, tokens["spotify"])
+    sp = spotify_client(token_info["access_token"])
+    spotify_user_id = call("spotify", "me", sp.current_user)["id"]
+
+    path = args.checkpoint or checkpoint_path(args.manifest)
+    checkpoint = load_checkpoint(path, args.restart)
+    if checkpoint is None or checkpoint["spotify_user_id"] != spotify_user_id:
+        with open(args.manifest, "r") as f:
+            manifest = json.load(f)
+        # An "all" manifest is expanded once, so a resumed run works through the same playlists
+        checkpoint = {"manifest": os.path.abspath(args.manifest), "spotify_user_id": spotify_user_id,
+                      "searched": False, "playlists": {playlist_id: {"state": "pending"}
+                                                      for playlist_id in manifest_playlists(manifest, sp)}}
+        save_json(path, checkpoint)
+    playlist_ids = [playlist_id for playlist_id, status in checkpoint["playlists"].items()
+                    if status["state"] != "completed"]
+    print(f"{len(checkpoint['playlists'])} playlists in {args.manifest}, {len(playlist_ids)} left to transfer; "
+          f"checkpoint in {path}")
+
+    if playlist_ids and not checkpoint["searched"] and not args.no_dedupe:
+        checkpoint["searched"] = search_unique_tracks(sp, tokens["google"], spotify_user_id, playlist_ids)
+        save_json(path, checkpoint)
+
+    transfer_requests = []
+    jobs = {}
+    for playlist_id in playlist_ids:
+        request = TransferRequest(dict(token_info), dict(tokens["google"]), spotify_user_id, args.fresh)
+        transfer_requests.append(request)
+        jobs[playlist_id] = job_manager.submit(TransferJob(CLI_SESSION_ID, playlist_id), request)
+
+    try:
+        wait_for_jobs(jobs, checkpoint, path, args.exit_when_blocked)
+    except KeyboardInterrupt:
+        print(f"Interrupted; run the same command again to resume from {path}")
+        return 130
+    finally:
+        # Keep the newest Spotify token the engine refreshed to
+        tokens["spotify"] = max([token_info] + [request.token_info for request in transfer_requests],
+                                key=lambda info: info.get("expires_at", 0))
+        save_json(args.tokens, tokens, mode=0o600)
+
+    states = [job.state for job in jobs.values()]
+    print(f"{states.count('completed')} completed, {states.count('failed')} failed, "
+          f"{len(states) - states.count('completed') - states.count('failed')} waiting on the YouTube quota or an API")
+    return 1 if "failed" in states else 0
+
+
+def forget_matches(args):
+    """Drop match cache entries so the next transfers search those tracks again."""
+    from match_cache import match_cache
+
+    if args.negative_only:
+        print(f"Dropped {match_cache.invalidate_negative()} cached \"no result\" searches")
+        return
+    if not args.tracks:
+        sys.exit("Name the tracks whose matches to drop, or pass --negative-only")
+    try:
+        track_ids = list(dict.fromkeys(parse_spotify_id(value, "track") for value in args.tracks))
+    except ValueError as e:
+        sys.exit(str(e))
+
+    from clients import fresh_token_info, spotify_client
+    from retry import call
+    from tracks import Track
+
+    tokens = load_tokens(args.tokens)
+    tokens["spotify"] = fresh_token_info(CLI_SESSION_ID, tokens["spotify"])
+    save_json(args.tokens, tokens, mode=0o600)
+    sp = spotify_client(tokens["spotify"]["access_token"])
+    # The cache is also keyed by ISRC and by title and artist, so the tracks are looked up for those
+    for start in range(0, len(track_ids), TRACKS_PER_REQUEST):
+        chunk = track_ids[start:start + TRACKS_PER_REQUEST]
+        response = call("spotify", "tracks", lambda: sp.tracks(chunk))
+        for track_id, item in zip(chunk, response["tracks"]):
+            if not item:
+                print(f"{track_id}: not found on Spotify")
+                continue
+            track = Track.from_spotify(item)
+            match_cache.invalidate(track)
+            print(f"{track_id}: dropped the cached match for {track.artist} - {track.name}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", default=TOKENS_FILE, help="where the Spotify and YouTube tokens are stored")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    login_parser = commands.add_parser("login", help="authorize Spotify and YouTube and store the tokens")
+    login_parser.add_argument("--google-redirect-uri", default="http://127.0.0.1:5000/google-callback",
+                              help="a redirect URI registered for the Google OAuth client")
+
+    run_parser = commands.add_parser("run", help="transfer the playlists of a manifest")
+    run_parser.add_argument("manifest", help="JSON manifest of the playlists to transfer")
+    run_parser.add_argument("--engine", choices=("threads", "asyncio"),
+                            default=os.getenv("TRANSFER_ENGINE", "threads"), help="transfer engine to run them on")
+    run_parser.add_argument("--workers", type=int, help="playlists transferred at once")
+    run_parser.add_argument("--checkpoint", help=f"checkpoint file (default {CHECKPOINT_DIR}/<manifest name>.json)")
+    run_parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start the run over")
+    run_parser.add_argument("--fresh", action="store_true", help="create new YouTube playlists instead of syncing")
+    run_parser.add_argument("--no-dedupe", action="store_true", help="skip searching shared tracks up front")
+    run_parser.add_argument("--exit-when-blocked", action="store_true",
+                            help="exit once the remaining transfers wait for the quota reset or an API, "
+                                 "instead of waiting with them")
+
+    forget_parser = commands.add_parser("forget-matches",
+                                        help="drop match cache entries so those tracks are searched again")
+    forget_parser.add_argument("tracks", nargs="*", help="Spotify track IDs, URIs or links")
+    forget_parser.add_argument("--negative-only", action="store_true",
+                               help='drop every cached "no result" search instead')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    import logging
+
+    from dotenv import load_dotenv
+
+    # The app's modules read their settings from the environment as they're imported,
+    # so they're imported only once .env and the command-line options are applied
+    load_dotenv()
+    # Progress is printed; only the app's warnings and errors are worth interleaving with it
+    logging.basicConfig(level=logging.WARNING)
+    args = parse_args(argv)
+    if args.command == "login":
+        login(args)
+        return
+    if args.command == "forget-matches":
+        forget_matches(args)
+        return
+    status = run(args)
+    sys.stdout.flush()
+    # Deferred jobs wait on timers until the quota resets or the API recovers; don't wait for them to exit
+    os._exit(status)
+
+
+if __name__ == "__main__":
+    main()
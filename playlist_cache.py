@@ -0,0 +1,91 @@
+import logging
+import os
+import time
+
+from metrics import playlist_cache_lookups
+from state import state_backend
+
+logger = logging.getLogger(__name__)
+
+# Spotify returns at most 50 playlists per page
+PLAYLIST_PAGE_SIZE = 50
+# Seconds a cached page is served without asking Spotify
+PLAYLIST_CACHE_TTL = int(os.getenv("PLAYLIST_CACHE_TTL", 60))
+# Seconds a page is kept at all; past the TTL it is only used to tell whether the library changed
+PLAYLIST_CACHE_MAX_AGE = int(os.getenv("PLAYLIST_CACHE_MAX_AGE", 3600))
+
+
+def compact_playlist(playlist):
+    """The fields the playlists page shows, plus the snapshot ID pages are revalidated with."""
+    images = playlist.get("images") or []
+    return {
+        "id": playlist["id"],
+        "name": playlist["name"],
+        "image": images[0]["url"] if images else None,
+        "tracks": (playlist.get("tracks") or {}).get("total", 0),
+        "snapshot_id": playlist.get("snapshot_id"),
+    }
+
+
+def _signature(page):
+    return [page["total"]] + [[playlist["id"], playlist["snapshot_id"]] for playlist in page["items"]]
+
+
+class PlaylistListCache:
+    """Pages of each Spotify user's playlist list, kept in the shared state backend.
+
+    A page younger than `ttl` is served as is. An older one is fetched again and
+    its playlists' snapshot IDs compared with the cached ones: if the library
+    total and every snapshot match, the user's other cached pages stay valid;
+    otherwise they are all dropped, since a playlist added, removed or edited can
+    shift what every later offset returns.
+    """
+
+    def __init__(self, backend=state_backend, ttl=PLAYLIST_CACHE_TTL, max_age=PLAYLIST_CACHE_MAX_AGE):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_age = max_age
+
+    def _page_key(self, spotify_user_id, offset):
+        # Pages are keyed by the user's current generation, so invalidating is one write
+        generation = self.backend.get(f"playlists_generation:{spotify_user_id}") or 0
+        return f"playlists:{spotify_user_id}:{generation}:{offset}"
+
+    def get_page(self, spotify_user_id, offset, fetch):
+        """{"items", "total", "next_offset"} of the user's playlists from `offset`.
+
+        `fetch(offset)` returns the raw Spotify page and is only called when the
+        cached page is missing or older than the TTL.
+        """
+        key = self._page_key(spotify_user_id, offset)
+        cached = self.backend.get(key)
+        now = time.time()
+        if cached and now - cached["checked_at"] < self.ttl:
+            playlist_cache_lookups.inc(result="hit")
+            return cached["page"]
+
+        response = fetch(offset)
+        page = {
+            "items": [compact_playlist(playlist) for playlist in response["items"] if playlist],
+            "total": response.get("total", 0),
+            "next_offset": offset + len(response["items"]) if response.get("next") else None,
+        }
+        if cached is None:
+            playlist_cache_lookups.inc(result="miss")
+        elif _signature(cached["page"]) == _signature(page):
+            playlist_cache_lookups.inc(result="unchanged")
+        else:
+            playlist_cache_lookups.inc(result="changed")
+            logger.info(f"Playlists of Spotify user {spotify_user_id} changed, dropping their cached pages")
+            self.invalidate(spotify_user_id)
+            key = self._page_key(spotify_user_id, offset)
+        self.backend.set(key, {"page": page, "checked_at": now}, ttl=self.max_age)
+        return page
+
+    def invalidate(self, spotify_user_id):
+        """Forget every cached page of the user's playlists."""
+        # A timestamp rather than a counter, so a generation key that expired can't be reused
+        self.backend.set(f"playlists_generation:{spotify_user_id}", time.time_ns(), ttl=self.max_age)
+
+
+playlist_cache = PlaylistListCache()
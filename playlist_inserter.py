@@ -0,0 +1,322 @@
+import asyncio
+import logging
+import os
+import time
+
+from googleapiclient.errors import HttpError
+
+from quota import INSERT_COST, UPDATE_COST, QuotaDeferred, is_quota_error
+from metrics import timed
+from retry import CircuitOpen, backoff_delay, call, call_async, retry_after
+
+logger = logging.getLogger(__name__)
+
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", 20))
+INSERT_MAX_RETRIES = int(os.getenv("INSERT_MAX_RETRIES", 3))
+
+# Statuses worth another attempt; anything else fails the item for good
+RETRYABLE_STATUSES = {409, 429, 500, 502, 503, 504}
+
+
+def is_retryable(error):
+    return isinstance(error, HttpError) and error.resp.status in RETRYABLE_STATUSES
+
+
+class PlaylistInserter:
+    """Inserts resolved tracks into a YouTube playlist using batch HTTP requests.
+
+    Resolutions are buffered and sent `batch_size` at a time; only the items that
+    failed with a retryable error are re-sent. A batch may be executed in any order
+    on the server and retried items land at the end, so the positions returned by
+    the inserts are checked and any out-of-order items are moved back into place.
+    Retried items are re-sent after a jittered backoff that honors Retry-After.
+    `on_result(resolution, error)` is called for every buffered resolution in
+    playlist order once its batch settles, including those with no video to insert.
+    Inserts are paid for through `quota`; items rejected with quotaExceeded are sent
+    again while it lasts and don't count against `max_retries`. If the quota runs
+    out or YouTube's circuit opens partway through a batch, the items still unsent
+    are reported with their last error, so nothing already inserted goes
+    unrecorded, and then the QuotaDeferred or CircuitOpen is raised.
+    """
+
+    def __init__(self, youtube, playlist_id, on_result, start_position=0,
+                 batch_size=INSERT_BATCH_SIZE, max_retries=INSERT_MAX_RETRIES, quota=None):
+        self.youtube = youtube
+        self.quota = quota
+        self.playlist_id = playlist_id
+        self.on_result = on_result
+        self.position = start_position
+        self.batch_size = max(1, min(batch_size, 50))
+        self.max_retries = max_retries
+        self._buffer = []
+        self._pending_inserts = 0
+        # QuotaDeferred or CircuitOpen raised partway through a batch, re-raised once the batch is reported
+        self._deferred = None
+
+    def add(self, resolution):
+        if self._buffer_add(resolution):
+            self.flush()
+
+    def flush(self):
+        """Insert everything buffered and report each result in order."""
+        buffered, to_insert = self._take_buffer()
+        errors = self._insert_all(to_insert) if to_insert else {}
+        self._report(buffered, errors)
+        self._raise_deferred()
+
+    def _raise_deferred(self):
+        if self._deferred is not None:
+            error, self._deferred = self._deferred, None
+            raise error
+
+    def _defer(self, error, sent):
+        # Before anything was sent the batch can simply be resolved again later; after, it has to be reported
+        if not sent:
+            raise error
+        self._deferred = error
+
+    def _defer_reorder(self, error, unordered):
+        # The items are in the playlist either way; leave the rest out of order rather than unrecorded
+        logger.warning(f"Leaving {unordered} playlist items out of order: {error}")
+        self._deferred = self._deferred or error
+
+    def _buffer_add(self, resolution):
+        # Whether a full batch is now waiting
+        self._buffer.append(resolution)
+        if resolution.video_id and not resolution.error:
+            self._pending_inserts += 1
+        return self._pending_inserts >= self.batch_size
+
+    def _take_buffer(self):
+        buffered, self._buffer = self._buffer, []
+        self._pending_inserts = 0
+        return buffered, [r for r in buffered if r.video_id and not r.error]
+
+    def _report(self, buffered, errors):
+        for resolution in buffered:
+            self.on_result(resolution, errors.get(resolution.index))
+
+    def _insert_all(self, resolutions):
+        with timed("youtube_insert"):
+            return self._insert_all_timed(resolutions)
+
+    def _insert_all_timed(self, resolutions):
+        inserted = {}
+        errors = {}
+        pending = list(resolutions)
+        attempt = 0
+        while pending:
+            try:
+                if self.quota is not None:
+                    self.quota.charge(INSERT_COST * len(pending))
+                failed = self._execute_batch(pending, inserted)
+            except (QuotaDeferred, CircuitOpen) as e:
+                self._defer(e, inserted or errors)
+                break
+            errors.update(failed)
+            quota_failed = self._quota_failed(failed)
+            if quota_failed:
+                # The next charge raises QuotaDeferred
+                self.quota.exhausted()
+            else:
+                attempt += 1
+            pending, delay = self._next_round(pending, failed, quota_failed, attempt)
+            if pending:
+                time.sleep(delay)
+        for index in inserted:
+            errors.pop(index, None)
+        self._restore_order(resolutions, inserted)
+        self.position += len(inserted)
+        return errors
+
+    def _quota_failed(self, failed):
+        if self.quota is None:
+            return set()
+        return {index for index, error in failed.items() if is_quota_error(error)}
+
+    def _next_round(self, pending, failed, quota_failed, attempt):
+        """The items to send again, and how long to wait first."""
+        pending = [r for r in pending if r.index in quota_failed or (
+            attempt <= self.max_retries and r.index in failed and is_retryable(failed[r.index]))]
+        if not pending:
+            return pending, 0.0
+        server_delays = [retry_after(failed[r.index]) for r in pending if r.index in failed]
+        server_delay = max((d for d in server_delays if d is not None), default=None)
+        delay = 0.0 if quota_failed else backoff_delay(attempt, server_delay)
+        logger.info(f"Retrying {len(pending)} failed playlist inserts in {delay:.1f}s")
+        return pending, delay
+
+    def _insert_request(self, resolution):
+        # The item ID, position and video are all that's needed to put it in order later
+        return self.youtube.playlistItems().insert(
+            part="snippet",
+            fields="id,snippet(position,resourceId)",
+            body={
+                "snippet": {
+                    "playlistId": self.playlist_id,
+                    "resourceId": {"kind": "youtube#video", "videoId": resolution.video_id}
+                }
+            }
+        )
+
+    def _execute_batch(self, pending, inserted):
+        failed = {}
+
+        def callback(request_id, response, exception):
+            index = int(request_id)
+            if exception is not None:
+                failed[index] = exception
+            else:
+                inserted[index] = response
+
+        batch = self.youtube.new_batch_http_request(callback=callback)
+        for resolution in pending:
+            batch.add(self._insert_request(resolution), request_id=str(resolution.index))
+        try:
+            call("youtube", "playlistItems.insert.batch", batch.execute)
+        except HttpError as e:
+            # The batch request itself failed, so every item in it did
+            for resolution in pending:
+                if resolution.index not in inserted:
+                    failed.setdefault(resolution.index, e)
+        return failed
+
+    @staticmethod
+    def _server_order(resolutions, inserted):
+        """(playlist order, order on the server) of the inserted items, or None if positions are unknown."""
+        wanted = [r.index for r in resolutions if r.index in inserted]
+        positions = {index: (inserted[index].get("snippet") or {}).get("position") for index in wanted}
+        if None in positions.values():
+            return None
+        return wanted, sorted(wanted, key=positions.get)
+
+    def _update_request(self, item, position):
+        return self.youtube.playlistItems().update(
+            part="snippet",
+            fields="id",
+            body={
+                "id": item["id"],
+                "snippet": {
+                    "playlistId": self.playlist_id,
+                    "position": position,
+                    "resourceId": item["snippet"]["resourceId"]
+                }
+            }
+        )
+
+    def _restore_order(self, resolutions, inserted):
+        """Move inserted items so they follow playlist order; a no-op when the server kept it."""
+        order = self._server_order(resolutions, inserted)
+        if order is None:
+            return
+        wanted, current = order
+        for offset, index in enumerate(wanted):
+            if current[offset] == index:
+                continue
+            item = inserted[index]
+            request = self._update_request(item, self.position + offset)
+            try:
+                if self.quota is not None:
+                    self.quota.charge(UPDATE_COST)
+                call("youtube", "playlistItems.update", request.execute)
+            except (QuotaDeferred, CircuitOpen) as e:
+                self._defer_reorder(e, len(wanted) - offset)
+                return
+            except HttpError as e:
+                logger.error(f"Error moving playlist item {item['id']} into place: {e}")
+                continue
+            current.remove(index)
+            current.insert(offset, index)
+
+
+class AsyncPlaylistInserter(PlaylistInserter):
+    """PlaylistInserter for the asyncio engine, sending its batches over `apis`.
+
+    Batching, retries, quota handling and reordering are those of PlaylistInserter;
+    `add` and `flush` are coroutines, and `on_result` runs on a worker thread since
+    it records results in the job and the stores.
+    """
+
+    def __init__(self, apis, playlist_id, on_result, **kwargs):
+        super().__init__(apis.youtube, playlist_id, on_result, **kwargs)
+        self.apis = apis
+
+    async def add(self, resolution):
+        if self._buffer_add(resolution):
+            await self.flush()
+
+    async def flush(self):
+        buffered, to_insert = self._take_buffer()
+        errors = await self._insert_all(to_insert) if to_insert else {}
+        await asyncio.to_thread(self._report, buffered, errors)
+        self._raise_deferred()
+
+    async def _insert_all(self, resolutions):
+        with timed("youtube_insert"):
+            return await self._insert_all_timed(resolutions)
+
+    async def _insert_all_timed(self, resolutions):
+        inserted = {}
+        errors = {}
+        pending = list(resolutions)
+        attempt = 0
+        while pending:
+            try:
+                if self.quota is not None:
+                    await self.quota.charge_async(INSERT_COST * len(pending))
+                failed = await self._execute_batch(pending, inserted)
+            except (QuotaDeferred, CircuitOpen) as e:
+                self._defer(e, inserted or errors)
+                break
+            errors.update(failed)
+            quota_failed = self._quota_failed(failed)
+            if quota_failed:
+                await asyncio.to_thread(self.quota.exhausted)
+            else:
+                attempt += 1
+            pending, delay = self._next_round(pending, failed, quota_failed, attempt)
+            if pending:
+                await asyncio.sleep(delay)
+        for index in inserted:
+            errors.pop(index, None)
+        await self._restore_order(resolutions, inserted)
+        self.position += len(inserted)
+        return errors
+
+    async def _execute_batch(self, pending, inserted):
+        failed = {}
+        requests = {str(resolution.index): self._insert_request(resolution) for resolution in pending}
+        try:
+            results = await call_async("youtube", "playlistItems.insert.batch", lambda: self.apis.youtube_batch(requests))
+        except HttpError as e:
+            # The batch request itself failed, so every item in it did
+            return {resolution.index: e for resolution in pending}
+        for request_id, (response, exception) in results.items():
+            if exception is not None:
+                failed[int(request_id)] = exception
+            else:
+                inserted[int(request_id)] = response
+        return failed
+
+    async def _restore_order(self, resolutions, inserted):
+        order = self._server_order(resolutions, inserted)
+        if order is None:
+            return
+        wanted, current = order
+        for offset, index in enumerate(wanted):
+            if current[offset] == index:
+                continue
+            item = inserted[index]
+            request = self._update_request(item, self.position + offset)
+            try:
+                if self.quota is not None:
+                    await self.quota.charge_async(UPDATE_COST)
+                await call_async("youtube", "playlistItems.update", lambda: self.apis.youtube_execute(request))
+            except (QuotaDeferred, CircuitOpen) as e:
+                self._defer_reorder(e, len(wanted) - offset)
+                return
+            except HttpError as e:
+                logger.error(f"Error moving playlist item {item['id']} into place: {e}")
+                continue
+            current.remove(index)
+            current.insert(offset, index)
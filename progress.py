@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+import time
+
+from metrics import timed
+from state import state_backend
+
+logger = logging.getLogger(__name__)
+
+# Stores migrated into the state backend on startup
+LEGACY_PROGRESS_FILE = os.path.join("data", "transfer_progress.json")
+
+
+class ProgressStore:
+    """Resume points for interrupted transfers, kept in the shared state backend.
+
+    Each processed track is one small write of the resume point plus one list
+    append for its video, so the cost per track stays constant however large the
+    playlist is. Transfers nobody resumes expire after `retention_seconds`.
+    """
+
+    def __init__(self, backend=state_backend, retention_seconds=30 * 24 * 3600):
+        self.backend = backend
+        self.retention_seconds = retention_seconds
+
+    def get(self, resume_key):
+        """Return the index to resume `resume_key` from (0 for a fresh transfer)."""
+        entry = self.backend.get(f"progress:{resume_key}")
+        return entry["last_transferred"] if entry else 0
+
+    def inserted_videos(self, resume_key):
+        """Map of track index to the video inserted for it so far."""
+        return {index: video_id for index, video_id in self.backend.lrange(f"progress_items:{resume_key}")}
+
+    def record(self, resume_key, track_index, video_id=None):
+        """Mark the track at `track_index` as processed, with the video inserted for it, if any."""
+        try:
+            with timed("progress_write"):
+                # Only the job that owns `resume_key` writes it, so read-then-write can't race
+                last_transferred = max(self.get(resume_key), track_index + 1)
+                self.backend.set(
+                    f"progress:{resume_key}",
+                    {"last_transferred": last_transferred, "updated_at": time.time()},
+                    ttl=self.retention_seconds
+                )
+                if video_id:
+                    self.backend.rpush(f"progress_items:{resume_key}", [track_index, video_id], ttl=self.retention_seconds)
+        except Exception as e:
+            logger.error(f"Error writing progress for {resume_key}: {e}")
+
+    def clear(self, resume_key):
+        self.backend.delete(f"progress:{resume_key}", f"progress_items:{resume_key}")
+
+    def import_legacy_file(self, path=LEGACY_PROGRESS_FILE):
+        """One-time migration of resume points from the old whole-file JSON store."""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r") as f:
+                legacy = json.load(f)
+            for resume_key, entry in legacy.items():
+                last_transferred = entry.get("last_transferred", 0)
+                if last_transferred:
+                    self.record(resume_key, last_transferred - 1)
+            os.replace(path, path + ".migrated")
+            logger.info(f"Migrated {len(legacy)} transfers from {path}")
+        except Exception as e:
+            logger.error(f"Error migrating progress file {path}: {e}")
+
+
+progress_store = ProgressStore()
+progress_store.import_legacy_file()
@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from googleapiclient.errors import HttpError
+
+from metrics import quota_units, registry
+from state import state_backend
+
+logger = logging.getLogger(__name__)
+
+# Store migrated into the state backend on startup
+LEGACY_QUOTA_DB = os.path.join("data", "quota.db")
+YOUTUBE_DAILY_QUOTA = int(os.getenv("YOUTUBE_DAILY_QUOTA", 10000))
+# Share of searched tracks expected to need the matcher's fallback search, which costs as much again
+SEARCH_FALLBACK_SHARE = float(os.getenv("SEARCH_FALLBACK_SHARE", 0.3))
+
+# YouTube Data API unit costs for the calls a transfer makes
+SEARCH_COST = 100
+INSERT_COST = 50
+UPDATE_COST = 50
+PLAYLIST_COST = 50
+LIST_COST = 1
+
+# The daily quota resets at midnight Pacific Time
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+# A day's usage is kept a little past its reset, then dropped
+USAGE_TTL = 2 * 24 * 3600
+
+
+def is_quota_error(error):
+    return (isinstance(error, HttpError) and error.resp.status == 403
+            and b"quotaExceeded" in (error.content or b""))
+
+
+def estimate_transfer_cost(track_count, cache_hit_ratio=0.0):
+    """Units needed to create a playlist and transfer `track_count` tracks."""
+    # Doubtful matches get a second search; each search is followed by a videos.list call for durations
+    searches = round(track_count * (1.0 - cache_hit_ratio) * (1.0 + SEARCH_FALLBACK_SHARE))
+    return PLAYLIST_COST + track_count * INSERT_COST + searches * (SEARCH_COST + LIST_COST)
+
+
+class QuotaDeferred(Exception):
+    """Raised when a job can't be admitted, or go on, until the quota resets at `resume_at`."""
+
+    def __init__(self, resume_at, estimate):
+        super().__init__(f"Not enough YouTube quota for an estimated {estimate} units")
+        self.resume_at = resume_at
+        self.estimate = estimate
+
+
+class QuotaAccountant:
+    """Tracks YouTube units spent today against a daily budget.
+
+    Usage lives in the state backend so every worker and instance draws on the
+    same budget. Admitted jobs reserve their estimate in this process so concurrent admissions
+    don't promise the same units twice. When the budget runs out mid-transfer,
+    `charge` raises QuotaDeferred, so the job gives its worker back and is
+    queued again for the reset instead of waiting for it or letting calls fail.
+    """
+
+    def __init__(self, backend=state_backend, daily_budget=YOUTUBE_DAILY_QUOTA):
+        self.backend = backend
+        self.daily_budget = daily_budget
+        self._reserved = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def today():
+        return datetime.now(QUOTA_TIMEZONE).date().isoformat()
+
+    @staticmethod
+    def next_reset():
+        """Unix time of the next quota reset."""
+        now = datetime.now(QUOTA_TIMEZONE)
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=QUOTA_TIMEZONE)
+        return midnight.timestamp()
+
+    @classmethod
+    def _usage_key(cls, day=None):
+        return f"quota_usage:{day or cls.today()}"
+
+    def spent(self):
+        return self.backend.get(self._usage_key()) or 0
+
+    def remaining(self):
+        return max(self.daily_budget - self.spent(), 0)
+
+    def available(self, job_id=None):
+        """Units left once other jobs' outstanding reservations are honoured."""
+        with self._lock:
+            reserved = sum(units for other, units in self._reserved.items() if other != job_id)
+        return self.remaining() - reserved
+
+    def admit(self, job, estimate):
+        """Reserve `estimate` units for `job` or raise QuotaDeferred.
+
+        Jobs larger than a whole day's budget are admitted once half of it is free
+        and pause for the rest.
+        """
+        required = estimate if estimate <= self.daily_budget else self.daily_budget // 2
+        if self.available(job.id) < required:
+            raise QuotaDeferred(self.next_reset(), estimate)
+        with self._lock:
+            self._reserved[job.id] = estimate
+        job.quota_estimate = estimate
+        logger.info(f"Admitted job {job.id} with an estimated {estimate} quota units")
+
+    def release(self, job):
+        with self._lock:
+            self._reserved.pop(job.id, None)
+
+    def _try_spend(self, units):
+        # Spend first and hand the units back if they didn't fit, so concurrent charges never overdraw
+        key = self._usage_key()
+        if self.backend.incr(key, units, ttl=USAGE_TTL) <= self.daily_budget:
+            return True
+        self.backend.incr(key, -units, ttl=USAGE_TTL)
+        return False
+
+    def charge(self, units, job=None):
+        """Spend `units`, or raise QuotaDeferred if today's budget can't cover them."""
+        if not self._try_spend(units):
+            raise QuotaDeferred(self.next_reset(), units)
+        self._charged(units, job)
+
+    async def charge_async(self, units, job=None):
+        """`charge` for coroutines; the state backend write runs on a worker thread."""
+        if not await asyncio.to_thread(self._try_spend, units):
+            raise QuotaDeferred(self.next_reset(), units)
+        self._charged(units, job)
+
+    def _charged(self, units, job):
+        if job is not None:
+            job.add_quota_units(units)
+            with self._lock:
+                if job.id in self._reserved:
+                    self._reserved[job.id] = max(self._reserved[job.id] - units, 0)
+
+    def mark_exhausted(self):
+        """YouTube reported quotaExceeded, so treat today's budget as spent."""
+        key = self._usage_key()
+        shortfall = self.daily_budget - self.backend.incr(key, 0, ttl=USAGE_TTL)
+        if shortfall > 0:
+            self.backend.incr(key, shortfall, ttl=USAGE_TTL)
+
+    def stats(self):
+        spent = self.spent()
+        with self._lock:
+            reserved = sum(self._reserved.values())
+        return {
+            "daily_budget": self.daily_budget,
+            "spent": spent,
+            "remaining": max(self.daily_budget - spent, 0),
+            "reserved": reserved,
+            "next_reset": datetime.fromtimestamp(self.next_reset()).isoformat(),
+        }
+
+    def import_legacy_db(self, path=LEGACY_QUOTA_DB):
+        """One-time migration of today's usage from the old per-host SQLite file."""
+        if not os.path.exists(path):
+            return
+        try:
+            conn = sqlite3.connect(path)
+            try:
+                row = conn.execute("SELECT units FROM quota_usage WHERE day = ?", (self.today(),)).fetchone()
+            finally:
+                conn.close()
+            if row:
+                self.backend.incr(self._usage_key(), row[0], ttl=USAGE_TTL)
+            os.replace(path, path + ".migrated")
+            logger.info(f"Migrated today's quota usage from {path}")
+        except Exception as e:
+            logger.error(f"Error migrating quota usage from {path}: {e}")
+
+
+class JobQuota:
+    """Per-job handle the transfer stages use to pay for their API calls."""
+
+    def __init__(self, accountant, job):
+        self.accountant = accountant
+        self.job = job
+
+    def charge(self, units):
+        self.accountant.charge(units, self.job)
+        quota_units.inc(units)
+
+    async def charge_async(self, units):
+        await self.accountant.charge_async(units, self.job)
+        quota_units.inc(units)
+
+    def exhausted(self):
+        self.accountant.mark_exhausted()
+
+
+quota_accountant = QuotaAccountant()
+quota_accountant.import_legacy_db()
+registry.gauge("youtube_quota_remaining_units", "YouTube quota units left in today's budget.",
+               function=quota_accountant.remaining)
@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from googleapiclient.errors import HttpError
+
+from clients import authorized_http
+from match_cache import match_cache, track_keys
+from matcher import MATCH_ACCEPT_SCORE, MATCH_MIN_SCORE, best_candidate, fallback_query, parse_duration
+from metrics import searches_coalesced, timed
+from quota import LIST_COST, SEARCH_COST, is_quota_error
+from ratelimit import TokenBucket
+from retry import call, call_async
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+SEARCH_CONCURRENCY = int(os.getenv("SEARCH_CONCURRENCY", 4))
+SEARCH_RATE = float(os.getenv("SEARCH_RATE", 5))
+SEARCH_BURST = float(os.getenv("SEARCH_BURST", SEARCH_RATE))
+# Videos each search returns for the matcher to choose from
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", 5))
+
+# Shared by every transfer in the process so concurrent jobs can't exceed the YouTube rate together
+search_rate_limiter = TokenBucket(SEARCH_RATE, SEARCH_BURST)
+# Transfers looking up the same track at the same time share one lookup, keyed by normalized name and artist
+search_flights = SingleFlight()
+
+
+class Resolution:
+    """Outcome of resolving one playlist entry to a YouTube video."""
+
+    __slots__ = ("index", "track", "query", "video_id", "cached", "error", "score")
+
+    def __init__(self, index, track, query, video_id=None, cached=False, error=None, score=None):
+        self.index = index
+        self.track = track
+        self.query = query
+        self.video_id = video_id
+        self.cached = cached
+        self.error = error
+        # The matcher's confidence in `video_id`; None when it came from the cache
+        self.score = score
+
+
+def track_query(track):
+    return f"{track.name} {track.artist}" if track.artist else track.name
+
+
+def search_request(youtube, query):
+    # Only what the matcher scores on is read, so leave the rest of the response out
+    return youtube.search().list(q=query, part="snippet", maxResults=SEARCH_CANDIDATES, type="video",
+                                 fields="items(id(videoId),snippet(title,channelTitle))")
+
+
+def details_request(youtube, candidates):
+    # Search results carry no durations; one videos.list call fetches them for every candidate
+    return youtube.videos().list(id=",".join(candidate["video_id"] for candidate in candidates),
+                                 part="contentDetails", fields="items(id,contentDetails(duration))")
+
+
+def search_candidates(search_response):
+    """The videos of a search response as matcher candidates, durations still unknown."""
+    # Partial responses leave out an empty item list
+    return [{"video_id": item["id"]["videoId"], "title": item["snippet"].get("title", ""),
+             "channel": item["snippet"].get("channelTitle", ""), "duration_ms": None}
+            for item in search_response.get("items") or ()]
+
+
+def add_durations(candidates, details_response):
+    durations = {item["id"]: parse_duration(item["contentDetails"].get("duration"))
+                 for item in details_response.get("items") or ()}
+    for candidate in candidates:
+        candidate["duration_ms"] = durations.get(candidate["video_id"])
+
+
+def needs_fallback(match):
+    return match[0] is None or match[1] < MATCH_MIN_SCORE
+
+
+def accepted(*matches):
+    """(video ID, score) of the best of `matches` if it's good enough to insert, else (None, score)."""
+    candidate, score = max(matches, key=lambda match: match[1] if match[0] is not None else -1.0)
+    if candidate is None or score < MATCH_ACCEPT_SCORE:
+        return None, score
+    return candidate["video_id"], score
+
+
+class SearchResolver:
+    """Resolves tracks to video IDs on a bounded thread pool, yielding results in playlist order.
+
+    Each search returns a few candidates that the matcher scores against the
+    track; a doubtful best match gets one fallback search, and a match still too
+    poor to trust is treated as no result rather than inserted.
+
+    httplib2 connections are not thread-safe, so when `credentials` are given each
+    worker thread executes its searches over its own authorized connection.
+    Without credentials searches run one at a time on the service's own connection.
+    Each search is paid for through `quota`, which raises QuotaDeferred once the quota is used up,
+    and `on_rate_limit(seconds)` is told whenever the rate limiter held a search back.
+    Transient API errors are retried with backoff; CircuitOpen is left to the caller.
+    A track another transfer is already looking up waits for that lookup instead
+    of searching too.
+    """
+
+    def __init__(self, youtube, credentials=None, concurrency=SEARCH_CONCURRENCY, rate_limiter=search_rate_limiter,
+                 quota=None, on_rate_limit=None):
+        self.youtube = youtube
+        self.quota = quota
+        self.on_rate_limit = on_rate_limit
+        self.credentials = credentials
+        self.concurrency = concurrency if credentials is not None else 1
+        self.rate_limiter = rate_limiter
+        self._local = threading.local()
+
+    def _http(self):
+        if self.credentials is None:
+            return None
+        if not hasattr(self._local, "http"):
+            self._local.http = authorized_http(self.credentials)
+        return self._local.http
+
+    def search(self, query):
+        """Run one rate-limited search and return its candidates, with their durations."""
+        if self.quota is not None:
+            self.quota.charge(SEARCH_COST)
+        waited = self.rate_limiter.acquire()
+        if waited and self.on_rate_limit is not None:
+            self.on_rate_limit(waited)
+        request = search_request(self.youtube, query)
+        with timed("youtube_search"):
+            candidates = search_candidates(call("youtube", "search.list", lambda: request.execute(http=self._http())))
+            if candidates:
+                if self.quota is not None:
+                    self.quota.charge(LIST_COST)
+                request = details_request(self.youtube, candidates)
+                add_durations(candidates, call("youtube", "videos.list", lambda: request.execute(http=self._http())))
+        return candidates
+
+    def match(self, track, query):
+        """(video ID or None, score) for `track`, searching a second way if the first match is doubtful."""
+        match = best_candidate(track, self.search(query))
+        if not needs_fallback(match):
+            return match[0]["video_id"], match[1]
+        return accepted(match, best_candidate(track, self.search(fallback_query(track))))
+
+    def lookup(self, track, query):
+        """(video ID, score, None) for `track`, saved to the match cache; (None, None, error) if YouTube refused."""
+        while True:
+            try:
+                video_id, score = self.match(track, query)
+                break
+            except HttpError as e:
+                if self.quota is None or not is_quota_error(e):
+                    return None, None, e
+                # The next charge raises QuotaDeferred, parking the job until the reset
+                self.quota.exhausted()
+        match_cache.put(track, video_id)
+        return video_id, score, None
+
+    def resolve(self, index, track):
+        query = track_query(track)
+        # Popular tracks were usually resolved already, possibly by another user
+        cached, video_id = match_cache.get(track)
+        if cached:
+            return Resolution(index, track, query, video_id, cached=True)
+        (video_id, score, error), shared = search_flights.do(track_keys(track)[-1], lambda: self.lookup(track, query))
+        if shared:
+            searches_coalesced.inc()
+        return Resolution(index, track, query, video_id, error=error, score=score)
+
+    def resolve_all(self, entries):
+        """Yield a Resolution for each (index, track) in `entries`, in input order.
+
+        At most a few batches per worker are kept in flight, so `entries` can be a
+        lazy iterator and results start flowing before the input is exhausted.
+        """
+        max_in_flight = self.concurrency * 4
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="search") as executor:
+            pending = deque()
+            for index, track in entries:
+                pending.append(executor.submit(self.resolve, index, track))
+                if len(pending) >= max_in_flight:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+class AsyncSearchResolver:
+    """SearchResolver for the asyncio engine: each search is a task on the event loop, over `apis`.
+
+    Searches, caching, quota and rate limiting behave exactly as in SearchResolver,
+    with at most `concurrency` searches of the transfer in flight.
+    """
+
+    def __init__(self, apis, concurrency=SEARCH_CONCURRENCY, rate_limiter=search_rate_limiter,
+                 quota=None, on_rate_limit=None):
+        self.apis = apis
+        self.quota = quota
+        self.on_rate_limit = on_rate_limit
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter
+
+    async def search(self, query):
+        if self.quota is not None:
+            await self.quota.charge_async(SEARCH_COST)
+        waited = await self.rate_limiter.acquire_async()
+        if waited and self.on_rate_limit is not None:
+            # It may publish a job event, which writes to the state backend
+            await asyncio.to_thread(self.on_rate_limit, waited)
+        request = search_request(self.apis.youtube, query)
+        with timed("youtube_search"):
+            candidates = search_candidates(
+                await call_async("youtube", "search.list", lambda: self.apis.youtube_execute(request)))
+            if candidates:
+                if self.quota is not None:
+                    await self.quota.charge_async(LIST_COST)
+                request = details_request(self.apis.youtube, candidates)
+                add_durations(candidates, await call_async("youtube", "videos.list",
+                                                           lambda: self.apis.youtube_execute(request)))
+        return candidates
+
+    async def match(self, track, query):
+        match = best_candidate(track, await self.search(query))
+        if not needs_fallback(match):
+            return match[0]["video_id"], match[1]
+        return accepted(match, best_candidate(track, await self.search(fallback_query(track))))
+
+    async def lookup(self, track, query):
+        while True:
+            try:
+                video_id, score = await self.match(track, query)
+                break
+            except HttpError as e:
+                if self.quota is None or not is_quota_error(e):
+                    return None, None, e
+                await asyncio.to_thread(self.quota.exhausted)
+        await asyncio.to_thread(match_cache.put, track, video_id)
+        return video_id, score, None
+
+    async def resolve(self, index, track):
+        query = track_query(track)
+        # The cache is SQLite, so it's read and written off the event loop
+        cached, video_id = await asyncio.to_thread(match_cache.get, track)
+        if cached:
+            return Resolution(index, track, query, video_id, cached=True)
+        (video_id, score, error), shared = await search_flights.do_async(
+            track_keys(track)[-1], lambda: self.lookup(track, query))
+        if shared:
+            searches_coalesced.inc()
+        return Resolution(index, track, query, video_id, error=error, score=score)
+
+    async def resolve_all(self, entries):
+        """Yield a Resolution for each (index, track) of the async iterator `entries`, in input order."""
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def resolve(index, track):
+            async with slots:
+                return await self.resolve(index, track)
+
+        max_in_flight = self.concurrency * 4
+        pending = deque()
+        try:
+            async for index, track in entries:
+                pending.append(asyncio.ensure_future(resolve(index, track)))
+                if len(pending) >= max_in_flight:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
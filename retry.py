@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from googleapiclient.errors import HttpError
+
+from metrics import api_request_seconds, api_retries, registry
+
+logger = logging.getLogger(__name__)
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 5))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 1))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 60))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 10))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", 30))
+
+TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
+# YouTube reports per-user rate limiting as a 403, unlike the daily quota which doesn't come back by retrying
+RATE_LIMIT_REASONS = (b"rateLimitExceeded", b"userRateLimitExceeded")
+API_NAMES = {"spotify": "Spotify", "youtube": "YouTube"}
+_network_errors = None
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an API whose circuit breaker is open until `resume_at`."""
+
+    def __init__(self, api, resume_at):
+        super().__init__(f"{API_NAMES[api]} API is unavailable, not calling it again before "
+                         f"{time.strftime('%H:%M:%S', time.localtime(resume_at))}")
+        self.api = api
+        self.resume_at = resume_at
+
+
+def network_errors():
+    """Connection and timeout errors of the HTTP libraries the API clients use."""
+    global _network_errors
+    if _network_errors is None:
+        # Imported here rather than at startup, like the clients themselves
+        import httplib2
+        import requests
+        _network_errors = (ConnectionError, TimeoutError, socket.timeout, requests.ConnectionError,
+                           requests.Timeout, httplib2.HttpLib2Error)
+    return _network_errors
+
+
+def is_transient(error):
+    """Whether `error` is likely to go away if the same call is made again a little later."""
+    from spotipy.exceptions import SpotifyException
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        return status in TRANSIENT_STATUSES or (
+            status == 403 and any(reason in (error.content or b"") for reason in RATE_LIMIT_REASONS))
+    if isinstance(error, SpotifyException):
+        return error.http_status in TRANSIENT_STATUSES
+    return isinstance(error, network_errors())
+
+
+def retry_after(error):
+    """Seconds the server asked us to wait via Retry-After, or None."""
+    from spotipy.exceptions import SpotifyException
+    if isinstance(error, HttpError):
+        value = error.resp.get("retry-after")
+    elif isinstance(error, SpotifyException):
+        value = (error.headers or {}).get("Retry-After")
+    else:
+        return None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, server_delay=None):
+    """Seconds to wait before retry number `attempt` (1-based), with full jitter.
+
+    A Retry-After from the server wins over the exponential schedule; a little
+    jitter is still added so clients told the same time don't all return at once.
+    """
+    if server_delay is not None:
+        return server_delay + random.uniform(0, RETRY_BASE_DELAY)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """Stops calling an API after `failure_threshold` transient failures in a row.
+
+    While open, calls raise CircuitOpen straight away. After `reset_seconds` a
+    single trial call is let through: success closes the breaker, another
+    failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_until = None
+        self.trips = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_until is None:
+                return "closed"
+            return "open" if time.time() < self.opened_until else "half_open"
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_until is None:
+                return
+            if time.time() < self.opened_until or self._trial_in_flight:
+                raise CircuitOpen(self.name, max(self.opened_until, time.time() + 1))
+            self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_until = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        opened = False
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or self.failures >= self.failure_threshold:
+                opened = self._open(time.time() + self.reset_seconds)
+        if opened:
+            logger.warning(f"Circuit breaker for {self.name} opened")
+
+    def open_until(self, resume_at):
+        """Open the breaker until `resume_at`, e.g. when the server asked for a long pause."""
+        with self._lock:
+            opened = self._open(max(resume_at, self.opened_until or 0))
+        if opened:
+            logger.warning(f"Circuit breaker for {self.name} opened")
+
+    def _open(self, resume_at):
+        """Returns whether the breaker was closed until now; the caller holds self._lock and logs after releasing it."""
+        opened = self.opened_until is None
+        if opened:
+            self.trips += 1
+        self.opened_until = resume_at
+        self._trial_in_flight = False
+        return opened
+
+    def stats(self):
+        state = self.state
+        with self._lock:
+            return {
+                "state": state,
+                "consecutive_failures": self.failures,
+                "opened_until": self.opened_until,
+                "trips": self.trips,
+            }
+
+
+circuit_breakers = {
+    "spotify": CircuitBreaker("spotify"),
+    "youtube": CircuitBreaker("youtube"),
+}
+registry.gauge("circuit_breaker_open", "1 while an API's circuit breaker is open or half-open.", ("api",),
+               function=lambda: {(api,): int(breaker.state != "closed") for api, breaker in circuit_breakers.items()})
+
+
+def call(api, operation, request, max_attempts=RETRY_MAX_ATTEMPTS):
+    """Run `request()` against `api` ("spotify" or "youtube"), retrying transient failures.
+
+    `operation` names the endpoint in the request metrics.
+
+    Retries back off exponentially with jitter and honor Retry-After; a server
+    asking for a longer pause than RETRY_MAX_DELAY opens the API's circuit
+    breaker instead of holding the caller. Raises CircuitOpen while the breaker
+    is open, and the last error once `max_attempts` are used up.
+    """
+    breaker = circuit_breakers[api]
+    attempt = 0
+    while True:
+        breaker.before_call()
+        started = time.perf_counter()
+        try:
+            result = request()
+        except Exception as e:
+            attempt += 1
+            delay = _failed(api, operation, breaker, e, attempt, max_attempts, started)
+            if delay:
+                time.sleep(delay)
+        else:
+            _succeeded(api, operation, breaker, started)
+            return result
+
+
+async def call_async(api, operation, request, max_attempts=RETRY_MAX_ATTEMPTS):
+    """`call` for coroutines: awaits `request()` and sleeps between retries without blocking the event loop."""
+    breaker = circuit_breakers[api]
+    attempt = 0
+    while True:
+        breaker.before_call()
+        started = time.perf_counter()
+        try:
+            result = await request()
+        except Exception as e:
+            attempt += 1
+            delay = _failed(api, operation, breaker, e, attempt, max_attempts, started)
+            if delay:
+                await asyncio.sleep(delay)
+        else:
+            _succeeded(api, operation, breaker, started)
+            return result
+
+
+def _succeeded(api, operation, breaker, started):
+    api_request_seconds.observe(time.perf_counter() - started, api=api, operation=operation, outcome="ok")
+    breaker.record_success()
+
+
+def _failed(api, operation, breaker, error, attempt, max_attempts, started):
+    """Seconds to wait before retrying after `error` (0 to go straight to the breaker), or re-raise it."""
+    transient = is_transient(error)
+    api_request_seconds.observe(time.perf_counter() - started, api=api, operation=operation,
+                                outcome="transient_error" if transient else "error")
+    if not transient:
+        # The API answered, it just didn't like the request
+        breaker.record_success()
+        raise error
+    breaker.record_failure()
+    if attempt >= max_attempts:
+        raise error
+    if breaker.state == "open":
+        # This failure tripped the breaker; fail fast rather than sleep through a retry
+        return 0
+    server_delay = retry_after(error)
+    if server_delay is not None and server_delay > RETRY_MAX_DELAY:
+        breaker.open_until(time.time() + server_delay)
+        return 0
+    delay = backoff_delay(attempt, server_delay)
+    api_retries.inc(api=api)
+    logger.warning(f"{api} call failed ({error}), retry {attempt}/{max_attempts - 1} in {delay:.1f}s")
+    return delay
@@ -0,0 +1,77 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one: the first caller makes it, the others wait for its result.
+
+    Threads and coroutines on the event loop are coalesced separately, as a
+    thread can't await a task and a coroutine mustn't block on a thread. Only
+    results are shared: if the call raises or is cancelled, each waiter makes
+    the call again itself, one of them first. Nothing is kept once a call
+    finishes, so caching results is up to the caller.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        # Only ever touched from the event loop's thread
+        self._async_calls = {}
+
+    def do(self, key, function):
+        """(function(), shared): `shared` is True when another thread's call was waited on instead."""
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                if future is None:
+                    future = self._calls[key] = Future()
+                    break
+            try:
+                return future.result(), True
+            except BaseException:
+                if not future.done():
+                    # Interrupted while waiting, not failed by the call it waited on
+                    raise
+                continue
+        try:
+            result = function()
+            future.set_result(result)
+            return result, False
+        finally:
+            # Waiters retry if the call raised anything at all, KeyboardInterrupt and SystemExit included
+            with self._lock:
+                del self._calls[key]
+            if not future.done():
+                future.cancel()
+
+    async def do_async(self, key, coroutine_function):
+        """`do` for coroutines: (await coroutine_function(), shared)."""
+        while True:
+            future = self._async_calls.get(key)
+            if future is None:
+                break
+            try:
+                # Shielded, so a waiter being cancelled doesn't cancel everyone else's result
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    # This waiter was cancelled, not the call it waited on
+                    raise
+            except Exception:
+                pass
+        future = self._async_calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await coroutine_function()
+            future.set_result(result)
+            return result, False
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Waiters retry rather than read it; mark it retrieved so asyncio doesn't warn when nobody waited
+            future.exception()
+            raise
+        finally:
+            del self._async_calls[key]
@@ -0,0 +1,343 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from cachelib import BaseCache
+
+logger = logging.getLogger(__name__)
+
+STATE_DB = os.path.join("data", "state.db")
+
+
+class SQLiteConnections:
+    """Connections to a SQLite file in WAL mode, one per thread since sqlite3 connections can't be shared.
+
+    Connections are in autocommit mode; `transaction()` groups statements.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.get().execute("PRAGMA journal_mode=WAL")
+
+    def get(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.get()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+class StateBackend:
+    """Key/value and list storage for state every worker and instance has to agree on.
+
+    Values are anything JSON can hold. Keys set with a `ttl` (in seconds) disappear
+    once it runs out; list items expire one by one. Backends with `shared = False`
+    keep state in this process only.
+    """
+
+    shared = True
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl=None):
+        """Set `key` only if it doesn't exist yet; return whether it was set."""
+        raise NotImplementedError
+
+    def incr(self, key, amount=1, ttl=None):
+        """Add `amount` to the integer at `key` (0 if unset) and return the new value; `ttl` is renewed."""
+        raise NotImplementedError
+
+    def delete(self, *keys):
+        raise NotImplementedError
+
+    def rpush(self, key, value, max_len=None, ttl=None):
+        """Append to the list at `key`, dropping the oldest items past `max_len`."""
+        raise NotImplementedError
+
+    def lrange(self, key, start=0):
+        """Items of the list at `key` in order, skipping the first `start`."""
+        raise NotImplementedError
+
+
+class MemoryStateBackend(StateBackend):
+    """Process-local backend for development, tests and single-worker deployments."""
+
+    shared = False
+
+    def __init__(self):
+        self._values = {}
+        self._lists = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key, now):
+        entry = self._values.get(key)
+        if entry and entry[1] is not None and entry[1] <= now:
+            del self._values[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key, time.time())
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        now = time.time()
+        with self._lock:
+            if self._live(key, now):
+                return False
+            self._values[key] = (value, now + ttl if ttl else None)
+            return True
+
+    def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        with self._lock:
+            entry = self._live(key, now)
+            value = (entry[0] if entry else 0) + amount
+            self._values[key] = (value, now + ttl if ttl else None)
+            return value
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+                self._lists.pop(key, None)
+
+    def rpush(self, key, value, max_len=None, ttl=None):
+        with self._lock:
+            items = self._lists.get(key)
+            if items is None or items.maxlen != max_len:
+                items = self._lists[key] = deque(items or (), maxlen=max_len)
+            items.append((value, time.time() + ttl if ttl else None))
+
+    def lrange(self, key, start=0):
+        now = time.time()
+        with self._lock:
+            values = [value for value, expires_at in self._lists.get(key, ()) if expires_at is None or expires_at > now]
+        return values[start:]
+
+
+class SQLiteStateBackend(StateBackend):
+    """Backend in a SQLite file in WAL mode, shared by every worker on the host (or on a shared volume).
+
+    Expired rows are swept and the WAL checkpointed every `sweep_every` writes.
+    """
+
+    def __init__(self, path=STATE_DB, sweep_every=1000):
+        self.path = path
+        self.sweep_every = sweep_every
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        self._db = SQLiteConnections(path)
+        self._db.get().executescript(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL);"
+            "CREATE TABLE IF NOT EXISTS lists ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL);"
+            "CREATE INDEX IF NOT EXISTS lists_key ON lists (key, id);"
+        )
+
+    @contextmanager
+    def _transaction(self):
+        with self._db.transaction() as conn:
+            yield conn
+        self._maybe_sweep()
+
+    def get(self, key):
+        row = self._db.get().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + ttl if ttl else None)
+            )
+
+    def add(self, key, value, ttl=None):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM kv WHERE key = ? AND expires_at <= ?", (key, now))
+            return conn.execute(
+                "INSERT OR IGNORE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), now + ttl if ttl else None)
+            ).rowcount == 1
+
+    def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM kv WHERE key = ? AND expires_at <= ?", (key, now))
+            row = conn.execute(
+                "INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + ?, expires_at = excluded.expires_at "
+                "RETURNING value",
+                (key, str(amount), now + ttl if ttl else None, amount)
+            ).fetchone()
+        return int(row[0])
+
+    def delete(self, *keys):
+        with self._transaction() as conn:
+            for key in keys:
+                conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+                conn.execute("DELETE FROM lists WHERE key = ?", (key,))
+
+    def rpush(self, key, value, max_len=None, ttl=None):
+        with self._transaction() as conn:
+            item_id = conn.execute(
+                "INSERT INTO lists (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + ttl if ttl else None)
+            ).lastrowid
+            if max_len:
+                conn.execute(
+                    "DELETE FROM lists WHERE key = ? AND id <= "
+                    "(SELECT id FROM lists WHERE key = ? AND id <= ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                    (key, key, item_id, max_len)
+                )
+
+    def lrange(self, key, start=0):
+        rows = self._db.get().execute(
+            "SELECT value FROM lists WHERE key = ? AND (expires_at IS NULL OR expires_at > ?) "
+            "ORDER BY id LIMIT -1 OFFSET ?",
+            (key, time.time(), start)
+        )
+        return [json.loads(value) for value, in rows]
+
+    def sweep(self):
+        """Delete expired rows and shrink the WAL."""
+        now = time.time()
+        with self._db.transaction() as conn:
+            expired = conn.execute("DELETE FROM kv WHERE expires_at <= ?", (now,)).rowcount
+            expired += conn.execute("DELETE FROM lists WHERE expires_at <= ?", (now,)).rowcount
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        logger.info(f"Swept state store, dropped {expired} expired entries")
+
+    def _maybe_sweep(self):
+        with self._writes_lock:
+            self._writes += 1
+            if self._writes % self.sweep_every:
+                return
+        try:
+            self.sweep()
+        except Exception as e:
+            logger.error(f"Error sweeping state store: {e}")
+
+
+class RedisStateBackend(StateBackend):
+    """Backend on a Redis server, shared by every instance behind the load balancer.
+
+    Needs the `redis` package. List items share the TTL of their list.
+    """
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.redis.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.redis.set(key, json.dumps(value), ex=int(ttl) if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        return bool(self.redis.set(key, json.dumps(value), ex=int(ttl) if ttl else None, nx=True))
+
+    def incr(self, key, amount=1, ttl=None):
+        pipeline = self.redis.pipeline()
+        pipeline.incrby(key, amount)
+        if ttl:
+            pipeline.expire(key, int(ttl))
+        return pipeline.execute()[0]
+
+    def delete(self, *keys):
+        if keys:
+            self.redis.delete(*keys)
+
+    def rpush(self, key, value, max_len=None, ttl=None):
+        pipeline = self.redis.pipeline()
+        pipeline.rpush(key, json.dumps(value))
+        if max_len:
+            pipeline.ltrim(key, -max_len, -1)
+        if ttl:
+            pipeline.expire(key, int(ttl))
+        pipeline.execute()
+
+    def lrange(self, key, start=0):
+        return [json.loads(value) for value in self.redis.lrange(key, start, -1)]
+
+
+def create_backend(spec):
+    """Backend for a STATE_BACKEND value: "memory", "sqlite", "sqlite:///<path>" or a redis:// URL."""
+    if spec == "memory":
+        return MemoryStateBackend()
+    if spec == "sqlite":
+        return SQLiteStateBackend()
+    if spec.startswith("sqlite:///"):
+        return SQLiteStateBackend(spec[len("sqlite:///"):])
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStateBackend(spec)
+    raise ValueError(f"Unknown STATE_BACKEND: {spec}")
+
+
+class BackendCache(BaseCache):
+    """cachelib view of a StateBackend, so Flask-Session can keep sessions in it."""
+
+    def __init__(self, backend, default_timeout=300):
+        super().__init__(default_timeout)
+        self.backend = backend
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        self.backend.set(key, value, ttl=timeout or None)
+        return True
+
+    def add(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        return self.backend.add(key, value, ttl=timeout or None)
+
+    def delete(self, key):
+        self.backend.delete(key)
+        return True
+
+    def has(self, key):
+        return self.backend.get(key) is not None
+
+
+state_backend = create_backend(os.getenv("STATE_BACKEND", "sqlite"))
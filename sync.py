@@ -0,0 +1,150 @@
+import logging
+import os
+import sqlite3
+import time
+
+from googleapiclient.errors import HttpError
+
+from quota import LIST_COST
+from retry import call, call_async
+from state import state_backend
+
+logger = logging.getLogger(__name__)
+
+# Store migrated into the state backend on startup
+LEGACY_SYNC_DB = os.path.join("data", "playlist_sync.db")
+
+
+class SyncMapping:
+    __slots__ = ("youtube_playlist_id", "snapshot_id", "synced_at")
+
+    def __init__(self, youtube_playlist_id, snapshot_id, synced_at):
+        self.youtube_playlist_id = youtube_playlist_id
+        self.snapshot_id = snapshot_id
+        self.synced_at = synced_at
+
+
+class SyncStore:
+    """Which YouTube playlist each Spotify playlist was copied to, and what it contains.
+
+    Kept in the state backend, so a playlist syncs the same way from any instance.
+    `snapshot_id` is only set once a sync finishes, so an interrupted run is
+    never mistaken for an up-to-date one.
+    """
+
+    def __init__(self, backend=state_backend):
+        self.backend = backend
+
+    def get(self, spotify_user_id, playlist_id):
+        entry = self.backend.get(f"sync:{spotify_user_id}:{playlist_id}")
+        return SyncMapping(**entry) if entry else None
+
+    def _set(self, spotify_user_id, playlist_id, youtube_playlist_id, snapshot_id=None, synced_at=None):
+        self.backend.set(f"sync:{spotify_user_id}:{playlist_id}", {
+            "youtube_playlist_id": youtube_playlist_id,
+            "snapshot_id": snapshot_id,
+            "synced_at": synced_at,
+        })
+
+    def start(self, spotify_user_id, playlist_id, youtube_playlist_id):
+        """Point `playlist_id` at a YouTube playlist; forgets recorded items if it changed."""
+        # Only the job syncing `playlist_id` writes its entries, so read-then-write can't race
+        mapping = self.get(spotify_user_id, playlist_id)
+        if mapping and mapping.youtube_playlist_id == youtube_playlist_id:
+            self._set(spotify_user_id, playlist_id, youtube_playlist_id, synced_at=mapping.synced_at)
+            return
+        self.backend.delete(f"sync_items:{spotify_user_id}:{playlist_id}")
+        self._set(spotify_user_id, playlist_id, youtube_playlist_id)
+
+    def items(self, spotify_user_id, playlist_id):
+        """Map of track key to the video inserted for it."""
+        return dict(self.backend.lrange(f"sync_items:{spotify_user_id}:{playlist_id}"))
+
+    def record_item(self, spotify_user_id, playlist_id, track_key, video_id):
+        self.backend.rpush(f"sync_items:{spotify_user_id}:{playlist_id}", [track_key, video_id])
+
+    def complete(self, spotify_user_id, playlist_id, snapshot_id):
+        mapping = self.get(spotify_user_id, playlist_id)
+        if mapping:
+            self._set(spotify_user_id, playlist_id, mapping.youtube_playlist_id, snapshot_id, time.time())
+
+    def import_legacy_db(self, path=LEGACY_SYNC_DB):
+        """One-time migration of playlist mappings and their items from the old per-host SQLite file."""
+        if not os.path.exists(path):
+            return
+        try:
+            conn = sqlite3.connect(path)
+            try:
+                mappings = conn.execute(
+                    "SELECT spotify_user_id, spotify_playlist_id, youtube_playlist_id, snapshot_id, synced_at "
+                    "FROM playlist_sync"
+                ).fetchall()
+                items = conn.execute(
+                    "SELECT spotify_user_id, spotify_playlist_id, track_key, video_id FROM sync_items"
+                ).fetchall()
+            finally:
+                conn.close()
+            for row in mappings:
+                self._set(*row)
+            for row in items:
+                self.record_item(*row)
+            os.replace(path, path + ".migrated")
+            logger.info(f"Migrated {len(mappings)} synced playlists from {path}")
+        except Exception as e:
+            logger.error(f"Error migrating playlist sync database {path}: {e}")
+
+
+def _list_request(youtube, youtube_playlist_id, page_token):
+    return youtube.playlistItems().list(
+        part="snippet",
+        playlistId=youtube_playlist_id,
+        maxResults=50,
+        pageToken=page_token,
+        fields="nextPageToken,items(snippet(resourceId(videoId)))"
+    )
+
+
+def fetch_playlist_videos(youtube, youtube_playlist_id, quota=None):
+    """Video IDs already in a YouTube playlist in playlist order, or None if the playlist is gone."""
+    videos = []
+    page_token = None
+    while True:
+        if quota is not None:
+            quota.charge(LIST_COST)
+        try:
+            request = _list_request(youtube, youtube_playlist_id, page_token)
+            response = call("youtube", "playlistItems.list", request.execute)
+        except HttpError as e:
+            if e.resp.status == 404:
+                logger.info(f"YouTube playlist {youtube_playlist_id} no longer exists")
+                return None
+            raise
+        videos.extend(item["snippet"]["resourceId"]["videoId"] for item in response.get("items", []))
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return videos
+
+
+async def fetch_playlist_videos_async(apis, youtube_playlist_id, quota=None):
+    """fetch_playlist_videos for the asyncio engine, over `apis`."""
+    videos = []
+    page_token = None
+    while True:
+        if quota is not None:
+            await quota.charge_async(LIST_COST)
+        try:
+            request = _list_request(apis.youtube, youtube_playlist_id, page_token)
+            response = await call_async("youtube", "playlistItems.list", lambda: apis.youtube_execute(request))
+        except HttpError as e:
+            if e.resp.status == 404:
+                logger.info(f"YouTube playlist {youtube_playlist_id} no longer exists")
+                return None
+            raise
+        videos.extend(item["snippet"]["resourceId"]["videoId"] for item in response.get("items", []))
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return videos
+
+
+sync_store = SyncStore()
+sync_store.import_legacy_db()
@@ -0,0 +1,88 @@
+import pytest
+
+from matcher import MATCH_MIN_SCORE, best_candidate, fallback_query, parse_duration, score_candidates
+from tracks import Track
+
+
+def candidate(title, channel, duration_ms=None):
+    return {"title": title, "channel": channel, "duration_ms": duration_ms}
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("PT3M25S", 205000),
+    ("PT45S", 45000),
+    ("PT1H2M3S", 3723000),
+    ("P1DT1S", 86401000),
+    ("PT10M", 600000),
+])
+def test_parse_duration(value, expected):
+    assert parse_duration(value) == expected
+
+
+@pytest.mark.parametrize("value", [None, "", "P", "PT", "3:25", "PT3M25"])
+def test_parse_duration_rejects_other_formats(value):
+    assert parse_duration(value) is None
+
+
+def test_official_upload_scores_above_the_fallback_threshold():
+    track = Track("1", None, "Bohemian Rhapsody - Remastered 2011", ("Queen",), 354000)
+    [score] = score_candidates(track, [candidate("Queen – Bohemian Rhapsody (Official Video)", "Queen Official", 355000)])
+    assert score >= MATCH_MIN_SCORE
+
+
+def test_covers_and_live_versions_are_marked_down():
+    track = Track("1", None, "Hallelujah", ("Jeff Buckley",), 414000)
+    studio, cover, live = score_candidates(track, [
+        candidate("Jeff Buckley - Hallelujah", "JeffBuckleyVEVO", 414000),
+        candidate("Hallelujah (Jeff Buckley cover)", "Some Singer", 414000),
+        candidate("Jeff Buckley - Hallelujah (Live)", "JeffBuckleyVEVO", 414000),
+    ])
+    assert studio > cover and studio > live
+
+
+def test_variant_words_in_the_track_name_are_not_penalised():
+    track = Track("1", None, "Hallelujah - Live", ("Jeff Buckley",), 414000)
+    [score] = score_candidates(track, [candidate("Jeff Buckley - Hallelujah (Live)", "JeffBuckleyVEVO", 414000)])
+    assert score >= MATCH_MIN_SCORE
+
+
+def test_duration_mismatch_lowers_the_score():
+    track = Track("1", None, "Song", ("Artist",), 200000)
+    close, far, unknown = score_candidates(track, [
+        candidate("Artist - Song", "Artist", 201000),
+        candidate("Artist - Song", "Artist", 600000),
+        candidate("Artist - Song", "Artist"),
+    ])
+    assert close > unknown > far
+
+
+def test_topic_channel_earns_a_bonus():
+    track = Track("1", None, "Song", ("Artist",), 200000)
+    plain, topic = score_candidates(track, [
+        candidate("Song", "Uploader", 200000),
+        candidate("Song", "Artist - Topic", 200000),
+    ])
+    assert topic > plain
+
+
+def test_scores_stay_between_zero_and_one():
+    track = Track("1", None, "Song", ("Artist",), 200000)
+    scores = score_candidates(track, [
+        candidate("Artist - Song", "Artist - Topic", 200000),
+        candidate("karaoke remix cover", "Nobody", 10),
+    ])
+    assert all(0.0 <= score <= 1.0 for score in scores)
+    assert scores[0] == 1.0 and scores[1] == 0.0
+
+
+def test_best_candidate_prefers_the_earliest_on_ties():
+    track = Track("1", None, "Song", ("Artist",), 200000)
+    first = candidate("Artist - Song", "Artist", 200000)
+    second = candidate("Artist - Song", "Artist", 200000)
+    assert best_candidate(track, [first, second])[0] is first
+    assert best_candidate(track, []) == (None, 0.0)
+
+
+def test_fallback_query_uses_the_isrc_when_there_is_one():
+    assert fallback_query(Track("1", "USUM71703861", "Song", ("Artist",), 1)) == "USUM71703861"
+    assert fallback_query(Track("1", None, "Song", ("Artist",), 1)) == "Song Artist topic"
@@ -0,0 +1,136 @@
+import time
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import playlist_inserter
+from playlist_inserter import PlaylistInserter
+from resolver import Resolution
+from retry import CircuitBreaker, CircuitOpen, circuit_breakers
+from tracks import Track
+
+
+def http_error(status):
+    return HttpError(httplib2.Response({"status": status}), b"")
+
+
+class FakeRequest:
+    def __init__(self, body, execute=None):
+        self.body = body
+        self._execute = execute
+
+    def execute(self):
+        return self._execute(self.body)
+
+
+class FakeBatch:
+    def __init__(self, youtube, callback):
+        self.youtube = youtube
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.youtube.batches += 1
+        for request_id, request in self.requests:
+            error = self.youtube.failures.pop(request_id, None)
+            if error is not None:
+                self.callback(request_id, None, error)
+                continue
+            video_id = request.body["snippet"]["resourceId"]["videoId"]
+            self.youtube.videos.append(video_id)
+            snippet = {"position": len(self.youtube.videos) - 1, "resourceId": request.body["snippet"]["resourceId"]}
+            self.callback(request_id, {"id": f"item{len(self.youtube.videos)}", "snippet": snippet}, None)
+
+
+class FakeYouTube:
+    """Just enough of the YouTube service for batched playlist inserts."""
+
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.videos = []
+        self.batches = 0
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+    def playlistItems(self):
+        return self
+
+    def insert(self, part, fields, body):
+        return FakeRequest(body)
+
+    def update(self, part, fields, body):
+        return FakeRequest(body, self._move)
+
+    def _move(self, body):
+        video_id = body["snippet"]["resourceId"]["videoId"]
+        self.videos.remove(video_id)
+        self.videos.insert(body["snippet"]["position"], video_id)
+        return {"id": body["id"]}
+
+
+def resolutions(count):
+    return [Resolution(index, Track(f"t{index}", None, f"Song {index}", ("Artist",), 200000), f"Song {index}",
+                       f"video{index}")
+            for index in range(count)]
+
+
+@pytest.fixture
+def youtube_breaker(monkeypatch):
+    breaker = CircuitBreaker("youtube")
+    monkeypatch.setitem(circuit_breakers, "youtube", breaker)
+    monkeypatch.setattr(playlist_inserter.time, "sleep", lambda seconds: None)
+    return breaker
+
+
+def test_inserts_in_batches_and_reports_in_order(youtube_breaker):
+    youtube = FakeYouTube()
+    reported = []
+    inserter = PlaylistInserter(youtube, "PL", lambda resolution, error: reported.append((resolution.index, error)),
+                                batch_size=2)
+    for resolution in resolutions(5):
+        inserter.add(resolution)
+    inserter.flush()
+    assert youtube.videos == [f"video{index}" for index in range(5)]
+    assert youtube.batches == 3
+    assert reported == [(index, None) for index in range(5)]
+
+
+def test_retries_retryable_failures(youtube_breaker):
+    youtube = FakeYouTube(failures={"1": http_error(503)})
+    reported = []
+    inserter = PlaylistInserter(youtube, "PL", lambda resolution, error: reported.append((resolution.index, error)))
+    for resolution in resolutions(3):
+        inserter.add(resolution)
+    inserter.flush()
+    assert youtube.videos == ["video0", "video1", "video2"]
+    assert reported == [(0, None), (1, None), (2, None)]
+
+
+def test_circuit_opening_mid_batch_reports_what_was_inserted(youtube_breaker, monkeypatch):
+    # The first round inserts two items and fails one; the circuit opens while backing off before the retry
+    monkeypatch.setattr(playlist_inserter.time, "sleep", lambda seconds: youtube_breaker.open_until(time.time() + 60))
+    youtube = FakeYouTube(failures={"1": http_error(503)})
+    reported = []
+    inserter = PlaylistInserter(youtube, "PL", lambda resolution, error: reported.append((resolution.index, error)))
+    for resolution in resolutions(3):
+        inserter.add(resolution)
+    with pytest.raises(CircuitOpen):
+        inserter.flush()
+    assert [index for index, error in reported if error is None] == [0, 2]
+    assert [index for index, error in reported if error is not None] == [1]
+
+
+def test_circuit_open_before_anything_was_sent_reports_nothing(youtube_breaker):
+    youtube_breaker.open_until(time.time() + 60)
+    reported = []
+    inserter = PlaylistInserter(FakeYouTube(), "PL", lambda resolution, error: reported.append(resolution.index))
+    for resolution in resolutions(2):
+        inserter.add(resolution)
+    with pytest.raises(CircuitOpen):
+        inserter.flush()
+    assert reported == []
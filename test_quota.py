@@ -0,0 +1,89 @@
+import pytest
+
+from quota import (INSERT_COST, LIST_COST, PLAYLIST_COST, SEARCH_COST, SEARCH_FALLBACK_SHARE, QuotaAccountant,
+                   QuotaDeferred, estimate_transfer_cost)
+from state import MemoryStateBackend
+
+
+class FakeJob:
+    def __init__(self, job_id):
+        self.id = job_id
+        self.quota_estimate = None
+        self.quota_units = 0
+
+    def add_quota_units(self, units):
+        self.quota_units += units
+
+
+@pytest.fixture
+def accountant():
+    return QuotaAccountant(MemoryStateBackend(), daily_budget=1000)
+
+
+def test_estimate_covers_the_playlist_inserts_and_searches():
+    searches = round(10 * (1 + SEARCH_FALLBACK_SHARE))
+    assert estimate_transfer_cost(10) == PLAYLIST_COST + 10 * INSERT_COST + searches * (SEARCH_COST + LIST_COST)
+
+
+def test_cached_matches_need_no_search():
+    assert estimate_transfer_cost(10, cache_hit_ratio=1.0) == PLAYLIST_COST + 10 * INSERT_COST
+    assert estimate_transfer_cost(10) > estimate_transfer_cost(10, cache_hit_ratio=0.5) > estimate_transfer_cost(
+        10, cache_hit_ratio=1.0)
+
+
+def test_empty_playlist_costs_only_the_playlist():
+    assert estimate_transfer_cost(0) == PLAYLIST_COST
+
+
+def test_charges_draw_down_the_daily_budget(accountant):
+    job = FakeJob("a")
+    accountant.charge(600, job)
+    assert accountant.spent() == 600 and accountant.remaining() == 400
+    assert job.quota_units == 600
+    with pytest.raises(QuotaDeferred) as raised:
+        accountant.charge(500, job)
+    assert raised.value.resume_at == accountant.next_reset()
+    # A refused charge spends nothing
+    assert accountant.spent() == 600
+    accountant.charge(400)
+    assert accountant.remaining() == 0
+
+
+def test_admission_reserves_the_estimate(accountant):
+    first, second = FakeJob("a"), FakeJob("b")
+    accountant.admit(first, 700)
+    assert first.quota_estimate == 700
+    assert accountant.available("b") == 300
+    with pytest.raises(QuotaDeferred):
+        accountant.admit(second, 400)
+    # Spending a reservation uses it up rather than counting twice
+    accountant.charge(500, first)
+    assert accountant.available("b") == 300
+    accountant.release(first)
+    assert accountant.available("b") == 500
+    accountant.admit(second, 400)
+
+
+def test_jobs_larger_than_a_day_start_once_half_the_budget_is_free(accountant):
+    accountant.charge(400)
+    accountant.admit(FakeJob("a"), 5000)
+    accountant.charge(200)
+    with pytest.raises(QuotaDeferred):
+        accountant.admit(FakeJob("b"), 5000)
+
+
+def test_quota_exceeded_from_youtube_uses_up_the_day(accountant):
+    accountant.charge(100)
+    accountant.mark_exhausted()
+    assert accountant.remaining() == 0
+    accountant.mark_exhausted()
+    assert accountant.spent() == 1000
+
+
+def test_accountants_on_one_backend_share_the_budget():
+    backend = MemoryStateBackend()
+    first, second = QuotaAccountant(backend, daily_budget=1000), QuotaAccountant(backend, daily_budget=1000)
+    first.charge(700)
+    with pytest.raises(QuotaDeferred):
+        second.charge(400)
+    assert second.remaining() == 300
@@ -0,0 +1,74 @@
+import asyncio
+import types
+
+import pytest
+
+import ratelimit
+from ratelimit import TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    async def sleep_async(self, seconds):
+        self.sleep(seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Stands in for the time and asyncio modules as ratelimit sees them, leaving everyone else's clock alone
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    monkeypatch.setattr(ratelimit, "asyncio", types.SimpleNamespace(sleep=clock.sleep_async))
+    return clock
+
+
+def test_bursts_up_to_capacity_without_waiting(clock):
+    bucket = TokenBucket(rate=2, capacity=5)
+    assert [bucket.acquire() for _ in range(5)] == [0.0] * 5
+    assert clock.slept == []
+
+
+def test_waits_for_tokens_to_refill_at_the_rate(clock):
+    bucket = TokenBucket(rate=4, capacity=2)
+    bucket.acquire(tokens=2)
+    assert bucket.acquire() == pytest.approx(0.25)
+    assert bucket.acquire(tokens=2) == pytest.approx(0.5)
+
+
+def test_more_tokens_than_the_bucket_holds_is_an_error(clock):
+    bucket = TokenBucket(rate=4, capacity=1)
+    with pytest.raises(ValueError):
+        bucket.acquire(tokens=2)
+
+
+def test_idle_time_refills_no_further_than_capacity(clock):
+    bucket = TokenBucket(rate=8, capacity=3)
+    for _ in range(3):
+        bucket.acquire()
+    clock.now += 60
+    assert [bucket.acquire() for _ in range(3)] == [0.0] * 3
+    assert bucket.acquire() == pytest.approx(0.125)
+
+
+def test_capacity_defaults_to_one_second_of_tokens():
+    assert TokenBucket(rate=8).capacity == 8
+    assert TokenBucket(rate=0.5).capacity == 1
+
+
+def test_acquire_async_waits_like_acquire(clock):
+    bucket = TokenBucket(rate=2, capacity=1)
+
+    async def main():
+        return [await bucket.acquire_async() for _ in range(3)]
+
+    assert asyncio.run(main()) == [0.0, pytest.approx(0.5), pytest.approx(0.5)]
@@ -0,0 +1,147 @@
+import time
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import retry
+from retry import RETRY_BASE_DELAY, RETRY_MAX_DELAY, CircuitBreaker, CircuitOpen, backoff_delay, call, retry_after
+
+
+def http_error(status, content=b"", headers=None):
+    return HttpError(httplib2.Response({"status": status, **(headers or {})}), content)
+
+
+@pytest.fixture
+def no_jitter(monkeypatch):
+    # The top of each jitter range
+    monkeypatch.setattr(retry.random, "uniform", lambda low, high: high)
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = CircuitBreaker("youtube", failure_threshold=3, reset_seconds=30)
+    monkeypatch.setitem(retry.circuit_breakers, "youtube", breaker)
+    monkeypatch.setattr(retry.time, "sleep", lambda seconds: None)
+    return breaker
+
+
+def test_backoff_doubles_up_to_the_maximum(no_jitter):
+    assert [backoff_delay(attempt) for attempt in (1, 2, 3)] == [RETRY_BASE_DELAY, RETRY_BASE_DELAY * 2,
+                                                                 RETRY_BASE_DELAY * 4]
+    assert backoff_delay(50) == RETRY_MAX_DELAY
+
+
+def test_backoff_honours_the_server_delay(no_jitter):
+    assert backoff_delay(1, server_delay=7) == 7 + RETRY_BASE_DELAY
+
+
+def test_retry_after_reads_seconds_and_dates():
+    assert retry_after(http_error(429, headers={"retry-after": "12"})) == 12
+    later = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 120))
+    assert 100 < retry_after(http_error(503, headers={"retry-after": later})) <= 120
+    assert retry_after(http_error(503)) is None
+    assert retry_after(http_error(503, headers={"retry-after": "soon"})) is None
+    assert retry_after(ValueError()) is None
+
+
+def test_breaker_opens_after_consecutive_failures(breaker):
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpen) as raised:
+        breaker.before_call()
+    assert raised.value.resume_at == breaker.opened_until
+
+
+def test_success_resets_the_failure_count(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_breaker_lets_one_trial_call_through(breaker):
+    breaker.open_until(time.time() + 60)
+    # The reset time passes
+    breaker.opened_until = time.time() - 1
+    assert breaker.state == "half_open"
+    breaker.before_call()
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.before_call()
+
+
+def test_failed_trial_opens_the_breaker_again(breaker):
+    breaker.open_until(time.time() + 60)
+    breaker.opened_until = time.time() - 1
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.opened_until > time.time() + 20
+    # Still the same trip
+    assert breaker.stats()["trips"] == 1
+
+
+def test_call_retries_transient_errors(breaker):
+    responses = [http_error(503), http_error(500), "ok"]
+
+    def request():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert call("youtube", "test", request) == "ok"
+    assert breaker.stats()["consecutive_failures"] == 0
+
+
+def test_call_raises_other_errors_at_once(breaker):
+    attempts = []
+
+    def request():
+        attempts.append(1)
+        raise http_error(404)
+
+    with pytest.raises(HttpError):
+        call("youtube", "test", request)
+    assert len(attempts) == 1
+    assert breaker.state == "closed"
+
+
+def test_call_raises_the_last_error_once_attempts_are_used_up(breaker):
+    attempts = []
+
+    def request():
+        attempts.append(1)
+        raise http_error(502)
+
+    with pytest.raises(HttpError):
+        call("youtube", "test", request, max_attempts=2)
+    assert len(attempts) == 2
+
+
+def test_call_stops_once_failures_open_the_breaker(breaker):
+    attempts = []
+
+    def request():
+        attempts.append(1)
+        raise http_error(503)
+
+    with pytest.raises(CircuitOpen):
+        call("youtube", "test", request, max_attempts=10)
+    assert len(attempts) == breaker.failure_threshold
+
+
+def test_long_retry_after_opens_the_breaker_instead_of_waiting(breaker):
+    def request():
+        raise http_error(429, headers={"retry-after": str(int(RETRY_MAX_DELAY) + 600)})
+
+    with pytest.raises(CircuitOpen) as raised:
+        call("youtube", "test", request)
+    assert raised.value.resume_at >= time.time() + RETRY_MAX_DELAY + 500
@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def run_threads(count, target):
+    results = [None] * count
+    threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, target())) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_concurrent_calls_for_a_key_share_one_call():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def search():
+        calls.append(1)
+        release.wait(5)
+        return "video"
+
+    leader, [leader_result] = run_threads(1, lambda: flight.do("track", search))
+    wait_for(lambda: calls)
+    waiters, results = run_threads(4, lambda: flight.do("track", search))
+    # Give the waiters time to find the call in flight
+    time.sleep(0.2)
+    release.set()
+    for thread in leader + waiters:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [("video", True)] * 4
+
+
+def test_waiters_make_the_call_themselves_when_it_fails():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def search():
+        calls.append(1)
+        if len(calls) == 1:
+            release.wait(5)
+            raise RuntimeError("search failed")
+        time.sleep(0.2)
+        return "video"
+
+    errors = []
+
+    def lead():
+        try:
+            flight.do("track", search)
+        except RuntimeError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    wait_for(lambda: calls)
+    waiters, results = run_threads(3, lambda: flight.do("track", search))
+    time.sleep(0.2)
+    release.set()
+    for thread in [leader] + waiters:
+        thread.join()
+    assert len(errors) == 1
+    assert [result for result, _ in results] == ["video"] * 3
+    # One waiter searched again and the others shared its result
+    assert len(calls) == 2
+    assert sorted(shared for _, shared in results) == [False, True, True]
+
+
+def test_keys_are_released_whatever_the_call_raises():
+    flight = SingleFlight()
+
+    def interrupted():
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        flight.do("track", interrupted)
+    assert flight.do("track", lambda: "video") == ("video", False)
+
+
+def test_different_keys_are_not_coalesced():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: 1) == (1, False)
+    assert flight.do("b", lambda: 2) == (2, False)
+
+
+def test_concurrent_coroutines_share_one_call():
+    flight = SingleFlight()
+    calls = []
+
+    async def search():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "video"
+
+    async def main():
+        return await asyncio.gather(*(flight.do_async("track", search) for _ in range(5)))
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert sorted(results) == [("video", False)] + [("video", True)] * 4
+
+
+def test_coroutine_waiters_retry_when_the_call_fails():
+    flight = SingleFlight()
+    calls = []
+
+    async def search():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        if len(calls) == 1:
+            raise RuntimeError("search failed")
+        return "video"
+
+    async def main():
+        return await asyncio.gather(*(flight.do_async("track", search) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert len(calls) == 2
+    assert sum(isinstance(result, RuntimeError) for result in results) == 1
+    assert sorted(result for result in results if not isinstance(result, RuntimeError)) == [("video", False),
+                                                                                            ("video", True)]
+
+
+def test_cancelling_a_coroutine_waiter_leaves_the_call_running():
+    flight = SingleFlight()
+
+    async def search():
+        await asyncio.sleep(0.1)
+        return "video"
+
+    async def main():
+        leader = asyncio.create_task(flight.do_async("track", search))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(flight.do_async("track", search))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return await leader
+
+    assert asyncio.run(main()) == ("video", False)
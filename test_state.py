@@ -0,0 +1,127 @@
+import os
+import time
+import uuid
+
+import pytest
+
+from state import (BackendCache, MemoryStateBackend, RedisStateBackend, SQLiteStateBackend, create_backend)
+
+# Point at a Redis server, e.g. redis://localhost:6379/15, to run the tests against RedisStateBackend too
+REDIS_TEST_URL = os.getenv("REDIS_TEST_URL")
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStateBackend()
+    if request.param == "sqlite":
+        return SQLiteStateBackend(str(tmp_path / "state.db"))
+    if not REDIS_TEST_URL:
+        pytest.skip("REDIS_TEST_URL is not set")
+    pytest.importorskip("redis")
+    return RedisStateBackend(REDIS_TEST_URL)
+
+
+@pytest.fixture
+def key():
+    # Fresh keys per test, so a shared Redis database needs no cleaning
+    prefix = f"test:{uuid.uuid4().hex}:"
+    return lambda name="key": prefix + name
+
+
+def test_values_round_trip_as_json(backend, key):
+    value = {"name": "Song", "artists": ["A", "B"], "count": 3, "score": 0.5, "missing": None}
+    backend.set(key(), value)
+    assert backend.get(key()) == value
+    assert backend.get(key("other")) is None
+
+
+def test_delete_removes_values_and_lists(backend, key):
+    backend.set(key("value"), 1)
+    backend.rpush(key("list"), 1)
+    backend.delete(key("value"), key("list"))
+    assert backend.get(key("value")) is None
+    assert backend.lrange(key("list")) == []
+    backend.delete()
+
+
+def test_add_only_sets_missing_keys(backend, key):
+    assert backend.add(key(), "first")
+    assert not backend.add(key(), "second")
+    assert backend.get(key()) == "first"
+
+
+def test_incr_counts_from_zero(backend, key):
+    assert backend.incr(key(), 0) == 0
+    assert backend.incr(key(), 5) == 5
+    assert backend.incr(key(), -2, ttl=60) == 3
+    assert backend.get(key()) == 3
+
+
+def test_lists_keep_order_and_drop_the_oldest_past_max_len(backend, key):
+    for value in range(5):
+        backend.rpush(key(), [value, f"v{value}"], max_len=3)
+    assert backend.lrange(key()) == [[2, "v2"], [3, "v3"], [4, "v4"]]
+
+
+def test_lrange_skips_the_first_items(backend, key):
+    for value in range(5):
+        backend.rpush(key(), value)
+    assert backend.lrange(key(), 3) == [3, 4]
+    assert backend.lrange(key(), 5) == []
+    assert backend.lrange(key("missing"), 2) == []
+
+
+def test_values_and_list_items_expire(backend, key):
+    if isinstance(backend, RedisStateBackend):
+        pytest.skip("Redis expires keys in whole seconds")
+    backend.set(key("value"), 1, ttl=0.1)
+    backend.rpush(key("list"), "old", ttl=0.1)
+    backend.rpush(key("list"), "new")
+    assert backend.get(key("value")) == 1
+    time.sleep(0.15)
+    assert backend.get(key("value")) is None
+    assert backend.lrange(key("list")) == ["new"]
+    assert backend.add(key("value"), 2)
+    assert backend.incr(key("counter"), 1, ttl=0.1) == 1
+    time.sleep(0.15)
+    assert backend.incr(key("counter"), 1) == 1
+
+
+def test_sqlite_backends_on_one_file_share_state(tmp_path):
+    path = str(tmp_path / "state.db")
+    first, second = SQLiteStateBackend(path), SQLiteStateBackend(path)
+    first.set("key", "value")
+    first.incr("counter", 2)
+    second.incr("counter", 3)
+    assert second.get("key") == "value"
+    assert first.get("counter") == 5
+
+
+def test_sqlite_sweep_drops_expired_rows(tmp_path):
+    backend = SQLiteStateBackend(str(tmp_path / "state.db"))
+    backend.set("gone", 1, ttl=0.05)
+    backend.rpush("list", "gone", ttl=0.05)
+    backend.set("kept", 1)
+    time.sleep(0.1)
+    backend.sweep()
+    conn = backend._db.get()
+    assert conn.execute("SELECT key FROM kv").fetchall() == [("kept",)]
+    assert conn.execute("SELECT COUNT(*) FROM lists").fetchone() == (0,)
+
+
+def test_create_backend(tmp_path):
+    assert isinstance(create_backend("memory"), MemoryStateBackend)
+    backend = create_backend(f"sqlite:///{tmp_path / 'other.db'}")
+    assert isinstance(backend, SQLiteStateBackend) and backend.path == str(tmp_path / "other.db")
+    with pytest.raises(ValueError):
+        create_backend("postgres://localhost")
+
+
+def test_backend_cache_speaks_cachelib(backend, key):
+    cache = BackendCache(backend, default_timeout=60)
+    assert cache.set(key(), {"user": "a"})
+    assert cache.has(key()) and cache.get(key()) == {"user": "a"}
+    assert not cache.add(key(), {"user": "b"})
+    assert cache.delete(key())
+    assert not cache.has(key())
@@ -0,0 +1,161 @@
+import heapq
+import logging
+import os
+import threading
+import time
+
+from clients import get_spotify_oauth
+from metrics import timed, token_refreshes
+from state import state_backend
+
+logger = logging.getLogger(__name__)
+
+PROVIDERS = ("spotify", "google")
+# Seconds a session's tokens are kept after they were last saved; refreshing saves them again
+TOKEN_TTL = int(os.getenv("TOKEN_TTL", 7 * 24 * 3600))
+# Spotify access tokens are refreshed in the background this many seconds before they expire
+TOKEN_REFRESH_AHEAD = int(os.getenv("TOKEN_REFRESH_AHEAD", 300))
+# Sessions that haven't used their tokens for this long are left to refresh on their next request
+TOKEN_REFRESH_IDLE = int(os.getenv("TOKEN_REFRESH_IDLE", 3600))
+TOKEN_REFRESH_INTERVAL = 15
+# A request whose token expires within this many seconds refreshes it before using it
+TOKEN_EXPIRY_MARGIN = 60
+# How long a worker may hold a session's refresh before others stop waiting for it
+REFRESH_LOCK_SECONDS = 30
+
+
+class TokenStore:
+    """Each browser session's Spotify and Google tokens, one state backend key per session and provider.
+
+    Loading or saving a session's tokens touches only that session's keys, and
+    keys expire `ttl` seconds after they were last saved, so nothing ever has
+    to scan for or clean up other sessions' tokens. Spotify access tokens of
+    sessions used recently are refreshed by a background thread shortly before
+    they expire, so requests rarely wait on a refresh; a per-session lock in
+    the backend keeps workers from refreshing the same token at once.
+    """
+
+    def __init__(self, backend=state_backend, ttl=TOKEN_TTL, refresh_ahead=TOKEN_REFRESH_AHEAD,
+                 refresh_idle=TOKEN_REFRESH_IDLE):
+        self.backend = backend
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.refresh_idle = refresh_idle
+        self._lock = threading.Lock()
+        # Heap of (refresh_at, session_id) for sessions this process has served
+        self._schedule = []
+        # session_id -> [refresh_at it's scheduled at, last time its tokens were used]
+        self._sessions = {}
+        refresher = threading.Thread(target=self._refresh_loop, name="token-refresh", daemon=True)
+        refresher.start()
+
+    def _key(self, session_id, provider):
+        return f"tokens:{provider}:{session_id}"
+
+    def get(self, session_id, provider):
+        """The session's tokens for `provider`, or None."""
+        if not session_id:
+            return None
+        tokens = self.backend.get(self._key(session_id, provider))
+        if tokens and provider == "spotify":
+            self._track(session_id, tokens, used=True)
+        return tokens
+
+    def save(self, session_id, provider, tokens):
+        self.backend.set(self._key(session_id, provider), tokens, ttl=self.ttl)
+        if provider == "spotify":
+            self._track(session_id, tokens, used=True)
+
+    def delete(self, session_id, *providers):
+        """Forget the session's tokens for `providers`, or for every provider."""
+        if not session_id:
+            return
+        self.backend.delete(*(self._key(session_id, provider) for provider in providers or PROVIDERS))
+        if "spotify" in (providers or PROVIDERS):
+            with self._lock:
+                self._sessions.pop(session_id, None)
+
+    def fresh_spotify(self, session_id):
+        """The session's Spotify token info, refreshed first if it's about to expire; None if there is none."""
+        token_info = self.get(session_id, "spotify")
+        if token_info is None or time.time() < token_info.get("expires_at", 0) - TOKEN_EXPIRY_MARGIN:
+            return token_info
+        return self._refresh(session_id, token_info, "request")
+
+    def _track(self, session_id, token_info, used):
+        # Schedule a background refresh ahead of the token's expiry; only requests count as using the session
+        refresh_at = token_info.get("expires_at", 0) - self.refresh_ahead
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                if not used:
+                    return
+                entry = self._sessions[session_id] = [None, now]
+            if used:
+                entry[1] = now
+            if entry[0] != refresh_at:
+                entry[0] = refresh_at
+                heapq.heappush(self._schedule, (refresh_at, session_id))
+
+    def _refresh(self, session_id, token_info, trigger):
+        lock_key = f"token_refresh:{session_id}"
+        locked = self.backend.add(lock_key, True, ttl=REFRESH_LOCK_SECONDS)
+        if not locked:
+            # Another worker is refreshing this token; use what it saves rather than refreshing twice
+            deadline = time.time() + REFRESH_LOCK_SECONDS
+            while time.time() < deadline:
+                time.sleep(0.2)
+                current = self.backend.get(self._key(session_id, "spotify"))
+                if current is None or current.get("expires_at", 0) > token_info.get("expires_at", 0):
+                    return current
+        try:
+            with timed("token_refresh"):
+                refreshed = get_spotify_oauth(session_id).refresh_access_token(token_info["refresh_token"])
+        except Exception:
+            token_refreshes.inc(trigger=trigger, outcome="error")
+            raise
+        finally:
+            if locked:
+                self.backend.delete(lock_key)
+        token_refreshes.inc(trigger=trigger, outcome="ok")
+        self.backend.set(self._key(session_id, "spotify"), refreshed, ttl=self.ttl)
+        self._track(session_id, refreshed, used=False)
+        return refreshed
+
+    def _due(self, now):
+        """Sessions whose background refresh is due; drops the ones that went idle."""
+        due = []
+        with self._lock:
+            while self._schedule and self._schedule[0][0] <= now:
+                refresh_at, session_id = heapq.heappop(self._schedule)
+                entry = self._sessions.get(session_id)
+                if entry is None or entry[0] != refresh_at:
+                    # Logged out, or rescheduled since this entry was pushed
+                    continue
+                if now - entry[1] > self.refresh_idle:
+                    del self._sessions[session_id]
+                    continue
+                due.append(session_id)
+        return due
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(TOKEN_REFRESH_INTERVAL)
+            for session_id in self._due(time.time()):
+                try:
+                    token_info = self.backend.get(self._key(session_id, "spotify"))
+                    if token_info is None:
+                        # Expired or deleted by another worker
+                        with self._lock:
+                            self._sessions.pop(session_id, None)
+                    elif time.time() >= token_info.get("expires_at", 0) - self.refresh_ahead:
+                        self._refresh(session_id, token_info, "background")
+                    else:
+                        # Another worker refreshed it already; follow the new expiry
+                        self._track(session_id, token_info, used=False)
+                except Exception as e:
+                    logger.error(f"Background refresh of Spotify token for session_id {session_id} failed: {e}")
+
+
+token_store = TokenStore()
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import queue
+import threading
+
+from metrics import timed
+from retry import call, call_async
+
+logger = logging.getLogger(__name__)
+
+# Only the parts of each playlist item the transfer actually uses
+TRACK_FIELDS = "items(track(id,name,artists(name),external_ids(isrc),duration_ms)),next,total"
+PAGE_SIZE = 100
+
+_END = object()
+
+
+class Track:
+    """The parts of a Spotify track a transfer uses, a fraction of the size of its JSON."""
+
+    __slots__ = ("id", "isrc", "name", "artists", "duration_ms")
+
+    def __init__(self, id, isrc, name, artists, duration_ms):
+        self.id = id
+        self.isrc = isrc
+        self.name = name
+        self.artists = artists
+        self.duration_ms = duration_ms
+
+    @classmethod
+    def from_spotify(cls, track):
+        """Track for a playlist item's `track` object."""
+        return cls(
+            track.get("id"),
+            (track.get("external_ids") or {}).get("isrc"),
+            track.get("name") or "",
+            tuple(artist["name"] for artist in track.get("artists") or () if artist.get("name")),
+            track.get("duration_ms"),
+        )
+
+    @property
+    def artist(self):
+        """The first artist's name, or "" for tracks without one."""
+        return self.artists[0] if self.artists else ""
+
+
+def fetch_page(sp, playlist_id, offset=0):
+    with timed("spotify_fetch"):
+        return call("spotify", "playlist_items", lambda: sp.playlist_items(
+            playlist_id, fields=TRACK_FIELDS, limit=PAGE_SIZE, offset=offset, additional_types=("track",)
+        ))
+
+
+def fetch_next_page(sp, page):
+    with timed("spotify_fetch"):
+        return call("spotify", "playlist_items", lambda: sp.next(page))
+
+
+async def fetch_page_async(apis, playlist_id, offset=0):
+    with timed("spotify_fetch"):
+        return await call_async("spotify", "playlist_items", lambda: apis.spotify_get(
+            f"playlists/{playlist_id}/tracks",
+            {"fields": TRACK_FIELDS, "limit": PAGE_SIZE, "offset": offset, "additional_types": "track"}
+        ))
+
+
+async def fetch_next_page_async(apis, page):
+    with timed("spotify_fetch"):
+        return await call_async("spotify", "playlist_items", lambda: apis.spotify_get(page["next"]))
+
+
+def page_tracks(page, index):
+    """(index, Track) for the playable tracks of `page`, whose first item is at `index`."""
+    for offset, item in enumerate(page["items"]):
+        track = item.get("track")
+        if track:
+            yield index + offset, Track.from_spotify(track)
+
+
+def iter_playlist_pages(sp, playlist_id, offset=0, first_page=None):
+    """Yield raw playlist-items pages, following `next` links until the playlist is exhausted.
+
+    Pass `first_page` when the page at `offset` was already fetched.
+    """
+    page = first_page if first_page is not None else fetch_page(sp, playlist_id, offset)
+    while page:
+        yield page
+        page = fetch_next_page(sp, page) if page.get("next") else None
+
+
+def iter_playlist_tracks(sp, playlist_id, offset=0, on_total=None, first_page=None):
+    """Yield (index, Track) for every playable track, one page in memory at a time.
+
+    `index` is the item's position in the playlist so it can be used as a resume point.
+    `on_total` is called with the playlist's item count once the first page arrives.
+    """
+    index = offset
+    for page in iter_playlist_pages(sp, playlist_id, offset, first_page):
+        if on_total is not None:
+            on_total(page.get("total", 0))
+            on_total = None
+        yield from page_tracks(page, index)
+        index += len(page["items"])
+
+
+async def iter_playlist_tracks_async(apis, playlist_id, offset=0, on_total=None, first_page=None):
+    """iter_playlist_tracks for the asyncio engine, fetching pages over `apis`."""
+    index = offset
+    page = first_page if first_page is not None else await fetch_page_async(apis, playlist_id, offset)
+    while page:
+        if on_total is not None:
+            on_total(page.get("total", 0))
+            on_total = None
+        for entry in page_tracks(page, index):
+            yield entry
+        index += len(page["items"])
+        page = await fetch_next_page_async(apis, page) if page.get("next") else None
+
+
+def iter_merged_tracks(sp, playlist_ids, first_page=None):
+    """Yield (index, Track) for each playlist in turn, numbered as if they were one playlist.
+
+    Pass `first_page` when the first playlist's first page was already fetched.
+    """
+    index = 0
+    for playlist_id in playlist_ids:
+        for page in iter_playlist_pages(sp, playlist_id, 0, first_page):
+            yield from page_tracks(page, index)
+            index += len(page["items"])
+        first_page = None
+
+
+async def iter_merged_tracks_async(apis, playlist_ids, first_page=None):
+    """iter_merged_tracks for the asyncio engine, fetching pages over `apis`."""
+    index = 0
+    for playlist_id in playlist_ids:
+        page = first_page if first_page is not None else await fetch_page_async(apis, playlist_id)
+        first_page = None
+        while page:
+            for entry in page_tracks(page, index):
+                yield entry
+            index += len(page["items"])
+            page = await fetch_next_page_async(apis, page) if page.get("next") else None
+
+
+def prefetch(iterable, max_buffered=2 * PAGE_SIZE):
+    """Drain `iterable` on a background thread so fetching overlaps with consuming.
+
+    The buffer is bounded, so the producer never runs more than a couple of pages ahead.
+    """
+    buffer = queue.Queue(maxsize=max_buffered)
+    stop = threading.Event()
+
+    def put(entry):
+        # Give up if the consumer went away instead of blocking on a full buffer forever
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for value in iterable:
+                if not put((value, None)):
+                    return
+            put((_END, None))
+        except Exception as e:
+            put((_END, e))
+
+    producer = threading.Thread(target=produce, name="spotify-fetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            value, error = buffer.get()
+            if value is _END:
+                if error is not None:
+                    raise error
+                return
+            yield value
+    finally:
+        stop.set()
+
+
+async def prefetch_async(iterable, max_buffered=2 * PAGE_SIZE):
+    """prefetch for async iterators: a producer task fills a bounded queue while the consumer drains it."""
+    buffer = asyncio.Queue(maxsize=max_buffered)
+
+    async def produce():
+        try:
+            async for value in iterable:
+                await buffer.put((value, None))
+            await buffer.put((_END, None))
+        except Exception as e:
+            await buffer.put((_END, e))
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            value, error = await buffer.get()
+            if value is _END:
+                if error is not None:
+                    raise error
+                return
+            yield value
+    finally:
+        producer.cancel()
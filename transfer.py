@@ -0,0 +1,416 @@
+import asyncio
+import logging
+import os
+import time
+
+from dead_letters import dead_letters
+from match_cache import match_cache, track_keys
+from metrics import tracks_processed
+from playlist_inserter import AsyncPlaylistInserter, PlaylistInserter
+from progress import progress_store
+from quota import LIST_COST, PLAYLIST_COST, JobQuota, estimate_transfer_cost, quota_accountant
+from resolver import AsyncSearchResolver, SearchResolver, track_query
+from retry import call, call_async
+from sync import fetch_playlist_videos, fetch_playlist_videos_async, sync_store
+from tracks import (fetch_page, fetch_page_async, iter_merged_tracks, iter_merged_tracks_async, iter_playlist_tracks,
+                    iter_playlist_tracks_async, page_tracks, prefetch, prefetch_async)
+
+logger = logging.getLogger(__name__)
+
+# Playlist ID of a transfer merging several Spotify playlists into one YouTube playlist: "merge:<id>,<id>,..."
+MERGE_PREFIX = "merge:"
+MERGE_FIELDS = "name,snapshot_id,tracks.total"
+# Playlists one merge may combine; each is read in full on every sync of the merge
+MAX_MERGED_PLAYLISTS = int(os.getenv("MAX_MERGED_PLAYLISTS", 20))
+# YouTube refuses longer playlist titles
+MAX_TITLE_LENGTH = 150
+
+
+def merge_playlist_id(playlist_ids):
+    """The playlist ID a merge of `playlist_ids`, in that order, is transferred and synced under."""
+    return MERGE_PREFIX + ",".join(playlist_ids)
+
+
+def merged_playlist_ids(playlist_id):
+    """The Spotify playlists merged under `playlist_id`, or None if it's a single playlist.
+
+    Raises ValueError unless it merges 2 to MAX_MERGED_PLAYLISTS distinct, well-formed playlist IDs.
+    """
+    if not playlist_id.startswith(MERGE_PREFIX):
+        return None
+    playlist_ids = playlist_id[len(MERGE_PREFIX):].split(",")
+    if len(playlist_ids) < 2:
+        raise ValueError("Select at least two playlists to merge.")
+    if len(playlist_ids) > MAX_MERGED_PLAYLISTS:
+        raise ValueError(f"At most {MAX_MERGED_PLAYLISTS} playlists can be merged into one.")
+    if not all(source.isalnum() for source in playlist_ids):
+        raise ValueError("Invalid playlist ID.")
+    if len(set(playlist_ids)) < len(playlist_ids):
+        raise ValueError("Each playlist can only be merged once.")
+    return playlist_ids
+
+
+def _merged_playlist(playlists):
+    """Name, description, snapshot and track count of the YouTube playlist merging `playlists`."""
+    names = [playlist["name"] for playlist in playlists]
+    return {
+        "name": " + ".join(names)[:MAX_TITLE_LENGTH],
+        "description": "Merged from Spotify playlists: " + ", ".join(names),
+        # Changes whenever any of the playlists changes
+        "snapshot_id": ",".join(playlist["snapshot_id"] for playlist in playlists),
+        "total": sum(playlist["tracks"]["total"] for playlist in playlists),
+    }
+
+
+def run_transfer(job, sp, youtube, spotify_user_id, credentials=None, fresh=False):
+    """Copy a Spotify playlist to YouTube, updating `job` as it goes.
+
+    The first transfer creates a private YouTube playlist; later ones sync into
+    it, searching and inserting only tracks it doesn't have yet, and return
+    without any YouTube calls when the Spotify snapshot hasn't changed and no
+    track is waiting to be retried. Tracks that fail after every retry go to the
+    dead-letter list and are retried by the next transfer. A merge playlist ID
+    copies its playlists one after another, skipping tracks an earlier one
+    already had. `fresh` forces a new YouTube playlist, and `credentials` lets
+    track searches run concurrently on per-thread connections. Raises
+    QuotaDeferred if today's YouTube quota can't cover the estimated cost or runs
+    out partway, and CircuitOpen if Spotify or YouTube is failing.
+    """
+    resume_key = f"transfer_{spotify_user_id}_{job.playlist_id}"
+    if fresh:
+        progress_store.clear(resume_key)
+
+    # Spotify playlist data
+    sources = merged_playlist_ids(job.playlist_id)
+    if sources:
+        playlist = _merged_playlist([call("spotify", "playlist", lambda source=source: sp.playlist(
+            source, fields=MERGE_FIELDS)) for source in sources])
+    else:
+        playlist = call("spotify", "playlist", lambda: sp.playlist(job.playlist_id, fields="name,description,snapshot_id"))
+    mapping, up_to_date = _previous_sync(job, spotify_user_id, playlist, fresh)
+    if up_to_date:
+        return
+
+    last_transferred = progress_store.get(resume_key)
+    logger.info(f"Resuming transfer from index {last_transferred} for job {job.id}")
+    if sources:
+        # Telling duplicates apart takes every earlier track, so merges are read from the start
+        first_page = fetch_page(sp, sources[0])
+    else:
+        first_page = fetch_page(sp, job.playlist_id, last_transferred)
+    synced = _admit(job, spotify_user_id, mapping, playlist, first_page, last_transferred)
+    quota = JobQuota(quota_accountant, job)
+    try:
+        _transfer_tracks(job, sp, youtube, spotify_user_id, resume_key, credentials,
+                         playlist, mapping, synced, first_page, last_transferred, quota)
+    finally:
+        quota_accountant.release(job)
+
+
+async def run_transfer_async(job, apis, spotify_user_id, fresh=False):
+    """run_transfer for the asyncio engine, making its API calls over `apis`.
+
+    Every step and decision is shared with run_transfer, so both engines leave the
+    same YouTube playlist, stores and job behind. Bookkeeping that touches SQLite
+    or the state backend runs on worker threads to keep the event loop free.
+    """
+    resume_key = f"transfer_{spotify_user_id}_{job.playlist_id}"
+    if fresh:
+        await asyncio.to_thread(progress_store.clear, resume_key)
+
+    sources = merged_playlist_ids(job.playlist_id)
+    if sources:
+        playlist = _merged_playlist(await asyncio.gather(*(
+            call_async("spotify", "playlist", lambda source=source: apis.spotify_get(
+                f"playlists/{source}", {"fields": MERGE_FIELDS, "additional_types": "track"}))
+            for source in sources)))
+    else:
+        playlist = await call_async("spotify", "playlist", lambda: apis.spotify_get(
+            f"playlists/{job.playlist_id}", {"fields": "name,description,snapshot_id", "additional_types": "track"}))
+    mapping, up_to_date = await asyncio.to_thread(_previous_sync, job, spotify_user_id, playlist, fresh)
+    if up_to_date:
+        return
+
+    last_transferred = await asyncio.to_thread(progress_store.get, resume_key)
+    logger.info(f"Resuming transfer from index {last_transferred} for job {job.id}")
+    if sources:
+        first_page = await fetch_page_async(apis, sources[0])
+    else:
+        first_page = await fetch_page_async(apis, job.playlist_id, last_transferred)
+    synced = await asyncio.to_thread(_admit, job, spotify_user_id, mapping, playlist, first_page, last_transferred)
+    quota = JobQuota(quota_accountant, job)
+    try:
+        await _transfer_tracks_async(job, apis, spotify_user_id, resume_key,
+                                     playlist, mapping, synced, first_page, last_transferred, quota)
+    finally:
+        quota_accountant.release(job)
+
+
+def _previous_sync(job, spotify_user_id, playlist, fresh):
+    """The mapping left by the last sync, and whether YouTube already mirrors `playlist` (the job is then finished)."""
+    job.playlist_name = playlist["name"]
+    mapping = None if fresh else sync_store.get(spotify_user_id, job.playlist_id)
+    failed_before = dead_letters.list(spotify_user_id, job.playlist_id)
+    if mapping and mapping.snapshot_id == playlist["snapshot_id"] and not failed_before:
+        job.youtube_playlist_id = mapping.youtube_playlist_id
+        job.finish(f"Playlist '{playlist['name']}' is already up to date on YouTube.")
+        return mapping, True
+    return mapping, False
+
+
+def _admit(job, spotify_user_id, mapping, playlist, first_page, last_transferred):
+    """Reserve the quota the rest of the transfer needs; returns the tracks synced before.
+
+    Tracks synced before or already matched by anyone won't need a search.
+    Raises QuotaDeferred if today's quota can't cover it.
+    """
+    synced = sync_store.items(spotify_user_id, job.playlist_id) if mapping else {}
+    sample = [track for _, track in page_tracks(first_page, 0)]
+    new_tracks = [track for track in sample if track_keys(track)[0] not in synced]
+    new_ratio = len(new_tracks) / len(sample) if sample else 1.0
+    cache_hit_ratio = sum(1 for track in new_tracks if match_cache.contains(track)) / len(new_tracks) if new_tracks else 0.0
+    remaining_tracks = max(playlist.get("total", first_page.get("total", 0)) - last_transferred, 0)
+    estimate = estimate_transfer_cost(round(remaining_tracks * new_ratio), cache_hit_ratio)
+    if mapping:
+        estimate += LIST_COST * (len(synced) // 50 + 1)
+    quota_accountant.admit(job, estimate)
+    return synced
+
+
+def _playlist_request(youtube, playlist):
+    return youtube.playlists().insert(
+        part="snippet,status",
+        fields="id",
+        body={
+            "snippet": {
+                "title": playlist["name"],
+                "description": playlist.get("description", "Transferred from Spotify")
+            },
+            "status": {"privacyStatus": "private"}
+        }
+    )
+
+
+def _create_playlist(youtube, playlist, quota):
+    quota.charge(PLAYLIST_COST)
+    request = _playlist_request(youtube, playlist)
+    return call("youtube", "playlists.insert", request.execute)["id"]
+
+
+async def _create_playlist_async(apis, playlist, quota):
+    await quota.charge_async(PLAYLIST_COST)
+    request = _playlist_request(apis.youtube, playlist)
+    return (await call_async("youtube", "playlists.insert", lambda: apis.youtube_execute(request)))["id"]
+
+
+def _start_sync(job, spotify_user_id, youtube_playlist_id, last_transferred):
+    job.youtube_playlist_id = youtube_playlist_id
+    sync_store.start(spotify_user_id, job.playlist_id, youtube_playlist_id)
+    if not last_transferred:
+        # A full pass retries every earlier failure, so start a fresh dead-letter list
+        dead_letters.clear(spotify_user_id, job.playlist_id)
+
+
+def _report_resume(job, resume_key, last_transferred):
+    if last_transferred:
+        job.emit("resumed", index=last_transferred, inserted=len(progress_store.inserted_videos(resume_key)))
+
+
+def _already_present(track, synced, present):
+    # Tracks whose video is still in the YouTube playlist need neither a search nor an insert
+    return synced.get(track_keys(track)[0]) in present
+
+
+def _skip_present(job, index, track):
+    job.advance(succeeded=True)
+    tracks_processed.inc(outcome="already_synced")
+    job.emit("skipped", index=index, track=track_query(track), reason="already on YouTube")
+
+
+def _duplicate(track, seen):
+    """Whether an earlier track of the merge was the same one; remembers `track` otherwise."""
+    keys = track_keys(track)
+    if any(key in seen for key in keys):
+        return True
+    seen.update(keys)
+    return False
+
+
+def _skip_duplicate(job, index, track):
+    # Processed, but nothing was transferred for it
+    job.advance(succeeded=False)
+    tracks_processed.inc(outcome="duplicate")
+    job.emit("skipped", index=index, track=track_query(track), reason="duplicate of an earlier track in the merge")
+
+
+def _result_recorder(job, spotify_user_id, resume_key, failures):
+    """The inserter's `on_result`: counts, reports and saves progress for each settled track."""
+    def on_result(resolution, error):
+        error = resolution.error or error
+        if error:
+            # Per track, so it's a warning that LOG_SAMPLE_RATES can thin out; the dead-letter list keeps every one
+            logger.warning(f"Error transferring track {resolution.query}: {error}")
+            failures[0] += 1
+            dead_letters.add(spotify_user_id, job.playlist_id, resolution.index, resolution.track, resolution.query, error)
+            job.advance(succeeded=False)
+            tracks_processed.inc(outcome="failed")
+            job.emit("failed", index=resolution.index, track=resolution.query, error=str(error))
+            return
+        job.advance(succeeded=bool(resolution.video_id))
+        tracks_processed.inc(outcome="inserted" if resolution.video_id else "no_match")
+        if not resolution.video_id:
+            job.emit("skipped", index=resolution.index, track=resolution.query, reason="no match on YouTube")
+        else:
+            job.emit("inserted", index=resolution.index, track=resolution.query, video_id=resolution.video_id)
+            sync_store.record_item(spotify_user_id, job.playlist_id, track_keys(resolution.track)[0], resolution.video_id)
+        # Save progress
+        progress_store.record(resume_key, resolution.index, resolution.video_id)
+
+    return on_result
+
+
+def _rate_limit_reporter(job):
+    last_wait_event = [0.0]
+
+    def on_rate_limit(waited):
+        # Throttled searches are routine, so report them at most every few seconds
+        now = time.monotonic()
+        if now - last_wait_event[0] >= 5:
+            last_wait_event[0] = now
+            job.emit("rate_limit_wait", seconds=round(waited, 2))
+
+    return on_rate_limit
+
+
+def _report_match(job, resolution):
+    if resolution.video_id:
+        job.emit("matched", index=resolution.index, track=resolution.query, video_id=resolution.video_id,
+                 cached=resolution.cached, score=round(resolution.score, 2) if resolution.score is not None else None)
+
+
+def _complete(job, spotify_user_id, resume_key, playlist, mapping, youtube_playlist_id, failures):
+    # Unavailable tracks are skipped without being counted, so settle the total on what was seen
+    job.set_total(job.processed)
+
+    # Clear progress on completion and remember which snapshot YouTube now mirrors
+    progress_store.clear(resume_key)
+    sync_store.complete(spotify_user_id, job.playlist_id, playlist["snapshot_id"])
+    verb = "synced" if mapping and youtube_playlist_id == mapping.youtube_playlist_id else "transferred"
+    message = f"Playlist '{playlist['name']}' {verb} successfully!"
+    if failures[0]:
+        message += f" {failures[0]} tracks failed and will be retried on the next transfer."
+    job.finish(message)
+
+
+def _transfer_tracks(job, sp, youtube, spotify_user_id, resume_key, credentials,
+                     playlist, mapping, synced, first_page, last_transferred, quota):
+    # Reuse the YouTube playlist from the last sync unless it has been deleted since
+    existing_videos = []
+    youtube_playlist_id = None
+    if mapping:
+        videos = fetch_playlist_videos(youtube, mapping.youtube_playlist_id, quota)
+        if videos is not None:
+            youtube_playlist_id = mapping.youtube_playlist_id
+            existing_videos = videos
+    if youtube_playlist_id is None:
+        # Create YouTube playlist
+        youtube_playlist_id = _create_playlist(youtube, playlist, quota)
+        synced = {}
+        if last_transferred:
+            # The resume point belonged to the playlist that's gone, so start over
+            progress_store.clear(resume_key)
+            last_transferred = 0
+            first_page = None
+    _start_sync(job, spotify_user_id, youtube_playlist_id, last_transferred)
+    _report_resume(job, resume_key, last_transferred)
+    failures = [0]
+    present = set(existing_videos)
+    sources = merged_playlist_ids(job.playlist_id)
+    seen = set()
+
+    def missing_tracks(entries):
+        for index, track in entries:
+            if sources:
+                if _duplicate(track, seen):
+                    if index >= last_transferred:
+                        _skip_duplicate(job, index, track)
+                    continue
+                if index < last_transferred:
+                    continue
+            if _already_present(track, synced, present):
+                _skip_present(job, index, track)
+                continue
+            yield index, track
+
+    # Stream tracks page by page while earlier pages are resolved and batch-inserted in playlist order
+    if sources:
+        job.set_total(max(playlist["total"] - last_transferred, 0))
+        tracks = iter_merged_tracks(sp, sources, first_page)
+    else:
+        tracks = iter_playlist_tracks(sp, job.playlist_id, offset=last_transferred, first_page=first_page,
+                                      on_total=lambda total: job.set_total(max(total - last_transferred, 0)))
+    entries = prefetch(missing_tracks(tracks))
+
+    resolver = SearchResolver(youtube, credentials, quota=quota, on_rate_limit=_rate_limit_reporter(job))
+    # New tracks go after everything already in the playlist
+    inserter = PlaylistInserter(youtube, youtube_playlist_id, _result_recorder(job, spotify_user_id, resume_key, failures),
+                                start_position=len(existing_videos), quota=quota)
+    for resolution in resolver.resolve_all(entries):
+        _report_match(job, resolution)
+        inserter.add(resolution)
+    inserter.flush()
+    _complete(job, spotify_user_id, resume_key, playlist, mapping, youtube_playlist_id, failures)
+
+
+async def _transfer_tracks_async(job, apis, spotify_user_id, resume_key,
+                                 playlist, mapping, synced, first_page, last_transferred, quota):
+    existing_videos = []
+    youtube_playlist_id = None
+    if mapping:
+        videos = await fetch_playlist_videos_async(apis, mapping.youtube_playlist_id, quota)
+        if videos is not None:
+            youtube_playlist_id = mapping.youtube_playlist_id
+            existing_videos = videos
+    if youtube_playlist_id is None:
+        youtube_playlist_id = await _create_playlist_async(apis, playlist, quota)
+        synced = {}
+        if last_transferred:
+            await asyncio.to_thread(progress_store.clear, resume_key)
+            last_transferred = 0
+            first_page = None
+    await asyncio.to_thread(_start_sync, job, spotify_user_id, youtube_playlist_id, last_transferred)
+    await asyncio.to_thread(_report_resume, job, resume_key, last_transferred)
+    failures = [0]
+    present = set(existing_videos)
+    sources = merged_playlist_ids(job.playlist_id)
+    seen = set()
+    if sources:
+        job.set_total(max(playlist["total"] - last_transferred, 0))
+        tracks = iter_merged_tracks_async(apis, sources, first_page)
+    else:
+        tracks = iter_playlist_tracks_async(apis, job.playlist_id, offset=last_transferred, first_page=first_page,
+                                            on_total=lambda total: job.set_total(max(total - last_transferred, 0)))
+
+    async def missing_tracks():
+        async for index, track in tracks:
+            if sources:
+                if _duplicate(track, seen):
+                    if index >= last_transferred:
+                        await asyncio.to_thread(_skip_duplicate, job, index, track)
+                    continue
+                if index < last_transferred:
+                    continue
+            if _already_present(track, synced, present):
+                await asyncio.to_thread(_skip_present, job, index, track)
+                continue
+            yield index, track
+
+    resolver = AsyncSearchResolver(apis, quota=quota, on_rate_limit=_rate_limit_reporter(job))
+    inserter = AsyncPlaylistInserter(apis, youtube_playlist_id, _result_recorder(job, spotify_user_id, resume_key, failures),
+                                     start_position=len(existing_videos), quota=quota)
+    async for resolution in resolver.resolve_all(prefetch_async(missing_tracks())):
+        if resolution.video_id:
+            await asyncio.to_thread(_report_match, job, resolution)
+        await inserter.add(resolution)
+    await inserter.flush()
+    await asyncio.to_thread(_complete, job, spotify_user_id, resume_key, playlist, mapping, youtube_playlist_id, failures)